@@ -0,0 +1,31 @@
+package common
+
+// ackWindow Batches sent to the server that were not acknowledged yet, in the
+// order they were sent. Batches are numbered from 0 in every connection, the
+// same way the server numbers them in its acknowledgements.
+type ackWindow struct {
+	sizes   []int
+	nextSeq int
+}
+
+// Len Amount of batches in flight
+func (w *ackWindow) Len() int {
+	return len(w.sizes)
+}
+
+// Push Registers a sent batch of `size` bets
+func (w *ackWindow) Push(size int) {
+	w.sizes = append(w.sizes, size)
+}
+
+// AckUpTo Removes every batch up to the one numbered `seq` and returns how
+// many bets they had
+func (w *ackWindow) AckUpTo(seq int) int {
+	acked := 0
+	for len(w.sizes) > 0 && w.nextSeq <= seq {
+		acked += w.sizes[0]
+		w.sizes = w.sizes[1:]
+		w.nextSeq++
+	}
+	return acked
+}
@@ -0,0 +1,102 @@
+package common
+
+import "time"
+
+// adaptiveWindow Minimum amount of batches sent between two budget adjustments
+const adaptiveWindow = 8
+
+// adaptiveWindowDuration Minimum time between two budget adjustments, so
+// throughput is not measured over a handful of buffered writes
+const adaptiveWindowDuration = 50 * time.Millisecond
+
+// adaptiveGain Minimum throughput improvement for a bigger budget to be kept
+const adaptiveGain = 1.05
+
+// batchSizer Decides the byte budget of the batches sent to the server.
+// With a fixed budget every batch is filled up to maxBytes. When adaptive,
+// the budget starts at minBytes and doubles after every measurement window
+// while the observed throughput keeps improving, until it plateaus or
+// reaches maxBytes. If the throughput later drops to half of the best
+// one observed, the budget is probed again from minBytes.
+type batchSizer struct {
+	adaptive bool
+	minBytes int
+	maxBytes int
+	budget   int
+
+	settled        bool
+	bestBudget     int
+	bestThroughput float64
+	windowStart    time.Time
+	windowBytes    int
+	windowBatches  int
+}
+
+func newBatchSizer(config ClientConfig) *batchSizer {
+	s := &batchSizer{
+		adaptive: config.AdaptiveBatches,
+		minBytes: config.MinBatchBytes,
+		maxBytes: config.MaxBatchBytes,
+		budget:   config.MaxBatchBytes,
+	}
+	if s.adaptive && s.minBytes > 0 && s.minBytes < s.maxBytes {
+		s.budget = s.minBytes
+	}
+	return s
+}
+
+// Budget Maximum encoded size of the next batch, header included
+func (s *batchSizer) Budget() int {
+	return s.budget
+}
+
+// Observe Registers that a batch of frameBytes was sent, adjusting the
+// budget at the end of every window when adaptive
+func (s *batchSizer) Observe(frameBytes int) {
+	if !s.adaptive {
+		return
+	}
+	if s.windowBatches == 0 {
+		s.windowStart = time.Now()
+	}
+	s.windowBytes += frameBytes
+	s.windowBatches++
+	elapsed := time.Since(s.windowStart)
+	if s.windowBatches < adaptiveWindow || elapsed < adaptiveWindowDuration {
+		return
+	}
+
+	throughput := float64(s.windowBytes) / elapsed.Seconds()
+	s.windowBytes = 0
+	s.windowBatches = 0
+
+	if s.settled {
+		if throughput < s.bestThroughput/2 {
+			s.settled = false
+			s.bestThroughput = 0
+			s.budget = s.minBytes
+			log.Debugf("action: batch_budget | result: reset | budget: %d", s.budget)
+		}
+		return
+	}
+
+	if throughput > s.bestThroughput*adaptiveGain {
+		s.bestThroughput = throughput
+		s.bestBudget = s.budget
+		if s.budget < s.maxBytes {
+			s.budget = minInt(s.budget*2, s.maxBytes)
+			log.Debugf("action: batch_budget | result: grow | budget: %d", s.budget)
+			return
+		}
+	}
+	s.budget = s.bestBudget
+	s.settled = true
+	log.Debugf("action: batch_budget | result: settled | budget: %d | throughput: %.0f", s.budget, s.bestThroughput)
+}
+
+func minInt(a, b int) int {
+	if a < b {
+		return a
+	}
+	return b
+}
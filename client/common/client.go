@@ -1,11 +1,16 @@
 package common
 
 import (
-	"bufio"
+	"errors"
 	"fmt"
+	"io"
+	"math"
 	"net"
 	"os"
 	"os/signal"
+	"strconv"
+	"strings"
+	"sync"
 	"syscall"
 	"time"
 
@@ -24,6 +29,16 @@ const MSG_END = "END"
 const MSG_ALL_BETS_SENT = "ALL_BETS_SENT"
 const MSG_RESULTS_REQUEST = "RESULTS_REQUEST"
 const MSG_LOTERY_IN_PROGRESS = "LOTERY_IN_PROGRESS"
+const MSG_LOAD_OK = "LOAD_OK"
+const MSG_ACK = "ACK"
+const MSG_SERVER_BUSY = "SERVER_BUSY"
+const MSG_SERVER_DRAINING = "SERVER_DRAINING"
+const OPT_BET_BATCH = "BET_BATCH"
+const OPT_ACK = "ACK"
+const OPT_OFFSET = "OFFSET"
+const OPT_STREAM = "STREAM"
+const OPT_ZLIB = "ZLIB"
+const OPT_WAIT = "WAIT"
 
 // ClientConfig Configuration used by the client
 type ClientConfig struct {
@@ -33,13 +48,52 @@ type ClientConfig struct {
 	LoopPeriod         time.Duration
 	MaxBatchSize       int
 	ResultsRetryPeriod time.Duration
+	ResultsWait        bool
+	BinaryBatches      bool
+	MaxBatchBytes      int
+	MinBatchBytes      int
+	AdaptiveBatches    bool
+	AckWindow          int
+	MaxReconnects      int
+	ReconnectPeriod    time.Duration
+	Streams            int
+	// CompressionLevel zlib level of the batches (0 disables compression)
+	CompressionLevel int
+	// CompressionMinBytes Batches smaller than this are sent uncompressed
+	CompressionMinBytes int
+	// ShutdownTimeout Time given on SIGTERM to the batches in flight to be
+	// acknowledged before closing the connection (0 closes it right away)
+	ShutdownTimeout time.Duration
 }
 
+// errServerDraining The server stopped the upload because it is shutting down
+var errServerDraining = errors.New("server draining")
+
+// errClientStopped The upload was stopped because the client is shutting down
+var errClientStopped = errors.New("client stopped")
+
 // Client Entity that encapsulates how
 type Client struct {
-	config  ClientConfig
-	conn    net.Conn
-	running bool
+	config      ClientConfig
+	conn        net.Conn
+	running     bool
+	useBetBatch bool
+	useAck      bool
+	useZlib     bool
+	// resumeOffset Amount of lines of the data file already stored by the server
+	resumeOffset int
+	busyRetries  int
+	// frame Buffer the batches are encoded into, reused across uploads
+	frame      frameBuilder
+	compressor *frameCompressor
+	// stream Part of the data file uploaded by this client, when the upload
+	// is split in `config.Streams` parallel streams
+	stream int
+	// streamClients Clients uploading the parts of the data file in parallel
+	streamClients []*Client
+	// uploading Whether batches are being sent through the connection
+	uploading bool
+	mu        sync.Mutex
 }
 
 // NewClient Initializes a new client receiving the configuration
@@ -53,8 +107,7 @@ func NewClient(config ClientConfig) *Client {
 	signal.Notify(sig, syscall.SIGTERM)
 	go func() {
 		<-sig
-		client.running = false
-		client.conn.Close()
+		client.stop()
 		log.Infof("action: socket_closed | result: success | client_id: %v", client.config.ID)
 	}()
 
@@ -72,6 +125,7 @@ func (c *Client) createClientSocket() error {
 			c.config.ID,
 			err,
 		)
+		return err
 	}
 	c.conn = conn
 	return nil
@@ -87,53 +141,137 @@ func (c *Client) StartClientLoop() {
 		return
 	}
 
-	c.createClientSocket()
-	defer c.close_connection()
-
-	shouldReturn := c.sendLoadBatchesRequest()
-	if shouldReturn {
+	if c.config.Streams > 1 && c.uploadStreams() {
 		return
 	}
 
-	shouldReturn = c.sendBatchedData()
-	if shouldReturn {
+	if err := c.createClientSocket(); err != nil {
 		return
 	}
+	defer c.close_connection()
 
-	shouldReturn = c.sendEndMessage()
-	if shouldReturn {
-		return
-	}
+	shouldReturn := false
+	if c.config.Streams <= 1 {
+		shouldReturn = c.startLoadBatches()
+		if shouldReturn {
+			return
+		}
 
-	shouldReturn = c.sendAllBetsSentNotification()
-	if shouldReturn {
-		return
+		shouldReturn = c.sendBatchedData()
+		if shouldReturn {
+			return
+		}
+		shouldReturn = c.sendEndMessage()
 	}
 
-	log.Infof("action: apuestas_enviadas | result: success")
+	// Every batch was stored by now. From here on, a server that resumes
+	// uploads may restart: a lost connection is replaced and the agency
+	// notified again, instead of giving up
+	shouldReturn = shouldReturn || c.sendAllBetsSentNotification()
+	if !shouldReturn {
+		log.Infof("action: apuestas_enviadas | result: success")
+	}
 
 	var winners []string
 
-	for {
-
-		shouldReturn = c.askForResults()
+	for reconnects := 0; ; {
 		if shouldReturn {
-			return
+			if !c.running || !c.useAck || reconnects >= c.config.MaxReconnects {
+				return
+			}
+			reconnects++
+			if c.redial() {
+				return
+			}
+			shouldReturn = c.sendAllBetsSentNotification()
+			continue
 		}
 
-		winners, shouldReturn = c.receiveResults()
+		askedAt := time.Now()
+		shouldReturn = c.askForResults()
+		if !shouldReturn {
+			winners, shouldReturn = c.receiveResults()
+		}
 		if shouldReturn {
-			return
+			continue
 		}
 		if winners != nil {
 			break
 		}
-		time.Sleep(c.config.ResultsRetryPeriod)
+		// A request held by the server already waited, only
+		// wait what is left of the retry period
+		time.Sleep(c.config.ResultsRetryPeriod - time.Since(askedAt))
 	}
 
 	log.Infof("action: consulta_ganadores | result: success | cant_ganadores: %d", len(winners))
 }
 
+// uploadStreams Uploads the data file through `c.config.Streams` connections at
+// once, each one sending a contiguous part of the file in its own LOAD_BATCHES
+// request. It returns once every part was uploaded (so ALL_BETS_SENT is only sent
+// afterwards), or true if any of them could not be.
+func (c *Client) uploadStreams() bool {
+	streams := make([]*Client, c.config.Streams)
+	c.mu.Lock()
+	for k := range streams {
+		streams[k] = &Client{config: c.config, running: c.running, stream: k}
+	}
+	c.streamClients = streams
+	c.mu.Unlock()
+
+	results := make(chan bool, len(streams))
+	for _, stream := range streams {
+		go func(stream *Client) {
+			results <- stream.uploadPart()
+		}(stream)
+	}
+	failed := false
+	for range streams {
+		failed = <-results || failed
+	}
+	c.useAck = streams[0].useAck
+	return failed
+}
+
+// uploadPart Uploads the part of the data file of a stream through its own connection
+func (c *Client) uploadPart() bool {
+	if err := c.createClientSocket(); err != nil {
+		return true
+	}
+	defer c.close_connection()
+	if c.startLoadBatches() || c.sendBatchedData() {
+		return true
+	}
+	// With acknowledgements every batch of the part was stored by now
+	return c.sendEndMessage() && !c.useAck
+}
+
+// stop Stops the client and the clients of its streams. A connection uploading
+// batches stops sending them and is given `ShutdownTimeout` to receive the
+// acknowledgements of the ones in flight and send END; any other is closed
+func (c *Client) stop() {
+	c.mu.Lock()
+	defer c.mu.Unlock()
+	c.running = false
+	for _, stream := range c.streamClients {
+		stream.stop()
+	}
+	if c.conn == nil {
+		return
+	}
+	if c.uploading && c.config.ShutdownTimeout > 0 {
+		c.conn.SetDeadline(time.Now().Add(c.config.ShutdownTimeout))
+		return
+	}
+	c.conn.Close()
+}
+
+func (c *Client) setUploading(uploading bool) {
+	c.mu.Lock()
+	defer c.mu.Unlock()
+	c.uploading = uploading
+}
+
 func (c *Client) close_connection() {
 	c.sendEndMessage()
 	c.conn.Close()
@@ -156,6 +294,9 @@ func (c *Client) receiveResults() ([]string, bool) {
 		stringMsg, ok := msg.(StringMessage)
 		if ok && stringMsg.Value == MSG_LOTERY_IN_PROGRESS {
 			return nil, false
+		} else if ok && stringMsg.Value == MSG_SERVER_DRAINING {
+			log.Infof("action: receive_results | result: retry | client_id: %v | error: %v", c.config.ID, errServerDraining)
+			return nil, true
 		} else {
 			log.Errorf("action: receive_results | result: fail | client_id: %v | error: invalid message received", c.config.ID)
 			return nil, true
@@ -164,8 +305,13 @@ func (c *Client) receiveResults() ([]string, bool) {
 	return stringListMsg.Values, false
 }
 
+// askForResults Sends the RESULTS_REQUEST. If `c.config.ResultsWait` is set, it
+// asks the server to hold the reply until the lottery is completed.
 func (c *Client) askForResults() bool {
 	msg := fmt.Sprintf("%s,%s", MSG_RESULTS_REQUEST, c.config.ID)
+	if c.config.ResultsWait {
+		msg = fmt.Sprintf("%s,%s", msg, OPT_WAIT)
+	}
 	return c.sendMessage(msg)
 }
 
@@ -178,9 +324,86 @@ func (c *Client) sendEndMessage() bool {
 	return c.sendMessage(MSG_END)
 }
 
+// startLoadBatches Sends the first LOAD_BATCHES request. If the server acknowledges
+// batches, a lost connection is replaced up to `c.config.MaxReconnects` times, since
+// the server may be restarting and an upload can be resumed
+func (c *Client) startLoadBatches() bool {
+	for attempt := 0; c.sendLoadBatchesRequest(); attempt++ {
+		if !c.running || c.config.AckWindow <= 0 || attempt >= c.config.MaxReconnects || c.redial() {
+			return true
+		}
+	}
+	return false
+}
+
+// sendLoadBatchesRequest Sends the LOAD_BATCHES request, offering the
+// optional features enabled in the configuration. If any was offered, the
+// server replies with the ones it accepts, and only those are used.
 func (c *Client) sendLoadBatchesRequest() bool {
-	msg := fmt.Sprintf("%s,%s", MSG_LOAD_BATCHES, c.config.ID)
-	return c.sendMessage(msg)
+	options := []string{}
+	if c.config.BinaryBatches {
+		options = append(options, OPT_BET_BATCH)
+	}
+	if c.config.AckWindow > 0 {
+		options = append(options, OPT_ACK)
+	}
+	if c.config.Streams > 1 {
+		options = append(options, fmt.Sprintf("%s=%d/%d", OPT_STREAM, c.stream, c.config.Streams))
+	}
+	if c.config.CompressionLevel != 0 {
+		options = append(options, OPT_ZLIB)
+	}
+
+	msg := strings.Join(append([]string{MSG_LOAD_BATCHES, c.config.ID}, options...), ",")
+	if shouldReturn := c.sendMessage(msg); shouldReturn || len(options) == 0 {
+		return shouldReturn
+	}
+
+	reply, err := ReceiveMessage(c.conn)
+	if err != nil {
+		if !c.running {
+			return true
+		}
+		log.Errorf("action: receive_message | result: fail | client_id: %v | error: %v", c.config.ID, err)
+		return true
+	}
+	stringMsg, ok := reply.(StringMessage)
+	if ok && (stringMsg.Value == MSG_SERVER_BUSY || stringMsg.Value == MSG_SERVER_DRAINING) {
+		return c.retryWhenBusy(stringMsg.Value)
+	}
+	accepted := strings.Split(stringMsg.Value, ",")
+	if !ok || accepted[0] != MSG_LOAD_OK {
+		log.Errorf("action: load_batches | result: fail | client_id: %v | error: invalid reply received", c.config.ID)
+		return true
+	}
+	c.useBetBatch = false
+	c.useAck = false
+	c.useZlib = false
+	streamAccepted := false
+	for _, option := range accepted[1:] {
+		switch {
+		case option == OPT_BET_BATCH:
+			c.useBetBatch = true
+		case option == OPT_ACK:
+			c.useAck = true
+		case option == OPT_ZLIB:
+			c.useZlib = true
+		case strings.HasPrefix(option, OPT_STREAM+"="):
+			streamAccepted = true
+		case strings.HasPrefix(option, OPT_OFFSET+"="):
+			offset, err := strconv.Atoi(strings.TrimPrefix(option, OPT_OFFSET+"="))
+			if err != nil || offset < 0 {
+				log.Errorf("action: load_batches | result: fail | client_id: %v | error: invalid offset %v", c.config.ID, option)
+				return true
+			}
+			c.resumeOffset = offset
+		}
+	}
+	if c.config.Streams > 1 && !streamAccepted {
+		log.Errorf("action: load_batches | result: fail | client_id: %v | error: parallel streams not supported", c.config.ID)
+		return true
+	}
+	return false
 }
 func (c *Client) sendMessage(msg string) bool {
 	err := SendMessage(c.conn, StringMessage{Value: msg})
@@ -197,50 +420,261 @@ func (c *Client) sendMessage(msg string) bool {
 	return false
 }
 
-// sendBatchedData Reads the data file `/data/agency-<client_id>` and sends its content in batches
-// of size `c.config.MaxBatchSize`. If an error occurs while sending a batch, it logs the error
-// and returns true to indicate that the calling function should return immediately.
-// If all data is sent successfully, it returns false.
+// sendBatchedData Reads the data file `/data/agency-<client_id>` and sends its content in batches.
+// If the server acknowledges batches and the upload is interrupted, it reconnects up to
+// `c.config.MaxReconnects` times and resumes from the last batch stored by the server.
+// If the upload can't be completed, it logs the error and returns true to indicate that the
+// calling function should return immediately. If all data is sent successfully, it returns false.
+// A server that is draining stops the upload with SERVER_DRAINING, which is resumed the same way.
 func (c *Client) sendBatchedData() bool {
+	c.setUploading(true)
+	defer c.setUploading(false)
+	for attempt := 0; ; attempt++ {
+		err := c.uploadBatches()
+		if err == nil {
+			return false
+		}
+		if !c.running {
+			if errors.Is(err, errClientStopped) {
+				// Every batch sent was acknowledged: END finishes the upload cleanly
+				c.sendEndMessage()
+			}
+			log.Infof("action: send_batches | result: stopped | client_id: %v | offset: %d", c.config.ID, c.resumeOffset)
+			return true
+		}
+		if errors.Is(err, errServerDraining) {
+			log.Infof("action: send_batches | result: retry | client_id: %v | error: %v", c.config.ID, err)
+		} else {
+			log.Errorf("action: send_batches | result: fail | client_id: %v | error: %v", c.config.ID, err)
+		}
+		if !c.useAck || attempt >= c.config.MaxReconnects {
+			return true
+		}
+		if c.reconnect() {
+			return true
+		}
+		log.Infof("action: resume_batches | result: in_progress | client_id: %v | offset: %d", c.config.ID, c.resumeOffset)
+	}
+}
+
+// retryWhenBusy Connects again after `c.config.ReconnectPeriod` when the server
+// was too busy to serve the connection (or was draining), up to
+// `c.config.MaxReconnects` times
+func (c *Client) retryWhenBusy(reply string) bool {
+	reason := strings.ToLower(strings.ReplaceAll(reply, "_", " "))
+	if c.busyRetries >= c.config.MaxReconnects {
+		log.Errorf("action: load_batches | result: fail | client_id: %v | error: %v", c.config.ID, reason)
+		return true
+	}
+	c.busyRetries++
+	log.Infof("action: load_batches | result: retry | client_id: %v | error: %v", c.config.ID, reason)
+	return c.reconnect()
+}
+
+// reconnect Replaces the current connection with a new one and sends a new
+// LOAD_BATCHES request through it, updating the resume offset
+func (c *Client) reconnect() bool {
+	if c.redial() {
+		return true
+	}
+	return c.sendLoadBatchesRequest()
+}
+
+// redial Replaces the connection with a new one, trying every reconnect
+// period (the server may be restarting) up to `MaxReconnects` times
+func (c *Client) redial() bool {
+	c.conn.Close()
+	for attempt := 0; attempt < c.config.MaxReconnects; attempt++ {
+		time.Sleep(c.config.ReconnectPeriod)
+		if !c.running {
+			return true
+		}
+		if err := c.createClientSocket(); err == nil {
+			return false
+		}
+	}
+	return true
+}
+
+// uploadBatches Sends the lines of the data file after `c.resumeOffset` in batches whose
+// encoded size fits the byte budget decided by the batch sizer (and, if configured, of at
+// most `c.config.MaxBatchSize` bets).
+// The file is read ahead in a goroutine, and every batch is encoded straight into a frame
+// buffer reused across batches, so the upload allocates about the same at any file size.
+// When the server acknowledges batches, up to `c.config.AckWindow` batches are sent ahead
+// of the acknowledgements, and the upload ends once every batch was acknowledged.
+func (c *Client) uploadBatches() error {
 	filePath := fmt.Sprintf("./data/agency-%s.csv", c.config.ID)
 	file, err := os.Open(filePath)
 	if err != nil {
-		log.Errorf("action: open_file | result: fail | client_id: %v | error: %v", c.config.ID, err)
-		return true
+		return fmt.Errorf("open file: %w", err)
+	}
+	start, end, err := c.partBounds(file)
+	if err != nil {
+		file.Close()
+		return fmt.Errorf("stat file: %w", err)
+	}
+	reader := newLineReader(file, start, end)
+	defer reader.Close()
+
+	agency, err := strconv.ParseUint(c.config.ID, 10, 16)
+	if c.useBetBatch && err != nil {
+		return fmt.Errorf("parse agency: %w", err)
 	}
-	defer file.Close()
 
-	scanner := bufio.NewScanner(file)
-	batch := []string{}
-	batchSize := 0
-	for scanner.Scan() {
-		if batchSize >= c.config.MaxBatchSize {
-			msg := StringListMessage{Values: batch}
-			err := SendMessage(c.conn, msg)
+	window := &ackWindow{}
+	sizer := newBatchSizer(c.config)
+	frame := &c.frame
+	frame.Reset(c.batchType())
+	skip := c.resumeOffset
+	for {
+		chunk, err := reader.Next()
+		if err == io.EOF {
+			break
+		}
+		if err != nil {
+			return fmt.Errorf("read file: %w", err)
+		}
+		var line []byte
+		for lines := *chunk; len(lines) > 0; {
+			line, lines = nextLine(lines)
+			if skip > 0 {
+				skip--
+				continue
+			}
+			var bet betRecord
+			itemBytes := StringListItemOverhead + len(line)
+			if c.useBetBatch {
+				bet, err = parseBetRecord(line)
+				if err != nil {
+					return fmt.Errorf("parse bet: %w", err)
+				}
+				itemBytes = bet.EncodedSize()
+			}
+
+			full := c.config.MaxBatchSize > 0 && frame.Count() >= c.config.MaxBatchSize
+			if frame.Count() > 0 && (full || frame.Len()+itemBytes > sizer.Budget()) {
+				if err := c.sendBatch(frame, window); err != nil {
+					return err
+				}
+				sizer.Observe(frame.Len())
+				frame.Reset(c.batchType())
+			}
+
+			if c.useBetBatch {
+				frame.AppendBet(uint16(agency), &bet)
+			} else {
+				frame.AppendString(line)
+			}
+		}
+		reader.Release(chunk)
+	}
+	if frame.Count() > 0 {
+		if err := c.sendBatch(frame, window); err != nil {
+			return err
+		}
+	}
+	for window.Len() > 0 {
+		if err := c.receiveAck(window); err != nil {
+			return err
+		}
+	}
+	return nil
+}
+
+// partBounds Byte range of the data file whose lines are uploaded by this
+// client: the whole file, or the part of its stream
+func (c *Client) partBounds(file *os.File) (int64, int64, error) {
+	if c.config.Streams <= 1 {
+		return 0, math.MaxInt64, nil
+	}
+	info, err := file.Stat()
+	if err != nil {
+		return 0, 0, err
+	}
+	streams := int64(c.config.Streams)
+	start := info.Size() * int64(c.stream) / streams
+	end := info.Size() * int64(c.stream+1) / streams
+	if c.stream == c.config.Streams-1 {
+		end = math.MaxInt64
+	}
+	return start, end, nil
+}
+
+// sendBatch Sends the batch encoded in `frame`. When the server acknowledges batches,
+// it waits for an acknowledgement first if the window of in-flight batches is full
+func (c *Client) sendBatch(frame *frameBuilder, window *ackWindow) error {
+	if !c.running {
+		return c.stopUpload(window)
+	}
+	if c.useAck {
+		for window.Len() >= c.config.AckWindow {
+			if err := c.receiveAck(window); err != nil {
+				return err
+			}
+		}
+	}
+	data := frame.Bytes()
+	if c.useZlib && len(data) >= c.config.CompressionMinBytes {
+		if c.compressor == nil {
+			compressor, err := newFrameCompressor(c.config.CompressionLevel)
 			if err != nil {
-				log.Errorf("action: send_message | result: fail | client_id: %v | error: %v",
-					c.config.ID,
-					err,
-				)
-				return true
+				return fmt.Errorf("compress batch: %w", err)
 			}
-			batch = nil
-			batchSize = 0
+			c.compressor = compressor
 		}
-		line := scanner.Text()
-		batch = append(batch, line)
-		batchSize++
+		data = c.compressor.Compress(data)
 	}
-	if batchSize > 0 {
-		msg := StringListMessage{Values: batch}
-		err := SendMessage(c.conn, msg)
-		if err != nil {
-			log.Errorf("action: send_message | result: fail | client_id: %v | error: %v",
-				c.config.ID,
-				err,
-			)
-			return true
+	if err := SendFrame(c.conn, data); err != nil {
+		return fmt.Errorf("send batch: %w", err)
+	}
+	if c.useAck {
+		window.Push(frame.Count())
+	} else {
+		c.resumeOffset += frame.Count()
+	}
+	return nil
+}
+
+// stopUpload Stops sending batches once the client is stopped: the batches in
+// flight are still acknowledged, so the server stores them and the upload can be
+// resumed right after them
+func (c *Client) stopUpload(window *ackWindow) error {
+	for c.useAck && window.Len() > 0 {
+		if err := c.receiveAck(window); err != nil {
+			return err
 		}
 	}
-	return false
+	return errClientStopped
+}
+
+// receiveAck Waits for the next acknowledgement from the server and removes
+// the acknowledged batches from the window, advancing the resume offset
+func (c *Client) receiveAck(window *ackWindow) error {
+	msg, err := ReceiveMessage(c.conn)
+	if err != nil {
+		return fmt.Errorf("receive ack: %w", err)
+	}
+	stringMsg, ok := msg.(StringMessage)
+	if ok && stringMsg.Value == MSG_SERVER_DRAINING {
+		return errServerDraining
+	}
+	parts := strings.Split(stringMsg.Value, ",")
+	if !ok || len(parts) != 2 || parts[0] != MSG_ACK {
+		return fmt.Errorf("invalid ack received")
+	}
+	seq, err := strconv.Atoi(parts[1])
+	if err != nil {
+		return fmt.Errorf("invalid ack received: %w", err)
+	}
+	c.resumeOffset += window.AckUpTo(seq)
+	return nil
+}
+
+// batchType Message type of the batches, using the encoding negotiated with the server
+func (c *Client) batchType() byte {
+	if c.useBetBatch {
+		return TypeBetBatch
+	}
+	return TypeStringList
 }
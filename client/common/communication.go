@@ -13,8 +13,25 @@ const HeaderSize = 5
 const (
 	TypeString     byte = 0x01
 	TypeStringList byte = 0x02
+	TypeBetBatch   byte = 0x03
+	// TypeCompressed The type of a batch message (1 byte) followed by its
+	// body compressed as a zlib stream
+	TypeCompressed byte = 0x04
 )
 
+// StringListItemOverhead Bytes added to every string of a StringListMessage
+const StringListItemOverhead = 4
+
+// BetBatchHeaderSize Size of the record count at the start of a TypeBetBatch frame
+const BetBatchHeaderSize = 4
+
+// BetRecordSize Size of the fixed part of a bet record in a TypeBetBatch frame:
+// agency (u16), number (u32), birthdate (i32) and the sizes (u16) of the
+// first name, last name and document that follow it
+const BetRecordSize = 2 + 4 + 4 + 3*2
+
+const secondsPerDay = 24 * 60 * 60
+
 type Message interface {
 	Type() byte
 	EncodeBody() ([]byte, error)
@@ -37,14 +54,16 @@ type StringListMessage struct {
 func (m StringListMessage) Type() byte { return TypeStringList }
 
 func (m StringListMessage) EncodeBody() ([]byte, error) {
-	buf := make([]byte, 0)
+	size := 0
 	for _, s := range m.Values {
-		strBytes := []byte(s)
-		size := uint32(len(strBytes))
-		sizeBuf := make([]byte, 4)
-		binary.BigEndian.PutUint32(sizeBuf, size)
-		buf = append(buf, sizeBuf...)
-		buf = append(buf, strBytes...)
+		size += StringListItemOverhead + len(s)
+	}
+	buf := make([]byte, 0, size)
+	var sizeBuf [StringListItemOverhead]byte
+	for _, s := range m.Values {
+		binary.BigEndian.PutUint32(sizeBuf[:], uint32(len(s)))
+		buf = append(buf, sizeBuf[:]...)
+		buf = append(buf, s...)
 	}
 	return buf, nil
 }
@@ -85,14 +104,17 @@ func SendMessage(conn net.Conn, msg Message) error {
 		return fmt.Errorf("encode error: %w", err)
 	}
 
-	header := make([]byte, HeaderSize)
-	header[0] = msg.Type()
-	binary.BigEndian.PutUint32(header[1:], uint32(len(body)))
+	packet := make([]byte, HeaderSize, HeaderSize+len(body))
+	packet[0] = msg.Type()
+	binary.BigEndian.PutUint32(packet[1:], uint32(len(body)))
+	return SendFrame(conn, append(packet, body...))
+}
 
-	packet := append(header, body...)
+// SendFrame Writes an already encoded frame, header included
+func SendFrame(conn net.Conn, frame []byte) error {
 	totalWritten := 0
-	for totalWritten < len(packet) {
-		n, err := conn.Write(packet[totalWritten:])
+	for totalWritten < len(frame) {
+		n, err := conn.Write(frame[totalWritten:])
 		if err != nil {
 			return err
 		}
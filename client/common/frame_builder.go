@@ -0,0 +1,209 @@
+package common
+
+import (
+	"bytes"
+	"compress/zlib"
+	"encoding/binary"
+	"fmt"
+	"math"
+	"time"
+)
+
+// betRecord A bet parsed from a data file line, with its text fields still
+// pointing to the line, so it can be encoded without allocating strings
+type betRecord struct {
+	FirstName []byte
+	LastName  []byte
+	Document  []byte
+	Birthdate int32 // days since 1970-01-01
+	Number    uint32
+}
+
+// parseBetRecord Parses a data file line with the format
+// `first_name,last_name,document,birthdate,number`
+func parseBetRecord(line []byte) (betRecord, error) {
+	var fields [5][]byte
+	count := 0
+	for start := 0; ; {
+		end := bytes.IndexByte(line[start:], ',')
+		if count == len(fields) {
+			return betRecord{}, fmt.Errorf("invalid bet line: expected 5 fields, got more")
+		}
+		if end < 0 {
+			fields[count] = bytes.TrimSpace(line[start:])
+			count++
+			break
+		}
+		fields[count] = bytes.TrimSpace(line[start : start+end])
+		count++
+		start += end + 1
+	}
+	if count != len(fields) {
+		return betRecord{}, fmt.Errorf("invalid bet line: expected 5 fields, got %d", count)
+	}
+	birthdate, err := parseDate(fields[3])
+	if err != nil {
+		return betRecord{}, fmt.Errorf("invalid bet birthdate: %w", err)
+	}
+	number, ok := parseUint32(fields[4])
+	if !ok {
+		return betRecord{}, fmt.Errorf("invalid bet number: %q", fields[4])
+	}
+	for _, text := range fields[0:3] {
+		if len(text) > math.MaxUint16 {
+			return betRecord{}, fmt.Errorf("invalid bet line: field too long")
+		}
+	}
+	return betRecord{
+		FirstName: fields[0],
+		LastName:  fields[1],
+		Document:  fields[2],
+		Birthdate: birthdate,
+		Number:    number,
+	}, nil
+}
+
+// parseDate Parses a `YYYY-MM-DD` date as days since 1970-01-01
+func parseDate(text []byte) (int32, error) {
+	if len(text) != 10 || text[4] != '-' || text[7] != '-' {
+		return 0, fmt.Errorf("invalid date %q", text)
+	}
+	year, okYear := parseUint32(text[0:4])
+	month, okMonth := parseUint32(text[5:7])
+	day, okDay := parseUint32(text[8:10])
+	if !okYear || !okMonth || !okDay {
+		return 0, fmt.Errorf("invalid date %q", text)
+	}
+	date := time.Date(int(year), time.Month(month), int(day), 0, 0, 0, 0, time.UTC)
+	if date.Month() != time.Month(month) || date.Day() != int(day) {
+		return 0, fmt.Errorf("invalid date %q", text)
+	}
+	return int32(date.Unix() / secondsPerDay), nil
+}
+
+// parseUint32 Parses a decimal number that fits in 32 bits
+func parseUint32(text []byte) (uint32, bool) {
+	if len(text) == 0 {
+		return 0, false
+	}
+	var value uint64
+	for _, digit := range text {
+		if digit < '0' || digit > '9' {
+			return 0, false
+		}
+		value = value*10 + uint64(digit-'0')
+		if value > math.MaxUint32 {
+			return 0, false
+		}
+	}
+	return uint32(value), true
+}
+
+// EncodedSize Size of the bet once encoded in a TypeBetBatch frame
+func (b *betRecord) EncodedSize() int {
+	return BetRecordSize + len(b.FirstName) + len(b.LastName) + len(b.Document)
+}
+
+// frameBuilder Encodes a batch frame, header included, straight into a
+// buffer that is reused from one batch to the next, instead of building
+// a Message and encoding it. Its bytes are valid until the next Reset.
+type frameBuilder struct {
+	buf     []byte
+	msgType byte
+	count   int
+}
+
+// Reset Starts a new, empty frame of the given message type
+func (f *frameBuilder) Reset(msgType byte) {
+	f.msgType = msgType
+	f.count = 0
+	f.buf = append(f.buf[:0], make([]byte, HeaderSize)...)
+	if msgType == TypeBetBatch {
+		f.buf = append(f.buf, make([]byte, BetBatchHeaderSize)...)
+	}
+}
+
+// Count Amount of items in the frame
+func (f *frameBuilder) Count() int {
+	return f.count
+}
+
+// Len Encoded size of the frame, header included
+func (f *frameBuilder) Len() int {
+	return len(f.buf)
+}
+
+// AppendString Adds a string to a TypeStringList frame
+func (f *frameBuilder) AppendString(value []byte) {
+	var size [StringListItemOverhead]byte
+	binary.BigEndian.PutUint32(size[:], uint32(len(value)))
+	f.buf = append(f.buf, size[:]...)
+	f.buf = append(f.buf, value...)
+	f.count++
+}
+
+// AppendBet Adds a bet to a TypeBetBatch frame
+func (f *frameBuilder) AppendBet(agency uint16, bet *betRecord) {
+	var record [BetRecordSize]byte
+	binary.BigEndian.PutUint16(record[0:2], agency)
+	binary.BigEndian.PutUint32(record[2:6], bet.Number)
+	binary.BigEndian.PutUint32(record[6:10], uint32(bet.Birthdate))
+	binary.BigEndian.PutUint16(record[10:12], uint16(len(bet.FirstName)))
+	binary.BigEndian.PutUint16(record[12:14], uint16(len(bet.LastName)))
+	binary.BigEndian.PutUint16(record[14:16], uint16(len(bet.Document)))
+	f.buf = append(f.buf, record[:]...)
+	f.buf = append(f.buf, bet.FirstName...)
+	f.buf = append(f.buf, bet.LastName...)
+	f.buf = append(f.buf, bet.Document...)
+	f.count++
+}
+
+// Bytes The encoded frame, with its header and record count filled in
+func (f *frameBuilder) Bytes() []byte {
+	f.buf[0] = f.msgType
+	binary.BigEndian.PutUint32(f.buf[1:HeaderSize], uint32(len(f.buf)-HeaderSize))
+	if f.msgType == TypeBetBatch {
+		binary.BigEndian.PutUint32(f.buf[HeaderSize:HeaderSize+BetBatchHeaderSize], uint32(f.count))
+	}
+	return f.buf
+}
+
+// frameCompressor Compresses batch frames into TypeCompressed frames,
+// reusing its output buffer and zlib writer from one frame to the next
+type frameCompressor struct {
+	buf    bytes.Buffer
+	writer *zlib.Writer
+}
+
+func newFrameCompressor(level int) (*frameCompressor, error) {
+	z := &frameCompressor{}
+	writer, err := zlib.NewWriterLevel(&z.buf, level)
+	if err != nil {
+		return nil, err
+	}
+	z.writer = writer
+	return z, nil
+}
+
+// Compress The frame compressed, or the frame itself if compressing it
+// does not make it smaller. Its bytes are valid until the next call.
+func (z *frameCompressor) Compress(frame []byte) []byte {
+	z.buf.Reset()
+	var header [HeaderSize + 1]byte
+	z.buf.Write(header[:])
+	z.writer.Reset(&z.buf)
+	if _, err := z.writer.Write(frame[HeaderSize:]); err != nil {
+		return frame
+	}
+	if err := z.writer.Close(); err != nil {
+		return frame
+	}
+	compressed := z.buf.Bytes()
+	if len(compressed) >= len(frame) {
+		return frame
+	}
+	compressed[0] = TypeCompressed
+	binary.BigEndian.PutUint32(compressed[1:HeaderSize], uint32(len(compressed)-HeaderSize))
+	compressed[HeaderSize] = frame[0]
+	return compressed
+}
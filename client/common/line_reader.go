@@ -0,0 +1,139 @@
+package common
+
+import (
+	"bufio"
+	"bytes"
+	"io"
+	"sync"
+)
+
+// readBufferSize Size of the buffered reader of the data file
+const readBufferSize = 1 << 20
+
+// readAheadChunkSize Amount of bytes of whole lines handed over at once
+const readAheadChunkSize = 64 * 1024
+
+// readAheadChunks Amount of chunks read ahead of the ones being sent
+const readAheadChunks = 4
+
+// chunkPool Chunks of lines, reused once their lines were encoded
+var chunkPool = sync.Pool{
+	New: func() interface{} {
+		chunk := make([]byte, 0, readAheadChunkSize+readAheadChunkSize/4)
+		return &chunk
+	},
+}
+
+// lineReader Reads a data file (or the lines starting in a byte range of
+// it) ahead of its consumer in a goroutine, so reading the disk overlaps
+// with sending batches through the network.
+// Lines are handed over in chunks of whole lines taken from chunkPool,
+// every line ending with '\n', and the consumer gives every chunk back
+// with Release once it is done with its lines.
+type lineReader struct {
+	chunks chan *[]byte
+	done   chan struct{}
+	err    error
+}
+
+// newLineReader Starts reading ahead the lines of `file` that start at
+// a byte in [start, end), so contiguous ranges split the file in parts
+// without cutting any line. The reader owns the file and closes it once
+// it is read or the reader is closed.
+func newLineReader(file io.ReadSeekCloser, start, end int64) *lineReader {
+	r := &lineReader{
+		chunks: make(chan *[]byte, readAheadChunks),
+		done:   make(chan struct{}),
+	}
+	go r.readAhead(file, start, end)
+	return r
+}
+
+func (r *lineReader) readAhead(file io.ReadSeekCloser, start, end int64) {
+	defer close(r.chunks)
+	defer file.Close()
+	reader := bufio.NewReaderSize(file, readBufferSize)
+	if start > 0 {
+		// The line that starts before `start` belongs to the previous part
+		if _, err := file.Seek(start-1, io.SeekStart); err != nil {
+			r.err = err
+			return
+		}
+		skipped, err := reader.ReadSlice('\n')
+		for err == bufio.ErrBufferFull {
+			start += int64(len(skipped))
+			skipped, err = reader.ReadSlice('\n')
+		}
+		if err != nil && err != io.EOF {
+			r.err = err
+			return
+		}
+		start += int64(len(skipped)) - 1
+		if start >= end {
+			return
+		}
+	}
+	position := start
+	chunk := chunkPool.Get().(*[]byte)
+	for {
+		line, err := reader.ReadSlice('\n')
+		position += int64(len(line))
+		*chunk = append(*chunk, line...)
+		if err == bufio.ErrBufferFull {
+			continue
+		}
+		if err != nil && err != io.EOF {
+			r.err = err
+			return
+		}
+		last := err == io.EOF || position >= end
+		if last && len(*chunk) > 0 && (*chunk)[len(*chunk)-1] != '\n' {
+			*chunk = append(*chunk, '\n')
+		}
+		if len(*chunk) >= readAheadChunkSize || (last && len(*chunk) > 0) {
+			select {
+			case r.chunks <- chunk:
+			case <-r.done:
+				return
+			}
+			chunk = chunkPool.Get().(*[]byte)
+		}
+		if last {
+			chunkPool.Put(chunk)
+			return
+		}
+	}
+}
+
+// Next Next chunk of lines. Returns io.EOF once the file was read.
+func (r *lineReader) Next() (*[]byte, error) {
+	chunk, ok := <-r.chunks
+	if !ok {
+		if r.err != nil {
+			return nil, r.err
+		}
+		return nil, io.EOF
+	}
+	return chunk, nil
+}
+
+// Release Gives a chunk back once its lines are no longer used
+func (r *lineReader) Release(chunk *[]byte) {
+	*chunk = (*chunk)[:0]
+	chunkPool.Put(chunk)
+}
+
+// Close Stops reading ahead, e.g. when the upload is interrupted
+func (r *lineReader) Close() {
+	close(r.done)
+}
+
+// nextLine Splits the first line off a chunk, without its line terminator
+func nextLine(chunk []byte) (line []byte, rest []byte) {
+	end := bytes.IndexByte(chunk, '\n')
+	line, rest = chunk[:end], chunk[end+1:]
+	if len(line) > 0 && line[len(line)-1] == '\r' {
+		line = line[:len(line)-1]
+	}
+	return line, rest
+}
@@ -38,7 +38,19 @@ func InitConfig() (*viper.Viper, error) {
 	v.BindEnv("loop", "amount")
 	v.BindEnv("log", "level")
 	v.BindEnv("batch", "maxAmount")
+	v.BindEnv("batch", "binary")
+	v.BindEnv("batch", "maxBytes")
+	v.BindEnv("batch", "minBytes")
+	v.BindEnv("batch", "adaptive")
+	v.BindEnv("batch", "ackWindow")
+	v.BindEnv("batch", "streams")
+	v.BindEnv("batch", "compression")
+	v.BindEnv("batch", "compressionMinBytes")
+	v.BindEnv("reconnect", "attempts")
+	v.BindEnv("reconnect", "period")
+	v.BindEnv("shutdown", "timeout")
 	v.BindEnv("results", "retryPeriod")
+	v.BindEnv("results", "wait")
 
 	// Try to read configuration from config file. If config file
 	// does not exists then ReadInConfig will fail but configuration
@@ -106,12 +118,24 @@ func main() {
 	PrintConfig(v)
 
 	clientConfig := common.ClientConfig{
-		ServerAddress:      v.GetString("server.address"),
-		ID:                 v.GetString("id"),
-		LoopAmount:         v.GetInt("loop.amount"),
-		LoopPeriod:         v.GetDuration("loop.period"),
-		MaxBatchSize:       v.GetInt("batch.maxAmount"),
-		ResultsRetryPeriod: v.GetDuration("results.retryPeriod"),
+		ServerAddress:       v.GetString("server.address"),
+		ID:                  v.GetString("id"),
+		LoopAmount:          v.GetInt("loop.amount"),
+		LoopPeriod:          v.GetDuration("loop.period"),
+		MaxBatchSize:        v.GetInt("batch.maxAmount"),
+		ResultsRetryPeriod:  v.GetDuration("results.retryPeriod"),
+		ResultsWait:         v.GetBool("results.wait"),
+		BinaryBatches:       v.GetBool("batch.binary"),
+		MaxBatchBytes:       v.GetInt("batch.maxBytes"),
+		MinBatchBytes:       v.GetInt("batch.minBytes"),
+		AdaptiveBatches:     v.GetBool("batch.adaptive"),
+		AckWindow:           v.GetInt("batch.ackWindow"),
+		MaxReconnects:       v.GetInt("reconnect.attempts"),
+		ReconnectPeriod:     v.GetDuration("reconnect.period"),
+		Streams:             v.GetInt("batch.streams"),
+		CompressionLevel:    v.GetInt("batch.compression"),
+		CompressionMinBytes: v.GetInt("batch.compressionMinBytes"),
+		ShutdownTimeout:     v.GetDuration("shutdown.timeout"),
 	}
 
 	client := common.NewClient(clientConfig)
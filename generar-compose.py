@@ -1,3 +1,19 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+""" Volumen compartido por las réplicas de clientes para repartirse los slots de agencias. """
+VOLUMEN_SLOTS = "client-slots"
+NOMBRES_SINTETICOS = ["Santiago Lionel", "Agustin Emanuel", "Tiago Nicolás", "María Sol", "Lucía", "Juan Pablo"]
+APELLIDOS_SINTETICOS = ["Lorca", "Zambrano", "Rivera", "Gómez", "Fernández", "Sosa"]
+
+
 def generar_compose(nombre_archivo, cantidad):
     with open(nombre_archivo, 'w') as archivo:
         archivo.write("name: tp0\n")
@@ -7,7 +23,34 @@ def generar_compose(nombre_archivo, cantidad):
             escribir_cliente(archivo, i)
         escribir_network(archivo)
 
-def escribir_servidor(archivo, numero):
+def generar_compose_flota(nombre_archivo, cantidad, por_contenedor, replicas, datos):
+    """
+    Compose para flotas grandes: cada contenedor de cliente simula
+    `por_contenedor` agencias (un proceso /client por agencia) y todos
+    montan el directorio de datos completo en vez de un archivo por
+    agencia. Con `replicas` los contenedores son réplicas de un único
+    servicio, que se reparten las agencias tomando un slot cada una.
+    """
+    contenedores = -(-cantidad // por_contenedor)
+    with open(nombre_archivo, 'w') as archivo:
+        archivo.write("name: tp0\n")
+        escribir_plantilla_cliente(archivo, datos, replicas)
+        archivo.write("services:\n")
+        escribir_servidor(archivo, cantidad, backlog=max(cantidad, 5))
+        if replicas:
+            escribir_cliente_replicado(archivo, cantidad, por_contenedor, contenedores)
+        else:
+            for i in range(contenedores):
+                primera = i * por_contenedor + 1
+                escribir_grupo_clientes(archivo, i + 1, primera, min(primera + por_contenedor - 1, cantidad))
+        escribir_network(archivo)
+        if replicas:
+            archivo.write(
+                "volumes:\n"
+                f"  {VOLUMEN_SLOTS}:\n"
+            )
+
+def escribir_servidor(archivo, numero, backlog=None):
     archivo.write(
         "  server:\n"
         "    container_name: server\n"
@@ -16,6 +59,10 @@ def escribir_servidor(archivo, numero):
         "    environment:\n"
         "      - PYTHONUNBUFFERED=1\n"
         f"      - TOTAL_AGENCIES={numero}\n"
+    )
+    if backlog is not None:
+        archivo.write(f"      - SERVER_LISTEN_BACKLOG={backlog}\n")
+    archivo.write(
         "    networks:\n"
         "      - testing_net\n"
         "    volumes:\n"
@@ -43,7 +90,64 @@ def escribir_cliente(archivo, numero):
         f"      - ./client/config.yaml:/config.yaml\n"
         f"      - ./.data/agency-{numero}.csv:/data/agency-{numero}.csv\n"
     )
-    
+
+def escribir_plantilla_cliente(archivo, datos, replicas):
+    """ Configuración común a todos los contenedores de clientes, reutilizada con un ancla de YAML. """
+    archivo.write(
+        "x-client: &client\n"
+        "  image: client:latest\n"
+        "  networks:\n"
+        "    - testing_net\n"
+        "  depends_on:\n"
+        "    - server\n"
+        "  volumes:\n"
+        "    - ./client/config.yaml:/config.yaml\n"
+        f"    - {datos}:/data:ro\n"
+    )
+    if replicas:
+        archivo.write(f"    - {VOLUMEN_SLOTS}:/slots\n")
+
+def comando_clientes(primera, ultima):
+    """
+    Script de sh que lanza un cliente por cada agencia entre `primera` y
+    `ultima` (expresiones de sh), espera a todos y falla si alguno falla.
+    Los `$` van duplicados para que docker compose no los interpole.
+    """
+    return (
+        f"pids=''; for id in $$(seq {primera} {ultima}); do CLI_ID=$$id /client & pids=\"$$pids $$!\"; done; "
+        "estado=0; for pid in $$pids; do wait $$pid || estado=1; done; exit $$estado"
+    )
+
+def escribir_grupo_clientes(archivo, numero, primera, ultima):
+    archivo.write(
+        f"  client{numero}:\n"
+        f"    <<: *client\n"
+        f"    container_name: client{numero}\n"
+        f"    entrypoint: {json.dumps(['/bin/sh', '-c', comando_clientes(primera, ultima)], ensure_ascii=False)}\n"
+    )
+
+def escribir_cliente_replicado(archivo, cantidad, por_contenedor, replicas):
+    """
+    Las réplicas de un servicio no pueden recibir variables de entorno
+    distintas, así que cada una toma el primer slot libre creando su
+    directorio en un volumen compartido (mkdir es atómico) y simula las
+    agencias de ese slot.
+    """
+    script = (
+        f"slot=0; while ! mkdir /slots/$$slot 2>/dev/null; do slot=$$((slot + 1)); "
+        f"if [ $$slot -ge {replicas} ]; then echo \"sin slots libres en {VOLUMEN_SLOTS}\" >&2; exit 1; fi; done; "
+        f"primera=$$((slot * {por_contenedor} + 1)); ultima=$$((primera + {por_contenedor - 1})); "
+        f"if [ $$ultima -gt {cantidad} ]; then ultima={cantidad}; fi; "
+        + comando_clientes("$$primera", "$$ultima")
+    )
+    archivo.write(
+        "  client:\n"
+        "    <<: *client\n"
+        f"    entrypoint: {json.dumps(['/bin/sh', '-c', script], ensure_ascii=False)}\n"
+        "    deploy:\n"
+        f"      replicas: {replicas}\n"
+    )
+
 def escribir_network(archivo):
     archivo.write(
         "networks:\n"
@@ -53,20 +157,136 @@ def escribir_network(archivo):
         "      config:\n"
         "        - subnet: 172.25.125.0/24\n"
     )
-    
-if __name__ == "__main__":
-    import sys
-    if len(sys.argv) != 3:
-        print("Uso: python3 generar-compose.py <nombre_archivo> <cantidad_clientes>")
-        sys.exit(1)
-    
-    nombre_archivo = sys.argv[1]
+
+def generar_apuestas(datos, cantidad, apuestas, sesgo, semilla):
+    """
+    Escribe `agency-<n>.csv` sintéticos para las `cantidad` agencias, con
+    `apuestas` filas por agencia en promedio. Con `sesgo` > 0 las filas
+    se reparten según una ley de Zipf (la agencia n recibe una parte
+    proporcional a 1/n^sesgo), como el dataset, donde pocas agencias
+    concentran la mayoría de las apuestas.
+    """
+    os.makedirs(datos, exist_ok=True)
+    pesos = [1 / n ** sesgo for n in range(1, cantidad + 1)]
+    total_pesos = sum(pesos)
+    rng = random.Random(semilla)
+    for agencia, peso in enumerate(pesos, start=1):
+        filas = max(1, round(apuestas * cantidad * peso / total_pesos))
+        with open(os.path.join(datos, f"agency-{agencia}.csv"), 'w', encoding='utf-8') as archivo:
+            archivo.writelines(
+                f"{rng.choice(NOMBRES_SINTETICOS)},{rng.choice(APELLIDOS_SINTETICOS)},"
+                f"{rng.randrange(10000000, 99999999)},"
+                f"{rng.randrange(1940, 2005)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d},"
+                f"{rng.randrange(10000)}\n"
+                for _ in range(filas)
+            )
+
+def agencias_sin_datos(datos, cantidad):
+    return [n for n in range(1, cantidad + 1) if not os.path.isfile(os.path.join(datos, f"agency-{n}.csv"))]
+
+def esperar_servidor(log, servidor, timeout=10):
+    """
+    Espera a que el servidor empiece a aceptar conexiones, según su log,
+    sin conectarse (una conexión vacía se registraría como un error).
+    """
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite and servidor.poll() is None:
+        with open(log) as archivo:
+            if "action: accept_connections | result: in_progress" in archivo.read():
+                return True
+        time.sleep(0.1)
+    return False
+
+def ejecutar_local(directorio, cantidad, datos, cliente, puerto):
+    """
+    Corre la flota sin docker: el servidor (server/main.py) y un proceso
+    del cliente por agencia, todos con `directorio` como directorio de
+    trabajo (donde quedan las apuestas y los logs). Al terminar todos
+    los clientes apaga el servidor con SIGTERM. Devuelve la cantidad de
+    clientes que fallaron.
+    """
+    raiz = os.path.dirname(os.path.abspath(__file__))
+    logs = os.path.join(directorio, "logs")
+    os.makedirs(logs, exist_ok=True)
+    shutil.copy(os.path.join(raiz, "server", "config.ini"), directorio)
+    shutil.copy(os.path.join(raiz, "client", "config.yaml"), directorio)
+    enlace_datos = os.path.join(directorio, "data")
+    if os.path.islink(enlace_datos):
+        os.remove(enlace_datos)
+    os.symlink(os.path.abspath(datos), enlace_datos)
+
+    entorno_servidor = dict(os.environ, PYTHONUNBUFFERED="1", LOGGING_LEVEL="INFO", TOTAL_AGENCIES=str(cantidad),
+                            SERVER_PORT=str(puerto), SERVER_LISTEN_BACKLOG=str(max(cantidad, 5)))
+    inicio = time.monotonic()
+    with open(os.path.join(logs, "server.log"), 'w') as log_servidor:
+        servidor = subprocess.Popen([sys.executable, os.path.join(raiz, "server", "main.py")], cwd=directorio,
+                                    env=entorno_servidor, stdout=log_servidor, stderr=subprocess.STDOUT)
     try:
-        cantidad = int(sys.argv[2])
-        if cantidad < 0:
-            raise ValueError
-    except ValueError:
-        print("La cantidad de clientes debe ser un entero positivo.")
-        sys.exit(1)
-    
-    generar_compose(nombre_archivo, cantidad)
\ No newline at end of file
+        if not esperar_servidor(os.path.join(logs, "server.log"), servidor):
+            print(f"El servidor no empezó a aceptar conexiones, ver {logs}/server.log")
+            return cantidad
+        clientes = []
+        for agencia in range(1, cantidad + 1):
+            entorno = dict(os.environ, CLI_ID=str(agencia), CLI_SERVER_ADDRESS=f"127.0.0.1:{puerto}")
+            with open(os.path.join(logs, f"client{agencia}.log"), 'w') as log_cliente:
+                clientes.append(subprocess.Popen([os.path.abspath(cliente)], cwd=directorio, env=entorno,
+                                                 stdout=log_cliente, stderr=subprocess.STDOUT))
+        fallidos = [agencia for agencia, proceso in enumerate(clientes, start=1) if proceso.wait() != 0]
+    finally:
+        servidor.send_signal(signal.SIGTERM)
+        servidor.wait()
+    print(f"{cantidad} clientes terminaron en {time.monotonic() - inicio:.1f}s, "
+          f"{len(fallidos)} con error{': ' + str(fallidos) if fallidos else ''}. Logs en {logs}")
+    return len(fallidos)
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description="Genera el docker compose (o corre localmente) un servidor y una flota de clientes")
+    parser.add_argument("nombre_archivo", help="compose a generar (con --local, el directorio de trabajo)")
+    parser.add_argument("cantidad_clientes", type=int, help="cantidad de agencias")
+    parser.add_argument("--agencias-por-contenedor", type=int, default=1,
+                        help="agencias que simula cada contenedor de cliente")
+    parser.add_argument("--replicas", action="store_true",
+                        help="clientes como réplicas de un único servicio en lugar de un servicio por contenedor")
+    parser.add_argument("--datos", default="./.data", help="directorio con los archivos agency-<n>.csv")
+    parser.add_argument("--generar-apuestas", type=int, default=0, metavar="N",
+                        help="generar archivos sintéticos con N apuestas por agencia en promedio")
+    parser.add_argument("--sesgo", type=float, default=0.0,
+                        help="exponente de Zipf del reparto de apuestas entre agencias (0 es uniforme)")
+    parser.add_argument("--semilla", type=int, default=0, help="semilla de los datos sintéticos")
+    parser.add_argument("--forzar", action="store_true",
+                        help="con --generar-apuestas, sobrescribir los archivos de agencias que ya existan")
+    parser.add_argument("--local", action="store_true", help="correr servidor y clientes como procesos, sin docker")
+    parser.add_argument("--cliente", default="./bin/client", help="binario del cliente para --local (make build)")
+    parser.add_argument("--puerto", type=int, default=12345, help="puerto del servidor para --local")
+    args = parser.parse_args()
+    if args.cantidad_clientes < 0:
+        parser.error("La cantidad de clientes debe ser un entero positivo.")
+    if args.agencias_por_contenedor < 1:
+        parser.error("La cantidad de agencias por contenedor debe ser un entero positivo.")
+    if args.generar_apuestas < 0 or args.sesgo < 0:
+        parser.error("La cantidad de apuestas y el sesgo no pueden ser negativos.")
+    return args
+
+if __name__ == "__main__":
+    args = get_args()
+    cantidad = args.cantidad_clientes
+
+    if args.generar_apuestas > 0:
+        existentes = cantidad - len(agencias_sin_datos(args.datos, cantidad))
+        if existentes and not args.forzar:
+            print(f"Ya existen {existentes} archivos de agencias en {args.datos} que --generar-apuestas "
+                  f"sobrescribiría; usar otro --datos o agregar --forzar")
+            sys.exit(1)
+        generar_apuestas(args.datos, cantidad, args.generar_apuestas, args.sesgo, args.semilla)
+    faltantes = agencias_sin_datos(args.datos, cantidad)
+    if faltantes:
+        print(f"Atención: faltan los archivos de {len(faltantes)} agencias en {args.datos} (la primera es "
+              f"agency-{faltantes[0]}.csv); se pueden generar con --generar-apuestas")
+
+    if args.local:
+        sys.exit(1 if ejecutar_local(args.nombre_archivo, cantidad, args.datos, args.cliente, args.puerto) else 0)
+    if args.agencias_por_contenedor == 1 and not args.replicas and args.datos == "./.data":
+        generar_compose(args.nombre_archivo, cantidad)
+    else:
+        generar_compose_flota(args.nombre_archivo, cantidad, args.agencias_por_contenedor, args.replicas, args.datos)
@@ -1,2 +1,2 @@
 #!/bin/bash
-python3 generar-compose.py $1 $2
\ No newline at end of file
+python3 generar-compose.py "$@"
\ No newline at end of file
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Localhost benchmark for the bets server
+
+Starts the server on an ephemeral port and simulates agencies that
+replay the same flow as the client (LOAD_BATCHES, batches, END,
+ALL_BETS_SENT, RESULTS_REQUEST), one process per agency. Every
+combination of the given agency counts and batch sizes is run against
+a fresh server, and the results are printed as JSON:
+
+- bets_per_sec: bets stored per second, from the first LOAD_BATCHES until
+  the last upload was acknowledged (until the draw without ACKs, since
+  only then all the bets are known to be stored).
+- batch_latency_ms: p50/p99 of the time between sending a batch and
+  receiving its ACK (only when the ACK window is enabled).
+- time_to_draw_s: from the first LOAD_BATCHES until every agency got
+  its winners.
+- peak_rss_kb: peak resident memory of the server (all its processes).
+- compression_ratio: bytes of the batches over the bytes sent, and
+  compress_s, the time the agencies spent compressing them (before the
+  upload, so it is not part of bets_per_sec), with --compression.
+
+The storage settings (format, journal and bets index) default to the
+ones of config.ini, so the numbers are those of the server as shipped.
+
+Usage: python benchmark.py --agencies 5,10 --batch-sizes 100,500
+"""
+
+import argparse
+import collections
+import configparser
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import signal
+import socket
+import tempfile
+import threading
+import time
+import zipfile
+
+from common.async_server import AsyncServer
+from common.bet_log import BET_LOG_FILEPATH
+from common.bet_writer import FORMAT_BINARY, STORAGE_FORMATS
+from common.communication import ProtocolMessage
+from common.server import (MSG_ACK, MSG_END, MSG_LOAD_OK, MSG_LOTERY_IN_PROGRESS, OPT_ACK, OPT_BET_BATCH, OPT_WAIT,
+                           OPT_ZLIB, Server)
+from common.sharded_server import ShardedServer
+from common.utils import EPOCH_ORDINAL, STORAGE_FILEPATH, BetBatch
+
+SERVER_MODES = {
+    "threads": Server,
+    "async": AsyncServer,
+}
+DEFAULT_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.data', 'dataset.zip')
+CONFIG_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+DATASET_AGENCIES = 5
+""" Short, so the agencies waiting for the draw don't hit the socket timeout. """
+RESULTS_WAIT_TIMEOUT = 1.0
+SYNTHETIC_FIRST_NAMES = ["Valentina", "Santiago", "Martina", "Mateo", "Sofía", "Benjamín"]
+SYNTHETIC_LAST_NAMES = ["Vera", "Álvarez", "Borges", "Gómez", "Fernández", "Pérez"]
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def server_config(filepath=CONFIG_FILEPATH):
+    """ Settings of config.ini, the server runs with by default """
+    config = configparser.ConfigParser()
+    config.read(filepath)
+    return config["DEFAULT"]
+
+
+def get_args(argv=None):
+    config = server_config()
+    parser = argparse.ArgumentParser(description="Benchmark the bets server on localhost")
+    parser.add_argument("--agencies", type=parse_list, default=[5], help="comma separated agency counts")
+    parser.add_argument("--batch-sizes", type=parse_list, default=[100], help="comma separated bets per batch")
+    parser.add_argument("--bets-per-agency", type=int, default=0,
+                        help="use this many synthetic bets per agency instead of the dataset")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="zip with agency-<n>.csv files")
+    parser.add_argument("--mode", choices=SERVER_MODES, default="threads")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--window", type=int, default=32, help="batches sent ahead of ACKs (0 disables ACKs)")
+    parser.add_argument("--storage-format", choices=STORAGE_FORMATS,
+                        default=config.get("STORAGE_FORMAT", FORMAT_BINARY), help="default: STORAGE_FORMAT of config.ini")
+    parser.add_argument("--journal", action=argparse.BooleanOptionalAction,
+                        default=config.getboolean("STORAGE_JOURNAL", False),
+                        help="keep the checkpoint journal (default: STORAGE_JOURNAL of config.ini)")
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction,
+                        default=config.getboolean("STORAGE_DEDUP", False),
+                        help="drop duplicated bets with the bets index (default: STORAGE_DEDUP of config.ini)")
+    parser.add_argument("--parser-processes", type=int, default=0, help="processes parsing the batches")
+    parser.add_argument("--binary", action="store_true", help="send BET_BATCH messages")
+    parser.add_argument("--compression", type=int, default=0, help="zlib level of the batches (0 disables it)")
+    parser.add_argument("--compression-min-bytes", type=int, default=1024,
+                        help="batches smaller than this are sent uncompressed")
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def load_agency_lines(args, agency):
+    """ Data lines (first_name,last_name,document,birthdate,number) of an agency """
+    if args.bets_per_agency > 0:
+        rng = random.Random(agency)
+        return [
+            f"{rng.choice(SYNTHETIC_FIRST_NAMES)},{rng.choice(SYNTHETIC_LAST_NAMES)},"
+            f"{rng.randrange(10000000, 99999999)},"
+            f"{rng.randrange(1940, 2005)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d},"
+            f"{rng.randrange(10000)}"
+            for _ in range(args.bets_per_agency)
+        ]
+    # Agencies beyond the ones in the dataset reuse its files
+    name = f"agency-{(agency - 1) % DATASET_AGENCIES + 1}.csv"
+    with zipfile.ZipFile(args.dataset) as dataset:
+        with io.TextIOWrapper(dataset.open(name), encoding='utf-8') as file:
+            return file.read().splitlines()
+
+
+def encode_batches(args, agency, batch_size):
+    lines = load_agency_lines(args, agency)
+    frames = []
+    for i in range(0, len(lines), batch_size):
+        chunk = lines[i:i + batch_size]
+        if args.binary:
+            batch = BetBatch.from_strings(str(agency), chunk)
+            frames.append(ProtocolMessage.encode_bet_batch([
+                (bet.agency, bet.first_name, bet.last_name, bet.document,
+                 bet.birthdate.toordinal() - EPOCH_ORDINAL, bet.number)
+                for bet in batch
+            ]))
+        else:
+            frames.append(ProtocolMessage.encode_string_list(chunk))
+    return len(lines), frames
+
+
+def compress_frames(args, frames):
+    """ Frames big enough compressed with --compression. Returns them and the seconds it took. """
+    started = time.perf_counter()
+    frames = [
+        ProtocolMessage.encode_compressed(frame, args.compression)
+        if len(frame) >= args.compression_min_bytes else frame
+        for frame in frames
+    ]
+    return frames, time.perf_counter() - started
+
+
+def run_agency(args, agency, batch_size, port, barrier, results):
+    """ Simulated client of one agency. Reports its timings through `results`. """
+    total_bets, frames = encode_batches(args, agency, batch_size)
+    raw_bytes = sum(map(len, frames))
+    compress_seconds = 0.0
+    if args.compression:
+        frames, compress_seconds = compress_frames(args, frames)
+    options = (([OPT_BET_BATCH] if args.binary else []) + ([OPT_ACK] if args.window > 0 else [])
+               + ([OPT_ZLIB] if args.compression else []))
+    barrier.wait()
+
+    sock = socket.create_connection(('127.0.0.1', port))
+    started = time.monotonic()
+    ProtocolMessage.send_string_to_sock(sock, ','.join(["LOAD_BATCHES", str(agency)] + options))
+    if options:
+        reply = ProtocolMessage.new_from_sock(sock).split(',')
+        if reply[0] != MSG_LOAD_OK or any(option not in reply for option in options):
+            raise ValueError(f"options not accepted: {reply}")
+
+    latencies = []
+    in_flight = collections.deque()
+    next_seq = 0
+
+    def receive_ack():
+        nonlocal next_seq
+        reply, seq = ProtocolMessage.new_from_sock(sock).split(',')
+        if reply != MSG_ACK:
+            raise ValueError(f"unexpected reply: {reply}")
+        received = time.monotonic()
+        while next_seq <= int(seq):
+            latencies.append(received - in_flight.popleft())
+            next_seq += 1
+
+    for frame in frames:
+        if args.window > 0 and len(in_flight) >= args.window:
+            receive_ack()
+        in_flight.append(time.monotonic())
+        sock.sendall(frame)
+    if args.window > 0:
+        while in_flight:
+            receive_ack()
+    ProtocolMessage.send_string_to_sock(sock, MSG_END)
+    uploaded = time.monotonic()
+
+    ProtocolMessage.send_string_to_sock(sock, f"ALL_BETS_SENT,{agency}")
+    winners = MSG_LOTERY_IN_PROGRESS
+    while winners == MSG_LOTERY_IN_PROGRESS:
+        ProtocolMessage.send_string_to_sock(sock, f"RESULTS_REQUEST,{agency},{OPT_WAIT}")
+        winners = ProtocolMessage.new_from_sock(sock)
+    drawn = time.monotonic()
+    ProtocolMessage.send_string_to_sock(sock, MSG_END)
+    sock.close()
+
+    results.put({
+        "agency": agency,
+        "bets": total_bets,
+        "started": started,
+        "uploaded": uploaded,
+        "drawn": drawn,
+        "winners": len(winners),
+        "latencies": latencies,
+        "raw_bytes": raw_bytes,
+        "wire_bytes": sum(map(len, frames)),
+        "compress_s": compress_seconds,
+    })
+
+
+def peak_rss_kb():
+    """ Peak resident memory of this process and its children (e.g. shards) """
+    pids = [os.getpid()] + [child.pid for child in multiprocessing.active_children()]
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                total += next(int(line.split()[1]) for line in status if line.startswith("VmHWM:"))
+        except (OSError, StopIteration):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return total
+
+
+def serve(args, total_agencies, workdir, conn):
+    """ Server process of a run. Sends its port, and its peak RSS when asked to stop. """
+    logging.basicConfig(level=logging.WARNING)
+    os.chdir(workdir)
+    options = {
+        "results_wait_timeout": RESULTS_WAIT_TIMEOUT,
+        "parser_processes": args.parser_processes,
+        "storage_format": args.storage_format,
+        "journal": args.journal,
+        "dedup": args.dedup,
+        "storage_filepath": BET_LOG_FILEPATH if args.storage_format == FORMAT_BINARY else STORAGE_FILEPATH,
+    }
+    if args.shards > 1:
+        server = ShardedServer(SERVER_MODES[args.mode], args.shards, 0, total_agencies, total_agencies, **options)
+    else:
+        server = SERVER_MODES[args.mode](0, total_agencies, total_agencies, **options)
+    conn.send(server._server_socket.getsockname()[1])
+
+    def stop_when_asked():
+        conn.recv()
+        conn.send(peak_rss_kb())
+        # Stopped the same way as in production, from the main thread
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=stop_when_asked, daemon=True).start()
+    server.run()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[round(q * (len(values) - 1))]
+
+
+def run(args, total_agencies, batch_size):
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        conn, server_conn = ctx.Pipe()
+        server = ctx.Process(target=serve, args=(args, total_agencies, workdir, server_conn))
+        server.start()
+        port = conn.recv()
+
+        barrier = ctx.Barrier(total_agencies)
+        results = ctx.Queue()
+        agencies = [
+            ctx.Process(target=run_agency, args=(args, agency, batch_size, port, barrier, results))
+            for agency in range(1, total_agencies + 1)
+        ]
+        for agency in agencies:
+            agency.start()
+        reports = []
+        while len(reports) < total_agencies:
+            try:
+                reports.append(results.get(timeout=1))
+            except queue.Empty:
+                if any(agency.exitcode for agency in agencies):
+                    server.terminate()
+                    raise RuntimeError("a simulated agency failed")
+        for agency in agencies:
+            agency.join()
+
+        conn.send(None)
+        rss = conn.recv()
+        server.join()
+
+    latencies = [latency for report in reports for latency in report["latencies"]]
+    started = min(report["started"] for report in reports)
+    stored = "uploaded" if args.window > 0 else "drawn"
+    ingest_seconds = max(report[stored] for report in reports) - started
+    total_bets = sum(report["bets"] for report in reports)
+    wire_bytes = sum(report["wire_bytes"] for report in reports)
+    return {
+        "agencies": total_agencies,
+        "batch_size": batch_size,
+        "bets": total_bets,
+        "ingest_s": round(ingest_seconds, 4),
+        "bets_per_sec": round(total_bets / ingest_seconds, 1),
+        "batch_latency_ms": {
+            "p50": None if not latencies else round(percentile(latencies, 0.5) * 1000, 3),
+            "p99": None if not latencies else round(percentile(latencies, 0.99) * 1000, 3),
+        },
+        "time_to_draw_s": round(max(report["drawn"] for report in reports) - started, 4),
+        "winners": sum(report["winners"] for report in reports),
+        "peak_rss_kb": rss,
+        "wire_bytes": wire_bytes,
+        "compression_ratio": round(sum(report["raw_bytes"] for report in reports) / wire_bytes, 3),
+        "compress_s": round(sum(report["compress_s"] for report in reports), 4),
+    }
+
+
+def main():
+    args = get_args()
+    runs = [
+        run(args, total_agencies, batch_size)
+        for total_agencies in args.agencies
+        for batch_size in args.batch_sizes
+    ]
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {
+            "mode": args.mode,
+            "shards": args.shards,
+            "window": args.window,
+            "parser_processes": args.parser_processes,
+            "storage_format": args.storage_format,
+            "journal": args.journal,
+            "dedup": args.dedup,
+            "binary": args.binary,
+            "compression": args.compression,
+            "data": f"synthetic:{args.bets_per_agency}" if args.bets_per_agency > 0 else "dataset",
+        },
+        "runs": runs,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
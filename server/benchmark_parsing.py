@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the per-bet CPU cost of the ingest path
+
+Times, in microseconds per bet (best of --repeat runs over the same
+batches), each way the server has of doing the two per-bet stages of
+the ingest of STRING_LIST batches:
+
+- parse: BetBatch.from_string_list (the server's path), appending every
+  line with BetBatch.append_line, and building a Bet per line with
+  Bet.from_string (the original path).
+- csv: BetBatch.csv_text (the server's path), csv.writer over
+  BetBatch.rows(), and csv.writer over the Bet objects (like store_bets).
+
+Usage: python benchmark_parsing.py --batch-size 100
+"""
+
+import argparse
+import csv
+import io
+import json
+import platform
+import time
+
+from benchmark import DEFAULT_DATASET, load_agency_lines
+from common.communication import HEADER_SIZE, ProtocolMessage, iter_string_list
+from common.utils import Bet, BetBatch
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Microbenchmark the per-bet cost of parsing and storing bets")
+    parser.add_argument("--agency", type=int, default=1, help="agency of the dataset whose bets are used")
+    parser.add_argument("--batch-size", type=int, default=100, help="bets per batch")
+    parser.add_argument("--bets-per-agency", type=int, default=0,
+                        help="use this many synthetic bets instead of the dataset")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET, help="zip with agency-<n>.csv files")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every path, the best one is reported")
+    return parser.parse_args()
+
+
+def parse_appending_lines(agency, body):
+    batch = BetBatch()
+    data = bytes(body)
+    for start, end in iter_string_list(data):
+        batch.append_line(int(agency), data, start, end)
+    return batch
+
+
+def parse_bets(agency, body):
+    data = bytes(body)
+    return [Bet.from_string(agency, data[start:end].decode('utf-8')) for start, end in iter_string_list(data)]
+
+
+def csv_writer_rows(batch):
+    buffer = io.StringIO()
+    csv.writer(buffer, quoting=csv.QUOTE_MINIMAL).writerows(batch.rows())
+    return buffer.getvalue()
+
+
+def csv_writer_bets(bets):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_MINIMAL)
+    for bet in bets:
+        writer.writerow([bet.agency, bet.first_name, bet.last_name, bet.document, bet.birthdate, bet.number])
+    return buffer.getvalue()
+
+
+def us_per_bet(function, inputs, bets, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in inputs:
+            function(item)
+        best = min(best, time.perf_counter() - started)
+    return round(best / bets * 1e6, 3)
+
+
+def main():
+    args = get_args()
+    agency = str(args.agency)
+    lines = load_agency_lines(args, args.agency)
+    bodies = [ProtocolMessage.encode_string_list(lines[i:i + args.batch_size])[HEADER_SIZE:]
+              for i in range(0, len(lines), args.batch_size)]
+    batches = [BetBatch.from_string_list(agency, body) for body in bodies]
+    bets = [parse_bets(agency, body) for body in bodies]
+    if "".join(map(BetBatch.csv_text, batches)) != "".join(map(csv_writer_bets, bets)):
+        raise SystemExit("csv_text does not match the rows of csv.writer")
+
+    repeat = args.repeat
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "bets": len(lines),
+        "batch_size": args.batch_size,
+        "us_per_bet": {
+            "parse": {
+                "from_string_list": us_per_bet(lambda body: BetBatch.from_string_list(agency, body),
+                                               bodies, len(lines), repeat),
+                "append_line": us_per_bet(lambda body: parse_appending_lines(agency, body), bodies, len(lines), repeat),
+                "bet_from_string": us_per_bet(lambda body: parse_bets(agency, body), bodies, len(lines), repeat),
+            },
+            "csv": {
+                "csv_text": us_per_bet(BetBatch.csv_text, batches, len(lines), repeat),
+                "csv_writer_rows": us_per_bet(csv_writer_rows, batches, len(lines), repeat),
+                "csv_writer_bets": us_per_bet(csv_writer_bets, bets, len(lines), repeat),
+            },
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import asyncio
+import functools
+import logging
+import socket
+
+from .communication import ProtocolMessage
+from .batch_parser import BATCH_PARSERS, parse_batch
+from .server import DISCARD_READ_SIZE, MSG_ACK, MSG_END, MSG_SERVER_DRAINING, OPT_ACK, OPT_WAIT, Server, upload_key
+
+ASYNC_REQUEST_HANDLERS = {
+    "LOAD_BATCHES": lambda server, agency, options, reader, writer: server._load_batches_request_async(agency, options, reader, writer),
+    "ALL_BETS_SENT": lambda server, agency, options, reader, writer: server._agency_done_submitting_async(agency),
+    "RESULTS_REQUEST": lambda server, agency, options, reader, writer: server._send_results_to_async(agency, options, writer),
+}
+
+class AsyncServer(Server):
+    """
+    Event loop based alternative to Server
+
+    Instead of handing every request to a worker of the thread pool,
+    all the client connections are served from a single asyncio event
+    loop over non-blocking sockets. An idle or slow agency only costs
+    a suspended coroutine, so the amount of concurrent clients is not
+    bounded by the amount of worker threads.
+
+    The protocol and the semantics of every request are the same as
+    in Server.
+    """
+
+    _loop = None
+
+    def _create_thread_pool(self, max_workers, max_queue, policy):
+        return None
+
+    def run(self):
+        """
+        Server loop
+
+        Accepts connections and serves them from the event loop until
+        the server is stopped
+        """
+        self.running = True
+        asyncio.run(self.__serve())
+
+    async def __serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._lottery_done_async = asyncio.Event()
+        if self._lottery_completed:
+            self._lottery_done_async.set()
+        self._client_writers = set()
+
+        if isinstance(self._server_socket, socket.socket):
+            self._server_socket.setblocking(False)
+            server = await asyncio.start_server(self.__handle_client_connection, sock=self._server_socket)
+            self._stop_accepting = server.close
+        else:
+            # Connections are handed over by another process (see ShardedServer)
+            self._loop.run_in_executor(None, self.__accept_handed_over_connections)
+            self._stop_accepting = self._server_socket.close
+        logging.info('action: accept_connections | result: in_progress')
+
+        await self._stopped.wait()
+
+        self._stop_accepting()
+        logging.info("action: server_socket_closed | result: success")
+        for writer in self._client_writers:
+            writer.close()
+        self._client_writers.clear()
+        logging.info("action: client_sockets_closed | result: success")
+        self._stop_parser_pool()
+        self._close_storage()
+        self._stop_metrics()
+
+    def stop(self):
+        """
+        Stop the server
+
+        Wakes up the event loop so it closes the server socket and
+        every client connection. Safe to call from a signal handler.
+        """
+        self.running = False
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def drain(self):
+        """
+        Stop the server gracefully, as Server.drain does
+
+        Safe to call from a signal handler: the drain runs in the event
+        loop, which keeps serving the uploads until they finish.
+        """
+        if self._draining.is_set():
+            return
+        self._draining.set()
+        if self._drain_timeout <= 0 or self._loop is None:
+            self.stop()
+            return
+        self._loop.call_soon_threadsafe(self._loop.create_task, self.__drain())
+
+    async def __drain(self):
+        logging.info(f"action: drain | result: in_progress | timeout: {self._drain_timeout}")
+        self.running = False
+        self._stop_accepting()
+        self._lottery_done_async.set()
+        loads = [done.wait() for loads in list(self._done_writting_data_for_agency.values()) for done in loads]
+        try:
+            await asyncio.wait_for(asyncio.gather(*loads), self._drain_timeout)
+            logging.info("action: drain | result: success")
+        except asyncio.TimeoutError:
+            logging.warning("action: drain | result: fail | error: timeout, closing the remaining uploads")
+        self._stopped.set()
+
+    def __accept_handed_over_connections(self):
+        """
+        Blocking accept loop for a server socket that is not a real
+        listening socket, run in an executor thread. Every connection
+        is served from the event loop.
+        """
+        while self.running:
+            try:
+                sock, _addr = self._server_socket.accept()
+            except OSError as e:
+                if self.running:
+                    logging.error(f"action: accept_connections | result: fail | error: {e}")
+                continue
+            asyncio.run_coroutine_threadsafe(self.__serve_handed_over_connection(sock), self._loop)
+
+    async def __serve_handed_over_connection(self, sock: socket.socket):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.__handle_client_connection(reader, writer)
+
+    async def __handle_client_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serve every request sent through a client connection until the
+        client sends END or a problem arises, then close the connection
+        """
+        addr = writer.get_extra_info('peername')
+        logging.info(f'action: accept_connections | result: success | ip: {addr[0]}')
+        self._client_writers.add(writer)
+        try:
+            while self.running:
+                msg = await ProtocolMessage.new_from_stream(reader)
+                if type(msg) is not str:
+                    raise ValueError("Invalid message type received for request")
+                if msg == MSG_END:
+                    break
+
+                request, agency, *options = msg.split(',')
+
+                if ASYNC_REQUEST_HANDLERS.get(request) is None:
+                    raise ValueError(f"Unknown request type: {request}")
+
+                await ASYNC_REQUEST_HANDLERS[request](self, agency, options, reader, writer)
+
+        except Exception as e:
+            if self.running:
+                logging.error(f"action: receive_message | result: fail | error: {e}")
+        finally:
+            self._client_writers.discard(writer)
+            writer.close()
+
+    async def _load_batches_request_async(self, agency: str, options: list[str],
+                                          reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handle LOAD_BATCHES request from client
+
+        Same as Server._load_batches_request. Every batch is parsed and
+        handed to the bets writer (which blocks while the writer falls
+        behind) in an executor thread, or in the parser processes if
+        there are, so the event loop only reads frames and sends replies.
+        """
+        if self._draining.is_set():
+            if options:
+                writer.write(ProtocolMessage.encode_string(MSG_SERVER_DRAINING))
+                await writer.drain()
+            return
+        total_bets = 0
+        upload = upload_key(agency, options)
+        on_failed = functools.partial(self.__fail_load, writer)
+        parsing = self._new_parsed_batches(agency, upload, on_failed)
+        done = asyncio.Event()
+        previous_loads = self._register_load(agency, upload, done)
+        ack = OPT_ACK in options and OPT_ACK in self._load_batches_options
+        drained = False
+        try:
+            if options:
+                if ack:
+                    for e in previous_loads:
+                        await e.wait()
+                writer.write(self._load_batches_reply(upload, options))
+                await writer.drain()
+            self._bet_writer.reset(upload)
+
+            seq = 0
+            while not self._draining.is_set():
+                msg_type, body = await ProtocolMessage.frame_from_stream(reader)
+                if msg_type not in BATCH_PARSERS:
+                    if ProtocolMessage.decode(msg_type, body) == MSG_END:
+                        if parsing is not None:
+                            total_bets = await self._loop.run_in_executor(None, parsing.wait)
+                        return
+                    else:
+                        raise ValueError("Invalid message type received for bets batch")
+
+                on_committed = None
+                if ack:
+                    ack_frame = ProtocolMessage.encode_string(f"{MSG_ACK},{seq}")
+                    on_committed = functools.partial(self._loop.call_soon_threadsafe, writer.write, ack_frame)
+                self._count_frame(body)
+                if parsing is None:
+                    total_bets += await self._loop.run_in_executor(
+                        None, self.__parse_and_store_batch, agency, msg_type, body, on_committed, upload, on_failed)
+                else:
+                    await self._loop.run_in_executor(None, parsing.wait_for_room)
+                    parsing.submit(agency, msg_type, body, on_committed)
+                seq += 1
+
+            if parsing is not None:
+                total_bets = await self._loop.run_in_executor(None, parsing.wait)
+            drained = True
+
+        except Exception as e:
+            if parsing is not None:
+                total_bets = parsing.stored_bets
+            logging.error(f"action: apuesta_recibida | result: fail | cantidad: {total_bets}")
+            logging.error(f"{e}")
+
+        finally:
+            if parsing is not None:
+                parsing.cancel()
+            if drained:
+                # The drain waits for `done`, so it is set once the reply was sent
+                stored = asyncio.Event()
+                self._bet_writer.sync(lambda: self._loop.call_soon_threadsafe(stored.set))
+                await stored.wait()
+                writer.write(self._draining_reply(agency))
+                await writer.drain()
+                # Closing the connection with unread batches would reset it
+                try:
+                    await asyncio.wait_for(self.__discard_until_closed(reader), self._drain_timeout)
+                except (asyncio.TimeoutError, OSError):
+                    pass
+                done.set()
+            else:
+                self._bet_writer.sync(lambda: self._loop.call_soon_threadsafe(done.set))
+                if ack:
+                    await self.__wait_unless_stopped(done)
+
+    def __parse_and_store_batch(self, agency: str, msg_type: int, body, on_committed, upload: str, on_failed) -> int:
+        return self._store_batch(agency, parse_batch(agency, msg_type, body), on_committed, upload, on_failed)
+
+    def __fail_load(self, writer: asyncio.StreamWriter, _error: Exception):
+        """ Same as Server._fail_load, from the writer thread """
+        self._loop.call_soon_threadsafe(writer.transport.abort)
+
+    async def __wait_unless_stopped(self, event: asyncio.Event):
+        """
+        Wait for an event set by the bets writer, or until the server
+        stops: the writer is closed then, and would never set it
+        """
+        waits = [self._loop.create_task(event.wait()), self._loop.create_task(self._stopped.wait())]
+        try:
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for wait in waits:
+                wait.cancel()
+
+    async def __discard_until_closed(self, reader: asyncio.StreamReader):
+        while await reader.read(DISCARD_READ_SIZE):
+            pass
+
+    async def _agency_done_submitting_async(self, agency: str):
+        """
+        Handle ALL_BETS_SENT from client
+
+        Same as Server._agency_done_submitting, awaiting the loads of
+        the agency instead of blocking on them.
+        """
+        if self._lottery_completed:
+            return
+
+        if not self._is_valid_agency(agency):
+            logging.error(f"action: agency_done_submitting | result: fail | agencia: {agency}")
+            return
+
+        for e in self._done_writting_data_for_agency.get(agency, []):
+            await e.wait()
+
+        self._mark_agency_done(agency)
+
+    def _on_lottery_completed(self):
+        super()._on_lottery_completed()
+        # Before the loop starts (e.g. restored from the journal) the
+        # event is set when it is created
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._lottery_done_async.set)
+
+    async def _send_results_to_async(self, agency: str, options: list[str], writer: asyncio.StreamWriter):
+        """
+        Handle RESULTS_REQUEST from client
+
+        Same as Server._send_results_to, awaiting the lottery instead
+        of blocking on it.
+        """
+        if not self._is_valid_agency(agency):
+            logging.error(f"action: enviar_resultados | result: fail | agencia: {agency}")
+            return
+
+        try:
+            if OPT_WAIT in options and not self._lottery_completed:
+                try:
+                    await asyncio.wait_for(self._lottery_done_async.wait(), self._results_wait_timeout)
+                except asyncio.TimeoutError:
+                    pass
+            writer.write(self._results_message_for(agency))
+            await writer.drain()
+            if self._lottery_completed:
+                logging.info(f"action: enviar_resultados | result: success | agencia: {agency}")
+
+        except Exception as e:
+            logging.error(f"action: enviar_resultados | result: fail | agencia: {agency} | error: {e}")
@@ -0,0 +1,110 @@
+import collections
+import concurrent.futures
+import threading
+import time
+
+from .communication import TYPE_BET_BATCH, TYPE_COMPRESSED, TYPE_STRING_LIST, decompress_body
+from .utils import BetBatch
+
+
+def _from_compressed(agency: str, body) -> BetBatch:
+    msg_type, body = decompress_body(body)
+    if msg_type not in BATCH_PARSERS or msg_type == TYPE_COMPRESSED:
+        raise ValueError("Invalid compressed message type")
+    return BATCH_PARSERS[msg_type](agency, body)
+
+
+BATCH_PARSERS = {
+    TYPE_STRING_LIST: BetBatch.from_string_list,
+    TYPE_BET_BATCH: lambda agency, body: BetBatch.from_bet_batch(body),
+    TYPE_COMPRESSED: _from_compressed,
+}
+
+
+def parse_batch(agency: str, msg_type: bytes, body) -> tuple[BetBatch, float]:
+    """
+    Parse the body of a batch message. Returns the batch and the
+    seconds spent parsing it. Module level, so parser processes can
+    run it.
+    """
+    started = time.perf_counter()
+    batch = BATCH_PARSERS[msg_type](agency, body)
+    return batch, time.perf_counter() - started
+
+
+class ParsedBatches:
+    """
+    Batches of a LOAD_BATCHES request being parsed by a pool of parser
+    processes, while the connection thread keeps reading frames.
+
+    Every parsed batch is handed to `store(parsed, on_committed)` as
+    soon as it and the ones received before it are parsed, so batches
+    are stored in arrival order. At most `max_pending` batches are in
+    flight: submit blocks while there are more, which bounds the memory
+    a fast agency can take while the parsers fall behind.
+
+    Once a batch fails to be parsed or stored, the batches after it
+    are discarded and the error is raised by the next call.
+    """
+
+    def __init__(self, executor, max_pending, store):
+        self._executor = executor
+        self._max_pending = max_pending
+        self._store = store
+        self._changed = threading.Condition(threading.RLock())
+        self._pending = collections.deque()
+        self._error = None
+        self.stored_bets = 0
+
+    def submit(self, agency: str, msg_type: bytes, body, on_committed=None):
+        # The body is a view of the reader buffer, so it is copied
+        body = bytes(body)
+        self.wait_for_room()
+        with self._changed:
+            future = self._executor.submit(parse_batch, agency, msg_type, body)
+            self._pending.append((future, on_committed))
+        future.add_done_callback(self._store_parsed)
+
+    def wait_for_room(self):
+        """ Block until another batch can be submitted """
+        with self._changed:
+            while len(self._pending) >= self._max_pending and self._error is None:
+                self._changed.wait()
+            self._raise_error()
+
+    def wait(self) -> int:
+        """ Block until every batch submitted is stored. Returns the amount of bets stored. """
+        with self._changed:
+            while self._pending and self._error is None:
+                self._changed.wait()
+            self._raise_error()
+            return self.stored_bets
+
+    def cancel(self):
+        """ Discard the batches not stored yet """
+        with self._changed:
+            if self._error is None:
+                self._error = concurrent.futures.CancelledError("Batches discarded")
+            self._discard_pending()
+
+    def _store_parsed(self, _future):
+        """ Store the leading parsed batches. Run by the executor when a batch is parsed. """
+        with self._changed:
+            while self._pending and self._pending[0][0].done() and self._error is None:
+                future, on_committed = self._pending.popleft()
+                try:
+                    self.stored_bets += self._store(future.result(), on_committed)
+                except Exception as e:
+                    self._error = e
+                    self._discard_pending()
+            self._changed.notify_all()
+
+    def _discard_pending(self):
+        for future, _on_committed in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._changed.notify_all()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
@@ -0,0 +1,177 @@
+import os
+import struct
+import threading
+from array import array
+
+from .utils import BetBatch
+
+"""
+Index of the bets already stored, to drop duplicated ones at ingest
+
+A bet is identified by its (agency, document, number). Instead of the
+keys themselves the index keeps a 64 bits fingerprint of each one in a
+flat open addressing table (an array of unsigned longs, with 0 marking
+an empty slot), so it takes ~32 bytes per bet instead of the ~100 a set
+of tuples would. Fingerprints use the (per process salted) hash of the
+key, which is fine since the index is rebuilt from the storage file
+whenever the server starts.
+
+A fingerprint match is never taken as proof of a duplicate: every slot
+also keeps the position of its key in an append-only keys file next to
+the storage file, and the bet is only dropped if the key read back from
+there is the same. The storage file itself cannot be used for that,
+since bets are indexed as they are received and the writer decides
+where they are stored only once it flushes them.
+"""
+INITIAL_CAPACITY = 1 << 16
+""" The table doubles once it is more than half full. """
+MAX_LOAD_FACTOR = 0.5
+_FINGERPRINT_MASK = (1 << 64) - 1
+""" Record of the keys file: agency, number and document length, followed by the document. """
+KEY_HEADER = struct.Struct('<iiI')
+
+
+def bet_index_filepath(storage_filepath: str) -> str:
+    """ Keys file of the bets index of a storage file, e.g. ./bets.bin.keys """
+    return f"{storage_filepath}.keys"
+
+
+class BetIndex:
+    """
+    Set of the (agency, document, number) of the stored bets, with a
+    count of the duplicated bets dropped for every agency. Thread-safe.
+
+    The keys file at `filepath` is created empty, replacing any previous
+    one, and is owned by the index until `close`.
+    """
+
+    def __init__(self, filepath: str, capacity=INITIAL_CAPACITY):
+        self._slots = array('Q', bytes(8 * capacity))
+        self._positions = array('Q', bytes(8 * capacity))
+        self._mask = capacity - 1
+        self._len = 0
+        self._max_len = int(MAX_LOAD_FACTOR * capacity)
+        self._lock = threading.Lock()
+        self._file = open(filepath, 'w+b', buffering=0)
+        self._keys_size = 0
+        self.duplicates = {}
+
+    def __len__(self) -> int:
+        return self._len
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def add_batch(self, batch: BetBatch) -> BetBatch:
+        """
+        Add the bets of a batch to the index. Returns the batch without
+        the bets that were already indexed (or repeated in the batch),
+        which is the batch itself when it has no duplicates.
+        """
+        documents = _documents(batch)
+        duplicated = []
+        with self._lock:
+            if self._len + len(documents) > self._max_len:
+                self._grow(self._len + len(documents))
+            # Keys of the batch, appended to the keys file once it is indexed
+            keys = bytearray()
+            # Inlined _add, since this loop runs once per received bet
+            slots, positions, mask, keys_size = self._slots, self._positions, self._mask, self._keys_size
+            for i, key in enumerate(zip(batch.agencies, documents, batch.numbers)):
+                fingerprint = (hash(key) & _FINGERPRINT_MASK) or 1
+                slot_index = fingerprint & mask
+                slot = slots[slot_index]
+                while slot and (slot != fingerprint or self._key_at(positions[slot_index], keys) != key):
+                    slot_index = (slot_index + 1) & mask
+                    slot = slots[slot_index]
+                if slot:
+                    duplicated.append(i)
+                    agency = key[0]
+                    self.duplicates[agency] = self.duplicates.get(agency, 0) + 1
+                else:
+                    slots[slot_index] = fingerprint
+                    positions[slot_index] = keys_size + len(keys)
+                    keys += KEY_HEADER.pack(key[0], key[2], len(key[1]))
+                    keys += key[1]
+            self._append_keys(keys)
+            self._len += len(documents) - len(duplicated)
+        if not duplicated:
+            return batch
+        duplicated = set(duplicated)
+        return batch.select(i for i in range(len(batch)) if i not in duplicated)
+
+    def discard_batch(self, batch: BetBatch):
+        """
+        Remove the bets of a batch from the index, e.g. when it could not
+        be stored after all. Slots after a removed one are shifted back,
+        so the probe sequences of the remaining fingerprints stay intact.
+        Their keys are left in the keys file, unreferenced.
+        """
+        with self._lock:
+            slots, positions, mask = self._slots, self._positions, self._mask
+            for key in zip(batch.agencies, _documents(batch), batch.numbers):
+                fingerprint = (hash(key) & _FINGERPRINT_MASK) or 1
+                hole = fingerprint & mask
+                while slots[hole] and (slots[hole] != fingerprint or self._key_at(positions[hole]) != key):
+                    hole = (hole + 1) & mask
+                if not slots[hole]:
+                    continue
+                slot_index = hole
+                while True:
+                    slot_index = (slot_index + 1) & mask
+                    slot = slots[slot_index]
+                    if not slot:
+                        break
+                    # A fingerprint moves back unless its home slot lies after the hole
+                    if (slot_index - (slot & mask)) & mask >= (slot_index - hole) & mask:
+                        slots[hole] = slot
+                        positions[hole] = positions[slot_index]
+                        hole = slot_index
+                slots[hole] = 0
+                self._len -= 1
+
+    def _key_at(self, position: int, pending: bytearray = b"") -> tuple:
+        """
+        The (agency, document, number) key at a position of the keys
+        file, where positions past its end refer to the `pending` keys
+        not appended yet
+        """
+        if position >= self._keys_size:
+            offset = position - self._keys_size
+            agency, number, length = KEY_HEADER.unpack_from(pending, offset)
+            start = offset + KEY_HEADER.size
+            return agency, bytes(pending[start:start + length]), number
+        fd = self._file.fileno()
+        agency, number, length = KEY_HEADER.unpack(os.pread(fd, KEY_HEADER.size, position))
+        return agency, os.pread(fd, length, position + KEY_HEADER.size), number
+
+    def _append_keys(self, keys: bytearray):
+        view = memoryview(keys)
+        while view:
+            view = view[self._file.write(view):]
+        self._keys_size += len(keys)
+
+    def _grow(self, min_len: int):
+        """ Double the table until `min_len` fingerprints fit in it, and rehash them """
+        capacity = len(self._slots)
+        while MAX_LOAD_FACTOR * capacity < min_len:
+            capacity *= 2
+        old_slots, old_positions = self._slots, self._positions
+        self._slots = array('Q', bytes(8 * capacity))
+        self._positions = array('Q', bytes(8 * capacity))
+        self._mask = capacity - 1
+        self._max_len = int(MAX_LOAD_FACTOR * capacity)
+        slots, positions, mask = self._slots, self._positions, self._mask
+        for fingerprint, position in zip(old_slots, old_positions):
+            if fingerprint:
+                slot_index = fingerprint & mask
+                while slots[slot_index]:
+                    slot_index = (slot_index + 1) & mask
+                slots[slot_index] = fingerprint
+                positions[slot_index] = position
+
+
+def _documents(batch: BetBatch) -> list[bytes]:
+    text, offsets = bytes(batch._text), batch._offsets
+    return [text[offsets[i]:offsets[i + 1]] for i in range(2, len(offsets) - 1, 3)]
@@ -0,0 +1,223 @@
+import datetime
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from .lottery import DEFAULT_RULE, WinningNumber
+from .utils import Bet, BetBatch
+
+"""
+Append-only binary bets log
+
+The file starts with a header (magic and version) followed by blocks,
+one per stored batch. Every block has a header with its amount of bets,
+its agency (0 if it mixes agencies) and the length of its text, followed
+by the columns of the batch as little-endian arrays:
+
+    agencies    int32[count]
+    numbers     int32[count]
+    birthdates  int32[count]    (date ordinals)
+    offsets     uint32[3 * count + 1]
+    text        utf-8 first names, last names and documents
+
+so numbers and agencies can be scanned straight from a memory map
+without decoding any name.
+"""
+BET_LOG_FILEPATH = "./bets.bin"
+FILE_HEADER = struct.Struct('<7sB')
+MAGIC = b"BETSLOG"
+VERSION = 1
+BLOCK_HEADER = struct.Struct('<4sIiI')
+BLOCK_MARKER = b"BLK1"
+_SWAP = sys.byteorder != 'little'
+
+
+def is_bet_log(filepath: str) -> bool:
+    """ Whether the file is a binary bets log (as opposed to a CSV one) """
+    try:
+        with open(filepath, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _column_bytes(column: array) -> bytes:
+    if _SWAP:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def encode_block(batch: BetBatch) -> bytes:
+    """ Encode a batch as a block of the log """
+    count = len(batch)
+    agency = batch.agencies[0] if count and batch.agencies.count(batch.agencies[0]) == count else 0
+    return b"".join((
+        BLOCK_HEADER.pack(BLOCK_MARKER, count, agency, len(batch._text)),
+        _column_bytes(batch.agencies),
+        _column_bytes(batch.numbers),
+        _column_bytes(batch.birthdates),
+        _column_bytes(batch._offsets),
+        bytes(batch._text),
+    ))
+
+
+def _block_size(count: int, text_len: int) -> int:
+    return BLOCK_HEADER.size + 12 * count + 4 * (3 * count + 1) + text_len
+
+
+def open_for_append(filepath: str):
+    """
+    Open a log to append blocks to it, writing the file header if it
+    is new. An incomplete last block (e.g. the server crashed while
+    writing it) is truncated, so new blocks are not appended after it.
+    """
+    file = open(filepath, 'ab')
+    if file.tell() == 0:
+        file.write(FILE_HEADER.pack(MAGIC, VERSION))
+        file.flush()
+        return file
+    with BetLog(filepath) as log:
+        valid_size, size = log.valid_size, log.size
+    if valid_size < size:
+        logging.warning(f"action: open_bet_log | result: in_progress | truncated_bytes: {size - valid_size}")
+        file.truncate(valid_size)
+        file.seek(valid_size)
+    return file
+
+
+class BetLog:
+    """
+    Read-only view of a binary bets log through a memory map
+
+    On open it walks the block headers (without reading the bets) to
+    index the blocks by agency. The view covers the file as it was
+    when opened.
+    """
+
+    def __init__(self, filepath: str):
+        self._file = open(filepath, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        if self.size < FILE_HEADER.size or FILE_HEADER.unpack_from(self._map, 0) != (MAGIC, VERSION):
+            self.close()
+            raise ValueError(f"{filepath} is not a bets log")
+        self._blocks = []
+        self._blocks_by_agency = {}
+        self.valid_size = self._index_blocks()
+
+    def _index_blocks(self) -> int:
+        """ Index the complete blocks. Returns where the last one ends. """
+        offset = FILE_HEADER.size
+        while offset + BLOCK_HEADER.size <= self.size:
+            marker, count, agency, text_len = BLOCK_HEADER.unpack_from(self._map, offset)
+            end = offset + _block_size(count, text_len)
+            if marker != BLOCK_MARKER or end > self.size:
+                break
+            self._blocks.append((offset, count, agency))
+            self._blocks_by_agency.setdefault(agency, []).append(len(self._blocks) - 1)
+            offset = end
+        return offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __len__(self) -> int:
+        return sum(count for _offset, count, _agency in self._blocks)
+
+    def _blocks_of(self, agency):
+        """ Blocks that may contain bets of `agency` (all of them if None) """
+        if agency is None:
+            return self._blocks
+        indexes = sorted(self._blocks_by_agency.get(agency, []) + self._blocks_by_agency.get(0, []))
+        return [self._blocks[i] for i in indexes]
+
+    def _column(self, start: int, count: int, typecode='i') -> array:
+        column = array(typecode)
+        column.frombytes(self._map[start:start + 4 * count])
+        if _SWAP:
+            column.byteswap()
+        return column
+
+    def batches(self, agency: int = None):
+        """ Yields the stored batches (only the ones of `agency`, if given) """
+        for offset, count, _block_agency in self._blocks_of(agency):
+            start = offset + BLOCK_HEADER.size
+            text_len = BLOCK_HEADER.unpack_from(self._map, offset)[3]
+            batch = BetBatch()
+            batch.agencies = self._column(start, count)
+            batch.numbers = self._column(start + 4 * count, count)
+            batch.birthdates = self._column(start + 8 * count, count)
+            batch._offsets = self._column(start + 12 * count, 3 * count + 1, 'I')
+            text_start = start + 12 * count + 4 * (3 * count + 1)
+            batch._text = bytearray(self._map[text_start:text_start + text_len])
+            yield batch
+
+    def bets(self, agency: int = None):
+        """ Yields the stored bets (only the ones of `agency`, if given) as Bet """
+        birthdates = {}
+        for batch in self.batches(agency):
+            text, offsets = bytes(batch._text), batch._offsets
+            for i, bet_agency in enumerate(batch.agencies):
+                if agency is not None and bet_agency != agency:
+                    continue
+                ordinal = batch.birthdates[i]
+                birthdate = birthdates.get(ordinal)
+                if birthdate is None:
+                    birthdate = birthdates[ordinal] = datetime.date.fromordinal(ordinal)
+                first, last, document, end = offsets[3 * i:3 * i + 4]
+                bet = Bet.__new__(Bet)
+                bet.agency = bet_agency
+                bet.first_name = text[first:last].decode('utf-8')
+                bet.last_name = text[last:document].decode('utf-8')
+                bet.document = text[document:end].decode('utf-8')
+                bet.birthdate = birthdate
+                bet.number = batch.numbers[i]
+                yield bet
+
+    def winners(self, rule=DEFAULT_RULE) -> dict:
+        """
+        Documents of the bets that win with the given lottery rule, by
+        agency. Only the numbers column of each block is scanned (for a
+        winning number, searched straight over the map), and only the
+        documents of the winning bets are decoded.
+        """
+        winners = {}
+        for offset, count, _agency in self._blocks:
+            start = offset + BLOCK_HEADER.size
+            for i in self._winning_indexes(rule, start + 4 * count, count):
+                winners.setdefault(self._int_at(start + 4 * i), []).append(self._document(offset, count, i))
+        return winners
+
+    def _winning_indexes(self, rule, numbers_start: int, count: int):
+        if not isinstance(rule, WinningNumber):
+            mask = rule.mask(self._column(numbers_start, count))
+            yield from (i for i, won in enumerate(mask) if won)
+            return
+        needle = _column_bytes(array('i', [rule.number]))
+        numbers_end = numbers_start + 4 * count
+        pos = self._map.find(needle, numbers_start, numbers_end)
+        while pos != -1:
+            if (pos - numbers_start) % 4 == 0:
+                yield (pos - numbers_start) // 4
+            pos = self._map.find(needle, pos + 1, numbers_end)
+
+    def _int_at(self, position: int) -> int:
+        return struct.unpack_from('<i', self._map, position)[0]
+
+    def _document(self, offset: int, count: int, index: int) -> str:
+        offsets_start = offset + BLOCK_HEADER.size + 12 * count
+        text_start = offsets_start + 4 * (3 * count + 1)
+        start, end = struct.unpack_from('<II', self._map, offsets_start + 4 * (3 * index + 2))
+        return self._map[text_start + start:text_start + end].decode('utf-8')
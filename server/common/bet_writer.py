@@ -0,0 +1,239 @@
+import csv
+import functools
+import io
+import logging
+import os
+import queue
+import threading
+import time
+
+from . import bet_log
+from .metrics import REGISTRY, WRITER_FLUSH_SECONDS, WRITER_FLUSHED_BYTES, WRITER_QUEUE_SECONDS
+from .utils import BetBatch
+
+_STOP = object()
+_RESET = object()
+""" Storage formats: a CSV file (like store_bets) or a binary bets log (see bet_log). """
+FORMAT_CSV = "csv"
+FORMAT_BINARY = "binary"
+STORAGE_FORMATS = (FORMAT_CSV, FORMAT_BINARY)
+
+class BetWriter:
+    """
+    Single writer stage for the bets storage file
+
+    Handler threads enqueue parsed batches with `write` instead of
+    opening the storage file themselves. A dedicated thread owns one
+    long-lived file handle and coalesces every batch queued while it
+    was busy into a single buffered write (group commit).
+
+    A group is flushed when it reaches `flush_bytes`, or `flush_interval`
+    seconds after its first batch (as soon as the queue is empty when
+    the interval is 0). If `fsync` is set, every
+    flush is also synced to disk. Callbacks passed to `write` or `sync`
+    run only after the data enqueued before them has been flushed.
+
+    A batch that cannot be encoded, or whose group cannot be flushed,
+    is dropped: its `on_failed` callback runs instead of `on_durable`,
+    its journal record is not committed and whatever the failed flush
+    wrote is truncated. Later batches of the same upload fail too until
+    `reset`, so the bets stored of every upload are always a prefix of
+    the ones received. `sync` callbacks run either way.
+
+    Bets are stored as CSV rows or, with the binary `storage_format`,
+    as one block of the bets log per batch. With a `journal`, the
+    records of the batches of every group are committed to it after
+    the group is flushed and before the callbacks run.
+    """
+
+    def __init__(self, filepath: str, flush_bytes=64 * 1024, flush_interval=0.0, fsync=False, max_pending=256,
+                 storage_format=FORMAT_CSV, journal=None):
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f"Unknown storage format: {storage_format}")
+        self._filepath = filepath
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        self._queue = queue.Queue(maxsize=max_pending)
+        if storage_format == FORMAT_BINARY:
+            self._buffer = io.BytesIO()
+            self._open = functools.partial(bet_log.open_for_append, filepath)
+            self._append = self._append_block
+        else:
+            self._buffer = io.StringIO()
+            self._csv_writer = csv.writer(self._buffer, quoting=csv.QUOTE_MINIMAL)
+            self._open = functools.partial(open, filepath, 'a+')
+            self._append = self._append_rows
+        self._file = self._open()
+        self._pending_callbacks = []
+        self._failed_uploads = set()
+        self._journal = journal
+        self._pending_records = []
+        REGISTRY.gauge("writer_queue_depth", "Batches waiting in the writer queue", self._queue.qsize)
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def write(self, bets, on_durable=None, record=None, on_failed=None, upload=None):
+        """
+        Enqueue a batch of bets (a BetBatch or a list of Bet) of an
+        upload to be appended to the storage file, with its journal
+        record if any. `on_failed(error)` is called if it is dropped.
+        Blocks while the writer is `max_pending` batches behind.
+        """
+        self._queue.put((bets, on_durable, time.perf_counter(), record, on_failed, upload))
+
+    def sync(self, on_durable):
+        """
+        Call `on_durable` once every batch enqueued so far is flushed
+        (or dropped)
+        """
+        self._queue.put(((), on_durable, None, None, lambda _error: on_durable(), None))
+
+    def reset(self, upload):
+        """
+        Accept batches of an upload again after one of them failed,
+        from the batches enqueued after this call on (the ones enqueued
+        before it are flushed first)
+        """
+        self._queue.put((_RESET, upload))
+
+    def close(self):
+        """
+        Flush every pending batch and close the storage file
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._file.close()
+
+    def _writer_loop(self):
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush()
+                deadline = None
+                continue
+
+            if item is _STOP:
+                self._flush()
+                return
+            if item[0] is _RESET:
+                # Batches enqueued before the reset may still fail their flush
+                self._flush()
+                deadline = None
+                self._failed_uploads.discard(item[1])
+                continue
+
+            bets, on_durable, enqueued, record, on_failed, upload = item
+            if enqueued is not None:
+                WRITER_QUEUE_SECONDS.observe(time.perf_counter() - enqueued)
+            error = None
+            if upload is not None and upload in self._failed_uploads:
+                error = ValueError(f"An earlier batch of upload {upload} could not be stored")
+            elif len(bets):
+                position = self._buffer.tell()
+                try:
+                    self._append(bets)
+                except Exception as e:
+                    logging.error(f"action: write_bets | result: fail | error: {e}")
+                    error = e
+                    # Rows of the batch written before the error are dropped too
+                    self._buffer.seek(position)
+                    self._buffer.truncate()
+                    if upload is not None:
+                        self._failed_uploads.add(upload)
+            if record is not None and error is None:
+                self._pending_records.append(record)
+            if on_durable is not None or on_failed is not None:
+                self._pending_callbacks.append((on_durable, on_failed, upload, error))
+
+            if deadline is None:
+                deadline = time.monotonic() + self._flush_interval
+            expired = time.monotonic() >= deadline and (self._flush_interval > 0 or self._queue.empty())
+            if self._buffer.tell() >= self._flush_bytes or expired:
+                self._flush()
+                deadline = None
+
+    def _append_rows(self, bets):
+        if isinstance(bets, BetBatch):
+            self._buffer.write(bets.csv_text())
+        else:
+            for bet in bets:
+                self._csv_writer.writerow([bet.agency, bet.first_name, bet.last_name,
+                                           bet.document, bet.birthdate, bet.number])
+
+    def _append_block(self, bets):
+        if not isinstance(bets, BetBatch):
+            batch = BetBatch()
+            for bet in bets:
+                batch.append(bet.agency, bet.first_name, bet.last_name, bet.document, bet.birthdate, bet.number)
+            bets = batch
+        self._buffer.write(bet_log.encode_block(bets))
+
+    def _flush(self):
+        error = None
+        size = None
+        try:
+            if self._file.closed:
+                self._file = self._open()
+            data = self._buffer.getvalue()
+            if data:
+                size = os.fstat(self._file.fileno()).st_size
+                started = time.perf_counter()
+                self._file.write(data)
+                self._file.flush()
+                if self._fsync:
+                    os.fsync(self._file.fileno())
+                WRITER_FLUSH_SECONDS.observe(time.perf_counter() - started)
+                WRITER_FLUSHED_BYTES.inc(len(data))
+                logging.debug(f"action: flush_bets | result: success | bytes: {len(data)}")
+            if self._journal is not None and self._pending_records:
+                self._journal.commit(self._pending_records, os.fstat(self._file.fileno()).st_size)
+        except Exception as e:
+            logging.error(f"action: flush_bets | result: fail | error: {e}")
+            error = e
+            if size is not None:
+                self._discard_failed_write(size)
+        finally:
+            self._buffer.seek(0)
+            self._buffer.truncate()
+            self._pending_records = []
+
+        callbacks, self._pending_callbacks = self._pending_callbacks, []
+        for on_durable, on_failed, upload, batch_error in callbacks:
+            batch_error = batch_error or error
+            if batch_error is not None and upload is not None:
+                self._failed_uploads.add(upload)
+            try:
+                if batch_error is None:
+                    if on_durable is not None:
+                        on_durable()
+                elif on_failed is not None:
+                    on_failed(batch_error)
+            except Exception as e:
+                logging.error(f"action: flush_bets_callback | result: fail | error: {e}")
+
+    def _discard_failed_write(self, size: int):
+        """
+        Truncate the storage file back to `size` bytes, the ones it had
+        before a failed flush, and reopen it, so neither the part of the
+        group that reached the file nor the part left in the file buffer
+        ends up stored
+        """
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        try:
+            os.truncate(self._filepath, size)
+        except OSError as e:
+            logging.error(f"action: truncate_bets | result: fail | error: {e}")
+        try:
+            self._file = self._open()
+        except OSError as e:
+            # Opened again by the next flush
+            logging.error(f"action: open_bets | result: fail | error: {e}")
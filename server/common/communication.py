@@ -1,21 +1,41 @@
+import asyncio
+import struct
+import zlib
 from socket import MSG_WAITALL, socket
 
+_STRING_SIZE = struct.Struct('>I')
+""" Header of a BET_BATCH body: amount of records. """
+BET_BATCH_HEADER = struct.Struct('>I')
+"""
+Fixed part of a BET_BATCH record: agency, number, birthdate as days
+since 1970-01-01, and the sizes of the first name, last name and
+document, which follow it as consecutive utf-8 strings.
+"""
+BET_RECORD = struct.Struct('>HIiHHH')
+
 def string_message(data: bytes) -> str:
-    return data.decode('utf-8')
+    return str(data, 'utf-8')
 
-def string_list_message(data: bytes) -> list[str]:
-    result = []
+def iter_string_list(data: bytes):
+    """
+    Yields the (start, end) offsets of every string in the body of
+    a STRING_LIST message, without copying the strings.
+    """
     offset = 0
-    while offset < len(data):
-        if offset + 4 > len(data):
+    length = len(data)
+    while offset < length:
+        if offset + 4 > length:
             raise ValueError("Invalid data: incomplete string size")
-        size = int.from_bytes(data[offset:offset+4], byteorder='big')
+        size, = _STRING_SIZE.unpack_from(data, offset)
         offset += 4
-        if offset + size > len(data):
+        if offset + size > length:
             raise ValueError("Invalid data: incomplete string content")
-        result.append(data[offset:offset+size].decode('utf-8'))
+        yield offset, offset + size
         offset += size
-    return result
+
+def string_list_message(data: bytes) -> list[str]:
+    data = memoryview(data)
+    return [str(data[start:end], 'utf-8') for start, end in iter_string_list(data)]
 
 TYPE_TO_CONSTRUCTOR = {
     b'\x01': string_message,
@@ -24,49 +44,167 @@ TYPE_TO_CONSTRUCTOR = {
 HEADER_SIZE = 5 # 1 byte for type + 4 bytes for length
 TYPE_STRING = b'\x01'
 TYPE_STRING_LIST = b'\x02'
+TYPE_BET_BATCH = b'\x03'
+"""
+Compressed batch: the type of the batch message (1 byte) followed by
+its body compressed as a zlib stream. Only sent once negotiated with
+the ZLIB option of LOAD_BATCHES.
+"""
+TYPE_COMPRESSED = b'\x04'
+""" Maximum size of a decompressed body, so a small frame can't inflate without bound. """
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+"""
+Maximum size of a frame body. Bodies are received into buffers of the
+size announced by the header, so larger ones are rejected before
+allocating them.
+"""
+MAX_FRAME_SIZE = 16 * 1024 * 1024
 MSG_TIMEOUT = 5
 
-def _recv_exact(sock: socket, nbytes: int) -> bytes:
-    data = bytearray()
-    
-    while len(data) < nbytes:
-        packet = sock.recv(nbytes - len(data), MSG_WAITALL)
-        if not packet:
+def decompress_body(data) -> tuple[bytes, bytes]:
+    """ Type and decompressed body of the message carried by a COMPRESSED message """
+    if len(data) < 1:
+        raise ValueError("Invalid data: missing compressed message type")
+    decompressor = zlib.decompressobj()
+    body = decompressor.decompress(data[1:], MAX_DECOMPRESSED_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError("Invalid data: compressed message too large")
+    if not decompressor.eof:
+        raise ValueError("Invalid data: incomplete compressed message")
+    return bytes(data[0:1]), body
+
+def _recv_exact_into(sock: socket, view: memoryview):
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:], len(view) - received, MSG_WAITALL)
+        if n == 0:
             raise EOFError("Socket closed before receiving expected bytes")
-        data += packet
+        received += n
+
+def _frame_length(header) -> int:
+    length = int.from_bytes(header[1:5], byteorder='big')
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Invalid data: frame of {length} bytes exceeds the maximum of {MAX_FRAME_SIZE}")
+    return length
+
+def _recv_exact(sock: socket, nbytes: int) -> bytes:
+    data = bytearray(nbytes)
+    _recv_exact_into(sock, memoryview(data))
     return data
 
+class FrameReader:
+    """
+    Reads messages from a socket into a single reusable buffer
+
+    Meant for long streams of frames, such as the batches of a
+    LOAD_BATCHES request. The buffer only grows when a frame does
+    not fit in it, so reading a frame does not allocate.
+    """
+
+    def __init__(self, sock: socket, buffer_size=16 * 1024):
+        self._sock = sock
+        self._header = bytearray(HEADER_SIZE)
+        self._buffer = bytearray(buffer_size)
+
+    def read_frame(self) -> tuple[bytes, memoryview]:
+        """
+        Receive the next message and return its type and a view of
+        its body. The view is only valid until the next call.
+        """
+        self._sock.settimeout(MSG_TIMEOUT)
+        _recv_exact_into(self._sock, memoryview(self._header))
+
+        type = bytes(self._header[0:1])
+        length = _frame_length(self._header)
+
+        if length > len(self._buffer):
+            self._buffer = bytearray(length)
+        body = memoryview(self._buffer)[:length]
+        _recv_exact_into(self._sock, body)
+        return type, body
+
 class ProtocolMessage:
     @staticmethod
     def new_from_sock(sock: socket):
         sock.settimeout(MSG_TIMEOUT)
         header = _recv_exact(sock, HEADER_SIZE)
 
-        type = header[0:1]
-        length = int.from_bytes(header[1:5], byteorder='big')
+        type = bytes(header[0:1])
+        length = _frame_length(header)
 
         body = _recv_exact(sock, length)
 
+        return ProtocolMessage.decode(type, body)
+
+    @staticmethod
+    async def new_from_stream(reader: asyncio.StreamReader):
+        """
+        Same as new_from_sock, but reading the message from an
+        asyncio stream instead of a blocking socket.
+        """
+        type, body = await ProtocolMessage.frame_from_stream(reader)
+        return ProtocolMessage.decode(type, body)
+
+    @staticmethod
+    async def frame_from_stream(reader: asyncio.StreamReader) -> tuple[bytes, memoryview]:
+        """
+        Receive the next message from an asyncio stream and return its
+        type and a view of its body, without decoding it.
+        """
+        header = await asyncio.wait_for(reader.readexactly(HEADER_SIZE), MSG_TIMEOUT)
+
+        type = header[0:1]
+        length = _frame_length(header)
+
+        body = await asyncio.wait_for(reader.readexactly(length), MSG_TIMEOUT)
+        return type, memoryview(body)
+
+    @staticmethod
+    def decode(type: bytes, body: bytes):
         constructor = TYPE_TO_CONSTRUCTOR.get(type)
         if not constructor:
             raise ValueError(f"Unknown message type: {type}")
         return constructor(body)
-        
+
     @staticmethod
-    def send_string_to_sock(sock: socket, string: str):
+    def encode_string(string: str) -> bytes:
         body = string.encode('utf-8')
         length = len(body).to_bytes(4, byteorder='big')
-        message = TYPE_STRING + length + body
-        sock.sendall(message)
+        return TYPE_STRING + length + body
+
+    @staticmethod
+    def encode_string_list(strings: list[str]) -> bytes:
+        encoded = [s.encode('utf-8') for s in strings]
+        body = b"".join(item for e in encoded for item in (len(e).to_bytes(4, byteorder='big'), e))
+        length = len(body).to_bytes(4, byteorder='big')
+        return TYPE_STRING_LIST + length + body
+
+    @staticmethod
+    def encode_bet_batch(records) -> bytes:
+        """
+        Encode a BET_BATCH message. Each record is a tuple of
+        (agency, first_name, last_name, document, days_since_epoch, number)
+        """
+        body = bytearray(BET_BATCH_HEADER.pack(len(records)))
+        for agency, first_name, last_name, document, birthdate, number in records:
+            texts = [first_name.encode('utf-8'), last_name.encode('utf-8'), document.encode('utf-8')]
+            body += BET_RECORD.pack(agency, number, birthdate, *map(len, texts))
+            for text in texts:
+                body += text
+        length = len(body).to_bytes(4, byteorder='big')
+        return TYPE_BET_BATCH + length + body
+
+    @staticmethod
+    def encode_compressed(frame: bytes, level: int = zlib.Z_DEFAULT_COMPRESSION) -> bytes:
+        """ Encode an already encoded batch message as a COMPRESSED message """
+        body = frame[0:1] + zlib.compress(frame[HEADER_SIZE:], level)
+        length = len(body).to_bytes(4, byteorder='big')
+        return TYPE_COMPRESSED + length + body
+
+    @staticmethod
+    def send_string_to_sock(sock: socket, string: str):
+        sock.sendall(ProtocolMessage.encode_string(string))
         
     @staticmethod
     def send_string_list_to_sock(sock: socket, strings: list[str]):
-        body = bytearray()
-        for s in strings:
-            bytes = s.encode('utf-8')
-            size = len(bytes).to_bytes(4, byteorder='big')
-            body.extend(size)
-            body.extend(bytes)
-        length = len(body).to_bytes(4, byteorder='big')
-        message = TYPE_STRING_LIST + length + body
-        sock.sendall(message)
\ No newline at end of file
+        sock.sendall(ProtocolMessage.encode_string_list(strings))
@@ -0,0 +1,136 @@
+import logging
+import os
+import threading
+from urllib.parse import quote, unquote
+
+""" Journal records, one per line: <kind>,<fields> """
+REC_BETS = "BETS"        # BETS,<upload>,<amount>: bets of an agency (or one of its streams) stored
+REC_WINNER = "WINNER"    # WINNER,<agency>,<document>: a winning bet stored (see _escape)
+REC_SIZE = "SIZE"        # SIZE,<bytes>: size of the storage file, commits the records before it
+REC_DONE = "DONE"        # DONE,<agency>: the agency is done submitting bets
+REC_RULE = "RULE"        # RULE,<rule>: lottery rule the winners were found with
+
+
+def journal_filepath(storage_filepath: str) -> str:
+    """ Journal of a storage file, e.g. ./bets.bin.journal """
+    return f"{storage_filepath}.journal"
+
+
+def _escape(document: str) -> str:
+    """
+    Percent-encode a document for a record, since it is text sent by an
+    agency and a comma or line break in it would split the record
+    """
+    return quote(document, safe='')
+
+
+class Journal:
+    """
+    Durable checkpoints of the ingestion: bets committed by every agency
+    (or stream of an agency), winners of every agency, size of the storage file and agencies done submitting.
+
+    The bets writer appends a group of records after every flush of the
+    storage file and before acknowledging its batches, ending it with the
+    new size of the file. On startup the journal is replayed: groups
+    without their SIZE record (cut by a crash) are ignored, and whatever
+    the storage file holds past the last SIZE was never acknowledged, so
+    it can be truncated. Replaying only reads the journal, never the bets.
+    """
+
+    def __init__(self, filepath: str, fsync=False):
+        self._filepath = filepath
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self.committed_bets = {}
+        self.winners = {}
+        self.agencies_done = set()
+        self.storage_size = None
+        self.rule = None
+        if os.path.exists(filepath):
+            self._replay()
+
+    def _replay(self):
+        bets, winners = {}, []
+        with open(self._filepath, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.endswith('\n'):
+                    break
+                kind, _, fields = line.rstrip('\n').partition(',')
+                if kind == REC_BETS:
+                    agency, amount = fields.split(',')
+                    bets[agency] = bets.get(agency, 0) + int(amount)
+                elif kind == REC_WINNER:
+                    agency, document = fields.split(',', 1)
+                    winners.append((int(agency), unquote(document)))
+                elif kind == REC_SIZE:
+                    for agency, amount in bets.items():
+                        self.committed_bets[agency] = self.committed_bets.get(agency, 0) + amount
+                    for agency, document in winners:
+                        self.winners.setdefault(agency, []).append(document)
+                    bets, winners = {}, []
+                    self.storage_size = int(fields)
+                elif kind == REC_DONE:
+                    self.agencies_done.add(int(fields))
+                elif kind == REC_RULE:
+                    self.rule = fields
+        logging.info(f"action: replay_journal | result: success | uploads: {len(self.committed_bets)} | "
+                     f"bets: {sum(self.committed_bets.values())} | agencies_done: {len(self.agencies_done)}")
+
+    def discard(self):
+        """ Forget the replayed state, e.g. when the storage file was removed """
+        self.committed_bets = {}
+        self.winners = {}
+        self.agencies_done = set()
+        self.storage_size = None
+
+    def compact(self, storage_size: int, rule: str = None):
+        """
+        Rewrite the journal as a single group with the replayed state
+        (and the lottery rule, if given), so it does not grow across
+        restarts, and open it for appending
+        """
+        self.rule = rule or self.rule
+        lines = [f"{REC_RULE},{self.rule}\n"] if self.rule else []
+        lines += [f"{REC_BETS},{agency},{amount}\n" for agency, amount in self.committed_bets.items()]
+        lines += [f"{REC_WINNER},{agency},{_escape(document)}\n"
+                  for agency, documents in self.winners.items() for document in documents]
+        lines.append(f"{REC_SIZE},{storage_size}\n")
+        lines += [f"{REC_DONE},{agency}\n" for agency in sorted(self.agencies_done)]
+        tmp_filepath = f"{self._filepath}.tmp"
+        with open(tmp_filepath, 'w', encoding='utf-8') as file:
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_filepath, self._filepath)
+        self.storage_size = storage_size
+        self._file = open(self._filepath, 'a', encoding='utf-8')
+
+    def commit(self, records, storage_size: int):
+        """
+        Append a group of (upload, agency, amount, winning documents)
+        records, once the storage file holds their bets and has
+        `storage_size` bytes. The upload is the key the server tracks the
+        progress of a load by: the agency or one of its streams.
+        """
+        lines = []
+        for upload, agency, amount, documents in records:
+            lines.append(f"{REC_BETS},{upload},{amount}\n")
+            lines += [f"{REC_WINNER},{agency},{_escape(document)}\n" for document in documents]
+        lines.append(f"{REC_SIZE},{storage_size}\n")
+        self._append(lines)
+
+    def agency_done(self, agency: str):
+        self._append([f"{REC_DONE},{agency}\n"])
+
+    def _append(self, lines):
+        with self._lock:
+            self._file.writelines(lines)
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
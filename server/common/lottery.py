@@ -0,0 +1,68 @@
+from array import array
+
+from .utils import LOTTERY_WINNER_NUMBER, number_mask
+
+"""
+Rules deciding which bets win the lottery
+
+A rule is applied to every batch as it is stored, keeping the winners
+of every agency up to date, so running the lottery is only a state
+transition. Rules are configured as <name>:<argument>, e.g.
+number:7574, and their text is kept in the journal, so a restart with
+a different rule rebuilds the winners instead of reusing stale ones.
+"""
+
+
+class WinningNumber:
+    """ Bets whose number is exactly `number` """
+
+    def __init__(self, number):
+        self.number = int(number)
+        if not 0 <= self.number < 2 ** 31:
+            raise ValueError(f"Invalid lottery winner number: {number}")
+
+    def mask(self, numbers: array) -> bytearray:
+        """ Mask with a truthy value for each winning number of the column """
+        return number_mask(numbers, self.number)
+
+    def has_won(self, number: int) -> bool:
+        return number == self.number
+
+    def __str__(self):
+        return f"number:{self.number}"
+
+
+class WinningEnding:
+    """ Bets whose number ends with the given digits """
+
+    def __init__(self, digits: str):
+        if not digits.isdigit():
+            raise ValueError(f"Invalid lottery rule digits: {digits}")
+        self.digits = digits
+        self._modulus = 10 ** len(digits)
+        self._remainder = int(digits)
+
+    def mask(self, numbers: array) -> bytearray:
+        modulus, remainder = self._modulus, self._remainder
+        return bytearray(number % modulus == remainder for number in numbers)
+
+    def has_won(self, number: int) -> bool:
+        return number % self._modulus == self._remainder
+
+    def __str__(self):
+        return f"ending:{self.digits}"
+
+
+LOTTERY_RULES = {
+    "number": WinningNumber,
+    "ending": WinningEnding,
+}
+DEFAULT_RULE = WinningNumber(LOTTERY_WINNER_NUMBER)
+
+
+def parse_rule(spec: str):
+    """ Rule configured as <name>:<argument>. Raises ValueError if invalid. """
+    name, _, argument = spec.strip().partition(':')
+    if name not in LOTTERY_RULES or not argument:
+        raise ValueError(f"Invalid lottery rule: {spec}")
+    return LOTTERY_RULES[name](argument)
@@ -0,0 +1,238 @@
+import bisect
+import http.server
+import logging
+import threading
+import time
+
+""" Upper bounds (in seconds) of the buckets of the timing histograms. """
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def _format_labels(key) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+
+class Counter:
+    """ Monotonic count, optionally split by labels (e.g. agency=1) """
+
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def total(self):
+        return sum(self.values().values())
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in sorted(self.values().items())]
+
+
+class Gauge:
+    """ Value read from a callback every time the metrics are rendered """
+
+    kind = "gauge"
+
+    def __init__(self, name, description, callback):
+        self.name = name
+        self.description = description
+        self.callback = callback
+
+    def value(self):
+        return self.callback()
+
+    def render(self) -> list[str]:
+        return [f"{self.name} {self.value()}"]
+
+
+class Histogram:
+    """ Distribution of observed values (e.g. durations) in fixed buckets """
+
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self._bounds = list(buckets)
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self):
+        """ Returns (count, sum) """
+        with self._lock:
+            return self._count, self._sum
+
+    def render(self) -> list[str]:
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self._bounds + ["+Inf"], counts):
+            cumulative += bucket
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process, rendered in the Prometheus text format.
+    Registering a name again returns (or, for gauges, replaces) the
+    existing metric, so several servers in a process share them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, description) -> Counter:
+        return self._register(name, lambda: Counter(name, description))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(name, lambda: Histogram(name, description, buckets))
+
+    def gauge(self, name, description, callback) -> Gauge:
+        with self._lock:
+            self._metrics[name] = Gauge(name, description, callback)
+            return self._metrics[name]
+
+    def get(self, name):
+        with self._lock:
+            return self._metrics.get(name)
+
+    def _register(self, name, create):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = create()
+            return self._metrics[name]
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logging.error(f"action: render_metric | result: fail | metric: {metric.name} | error: {e}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+FRAMES_RECEIVED = REGISTRY.counter("batch_frames_received_total", "Batch messages received")
+BYTES_RECEIVED = REGISTRY.counter("batch_bytes_received_total", "Bytes of the batch messages received")
+BETS_PARSED = REGISTRY.counter("bets_parsed_total", "Bets parsed, by agency")
+PARSE_SECONDS = REGISTRY.histogram("batch_parse_seconds", "Time spent parsing a batch message")
+BETS_STORED = REGISTRY.counter("bets_stored_total", "Bets written to the storage file, by agency")
+BETS_DUPLICATED = REGISTRY.counter("bets_duplicated_total", "Bets dropped for being already stored, by agency")
+WRITER_QUEUE_SECONDS = REGISTRY.histogram("writer_queue_wait_seconds",
+                                          "Time a batch waits in the writer queue before being buffered")
+WRITER_FLUSH_SECONDS = REGISTRY.histogram("writer_flush_seconds",
+                                          "Time the writer spends writing (and syncing) a group of batches")
+WRITER_FLUSHED_BYTES = REGISTRY.counter("writer_flushed_bytes_total", "Bytes written to the storage file")
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int) -> http.server.ThreadingHTTPServer:
+    """
+    Serve the metrics of the process as plain text in
+    http://<host>:<port>/metrics from a daemon thread
+    """
+    server = http.server.ThreadingHTTPServer(('', port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"action: start_metrics_server | result: success | port: {port}")
+    return server
+
+
+class SummaryLogger:
+    """
+    Logs a summary of the metrics every `interval` seconds: totals,
+    ingest rate (overall and by agency) since the last summary and the
+    average parse and flush times.
+    """
+
+    def __init__(self, interval: float, registry=REGISTRY):
+        self._interval = interval
+        self._registry = registry
+        self._stopped = threading.Event()
+        self._last_stored = BETS_STORED.values()
+        self._last_time = time.monotonic()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self):
+        while not self._stopped.wait(self._interval):
+            self.log_summary()
+
+    def log_summary(self):
+        now = time.monotonic()
+        stored = BETS_STORED.values()
+        elapsed = max(now - self._last_time, 1e-9)
+        rates = {
+            dict(key).get("agency"): (value - self._last_stored.get(key, 0)) / elapsed
+            for key, value in sorted(stored.items())
+        }
+        self._last_stored, self._last_time = stored, now
+
+        parses, parse_time = PARSE_SECONDS.snapshot()
+        flushes, flush_time = WRITER_FLUSH_SECONDS.snapshot()
+        gauges = "".join(
+            f" | {name}: {metric.value()}" for name, metric in
+            ((name, self._registry.get(name)) for name in ("thread_pool_queue_depth", "writer_queue_depth"))
+            if metric is not None
+        )
+        by_agency = ",".join(f"{agency}={rate:.0f}" for agency, rate in rates.items())
+        logging.info(
+            f"action: metrics | result: success | frames: {FRAMES_RECEIVED.total()} | "
+            f"bytes: {BYTES_RECEIVED.total()} | bets_parsed: {BETS_PARSED.total()} | "
+            f"bets_stored: {sum(stored.values())} | bets_per_sec: {sum(rates.values()):.0f} | "
+            f"bets_per_sec_by_agency: {by_agency} | "
+            f"parse_ms_avg: {1000 * parse_time / parses if parses else 0:.3f} | "
+            f"flush_ms_avg: {1000 * flush_time / flushes if flushes else 0:.3f}{gauges}"
+        )
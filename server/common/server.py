@@ -1,39 +1,232 @@
+import collections
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
+import os
+import select
 import socket
 import logging
 import signal
 import threading
+import time
 
-from .thread_pool import ThreadPool
-from .communication import ProtocolMessage
-from .utils import Bet, has_won, load_bets, store_bets
+from . import metrics
+from .batch_parser import BATCH_PARSERS, ParsedBatches, parse_batch
+from .bet_index import BetIndex, bet_index_filepath
+from .bet_log import BetLog, is_bet_log
+from .bet_writer import FORMAT_CSV, BetWriter
+from .journal import Journal, journal_filepath
+from .thread_pool import POLICY_BLOCK, ThreadPool
+from .communication import HEADER_SIZE, FrameReader, ProtocolMessage
+from .lottery import DEFAULT_RULE
+from .utils import STORAGE_FILEPATH, BetBatch, load_bets
 
 MSG_END = "END"
 MSG_LOTERY_IN_PROGRESS = "LOTERY_IN_PROGRESS"
+MSG_LOAD_OK = "LOAD_OK"
+MSG_ACK = "ACK"
+""" Sent to connections shed because the thread pool queue is full. """
+MSG_SERVER_BUSY = "SERVER_BUSY"
+"""
+Sent while the server is draining (stopping on SIGTERM) instead of
+the next ACK of an upload, or as the reply to a new request, so the
+client reconnects later and resumes its upload.
+"""
+MSG_SERVER_DRAINING = "SERVER_DRAINING"
+""" Bytes read at once while discarding the batches sent to a draining server. """
+DISCARD_READ_SIZE = 64 * 1024
+""" Seconds to wait for the workers running a task when stopping. """
+THREAD_POOL_STOP_TIMEOUT = 10
+""" Batches of a LOAD_BATCHES request in flight per parser process. """
+PARSER_PENDING_PER_PROCESS = 2
+""" LOAD_BATCHES option: the client can send batches as BET_BATCH messages. """
+OPT_BET_BATCH = "BET_BATCH"
+"""
+LOAD_BATCHES option: the server acknowledges every batch once stored,
+replying ACK,<n> where n is the sequence number (from 0) of the batch
+in the request. The LOAD_OK reply then includes OFFSET=<bets>, the
+amount of bets of the agency already stored, so a client can resume
+an interrupted upload from there.
+"""
+OPT_ACK = "ACK"
+OPT_OFFSET = "OFFSET"
+"""
+LOAD_BATCHES option STREAM=<k>/<n>: the request uploads the k-th (from
+0) of n contiguous parts of the agency's file, in parallel with the
+requests uploading the other parts. Its OFFSET counts only the bets of
+that part, so every stream resumes on its own.
+"""
+OPT_STREAM = "STREAM"
+"""
+LOAD_BATCHES option: the client can send batches as COMPRESSED messages
+(zlib). It decides which ones, e.g. only those big enough to be worth it.
+"""
+OPT_ZLIB = "ZLIB"
+"""
+RESULTS_REQUEST option: if the lottery is not completed yet, the server
+holds the request until it is (or until the results wait timeout
+expires, replying LOTERY_IN_PROGRESS as usual).
+"""
+OPT_WAIT = "WAIT"
 REQUEST_HANDLERS = {
-    "LOAD_BATCHES": lambda server, agency, sock: server._load_batches_request(agency, sock),
-    "ALL_BETS_SENT": lambda server, agency, sock: server._agency_done_submitting(agency),
-    "RESULTS_REQUEST": lambda server, agency, sock: server._send_results_to(agency, sock),
+    "LOAD_BATCHES": lambda server, agency, options, sock: server._load_batches_request(agency, options, sock),
+    "ALL_BETS_SENT": lambda server, agency, options, sock: server._agency_done_submitting(agency),
+    "RESULTS_REQUEST": lambda server, agency, options, sock: server._send_results_to(agency, options, sock),
 }
 
+
+def upload_key(agency: str, options: list[str]) -> str:
+    """
+    Key the progress of a LOAD_BATCHES request is tracked by: the agency,
+    or <agency>/<k>/<n> for the k-th of n parallel streams of the agency
+    """
+    for option in options:
+        if option.startswith(f"{OPT_STREAM}="):
+            stream, _, streams = option[len(OPT_STREAM) + 1:].partition('/')
+            if not (stream.isdigit() and streams.isdigit() and int(stream) < int(streams)):
+                raise ValueError(f"Invalid stream option: {option}")
+            return f"{agency}/{int(stream)}/{int(streams)}"
+    return agency
+
+class AckSender:
+    """
+    Sends the ACKs of an upload without blocking the bets writer thread,
+    which runs `send` for every connection: an ACK that does not fit in
+    the send buffer of the socket (the client is not reading them) is
+    left pending, and sent along with the next ACK or by the thread of
+    the connection through `flush`, before it reads the next batch and
+    when the upload ends.
+    """
+
+    def __init__(self, sock: socket):
+        self._sock = sock
+        self._frames = collections.deque()
+        self._unsent = b""
+        self._sending = threading.Lock()
+        self._poll = select.poll()
+        self._poll.register(sock, select.POLLOUT)
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._unsent or self._frames)
+
+    def send(self, seq: int):
+        self._frames.append(ProtocolMessage.encode_string(f"{MSG_ACK},{seq}"))
+        # If the thread of the connection is flushing, it sends this one too
+        if not self._sending.acquire(blocking=False):
+            return
+        try:
+            while self.pending and self._poll.poll(0):
+                if not self._unsent:
+                    self._unsent = self._frames.popleft()
+                self._unsent = self._unsent[self._sock.send(self._unsent):]
+        except OSError:
+            # The connection is broken, which its thread finds out when reading
+            pass
+        finally:
+            self._sending.release()
+
+    def flush(self):
+        """ Send the pending ACKs, blocking """
+        with self._sending:
+            while self.pending:
+                if not self._unsent:
+                    self._unsent = self._frames.popleft()
+                self._sock.sendall(self._unsent)
+                self._unsent = b""
+
+
 class Server:
-    def __init__(self, port, listen_backlog, total_agencies):
+    """ LOAD_BATCHES options supported by the server. """
+    _load_batches_options = {OPT_BET_BATCH, OPT_ACK, OPT_ZLIB}
+
+    def __init__(self, port, listen_backlog, total_agencies,
+                 flush_bytes=64 * 1024, flush_interval=0.0, fsync=False,
+                 results_wait_timeout=30.0, storage_filepath=STORAGE_FILEPATH, storage_format=FORMAT_CSV,
+                 metrics_port=0, metrics_log_interval=0.0, batch_log_sample=1,
+                 pool_max_workers=0, pool_max_queue=0, pool_policy=POLICY_BLOCK,
+                 parser_processes=0, journal=False, lottery_rule=DEFAULT_RULE, dedup=False, drain_timeout=0.0):
         # Initialize server socket
-        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._server_socket.bind(('', port))
-        self._server_socket.listen(listen_backlog)
+        self._server_socket = self._create_server_socket(port, listen_backlog)
         self.running = False
-        signal.signal(signal.SIGTERM, lambda _signum, _frame: self.stop())
+        self._draining = threading.Event()
+        self._drain_timeout = drain_timeout
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: self.drain())
         
         self._total_agencies = total_agencies
         self._agencies_done_submitting = set()
         self._lottery_completed = False
+        self._lottery_done = threading.Event()
+        self._results_wait_timeout = results_wait_timeout
         
         self._current_client_sockets = set()
-        self._store_bets_lock = threading.Lock()
         self._agency_done_submitting_lock = threading.Lock()
         self._done_writting_data_for_agency = {}
-        self._thread_pool = ThreadPool(num_workers=total_agencies)
+        self._loads_of_upload = {}
+        self._committed_lock = threading.Lock()
+        self._committed_bets = {}
+        self._winners_lock = threading.Lock()
+        self._winners_by_agency = {}
+        self._results_frames = None
+        self._lottery_rule = lottery_rule
+        self._storage_filepath = storage_filepath
+        self._journal = Journal(journal_filepath(storage_filepath), fsync) if journal else None
+        self._recover()
+        self._bet_writer = BetWriter(storage_filepath, flush_bytes, flush_interval, fsync,
+                                     storage_format=storage_format, journal=self._journal)
+        if self._journal is not None:
+            self._journal.compact(os.path.getsize(storage_filepath), str(lottery_rule))
+        self._bet_index = self._load_bet_index() if dedup else None
+        self._thread_pool = self._create_thread_pool(pool_max_workers, pool_max_queue, pool_policy)
+        if self._thread_pool is not None:
+            metrics.REGISTRY.gauge("thread_pool_queue_depth", "Tasks waiting for a worker of the thread pool",
+                                   self._thread_pool.queue_depth)
+        self._parser_processes = parser_processes
+        self._parser_pool = self._create_parser_pool(parser_processes)
+
+        # Log one of every `batch_log_sample` received batches (0 to log none)
+        self._batch_log_sample = batch_log_sample
+        self._batches_received = itertools.count()
+        self._metrics_server = metrics.start_metrics_server(metrics_port) if metrics_port else None
+        self._metrics_summary = metrics.SummaryLogger(metrics_log_interval) if metrics_log_interval > 0 else None
+
+    def _create_server_socket(self, port, listen_backlog):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # A restarted server must not wait for the connections of the previous one to time out
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(('', port))
+        server_socket.listen(listen_backlog)
+        return server_socket
 
+    def _create_thread_pool(self, max_workers, max_queue, policy):
+        return ThreadPool(num_workers=self._total_agencies, max_queue=max_queue, max_workers=max_workers,
+                          policy=policy, on_rejected=self._reply_busy)
+
+    def _create_parser_pool(self, processes):
+        """
+        Pool of processes parsing the received batches, or None to parse
+        them in the thread reading the connection. Processes are spawned
+        (not forked, the server already runs threads) and started now,
+        so the first batches do not wait for them.
+        """
+        if processes <= 0:
+            return None
+        pool = concurrent.futures.ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+        pool.submit(int).result()
+        logging.info(f"action: start_parser_pool | result: success | processes: {processes}")
+        return pool
+
+    def _new_parsed_batches(self, agency: str, upload: str, on_failed=None):
+        """ Parsing state of a LOAD_BATCHES request, None if batches are parsed inline """
+        if self._parser_pool is None:
+            return None
+        return ParsedBatches(self._parser_pool, self._parser_processes * PARSER_PENDING_PER_PROCESS,
+                             functools.partial(self._store_batch, agency, upload=upload, on_failed=on_failed))
+
+    def _stop_parser_pool(self):
+        if self._parser_pool is not None:
+            self._parser_pool.shutdown(cancel_futures=True)
 
     def run(self):
         """
@@ -65,23 +258,25 @@ class Server:
             if type(msg) is not str:
                 raise ValueError("Invalid message type received for request")
             if msg == MSG_END:
-                self._current_client_sockets.remove(sock)
+                self._current_client_sockets.discard(sock)
                 sock.close()
                 return
             
-            request, agency = msg.split(',')
+            request, agency, *options = msg.split(',')
             
             if REQUEST_HANDLERS.get(request) is None:
                 raise ValueError(f"Unknown request type: {request}")
             
-            REQUEST_HANDLERS[request](self, agency, sock)
+            REQUEST_HANDLERS[request](self, agency, options, sock)
 
-            self._thread_pool.submit(self.__handle_client_connection, sock)
+            if self._draining.is_set() or not self._thread_pool.submit(self.__handle_client_connection, sock,
+                                                                         bypass_limit=True):
+                raise ValueError("Server is stopping")
 
         except Exception as e:
             if self.running:
                 logging.error(f"action: receive_message | result: fail | error: {e}")
-            self._current_client_sockets.remove(sock)
+            self._current_client_sockets.discard(sock)
             sock.close()
                 
 
@@ -99,11 +294,47 @@ class Server:
             c, addr = self._server_socket.accept()
             logging.info(f'action: accept_connections | result: success | ip: {addr[0]}')
             self._current_client_sockets.add(c)
-            self._thread_pool.submit(self.__handle_client_connection, c)
+            if not self._thread_pool.submit(self.__handle_client_connection, c):
+                self._current_client_sockets.discard(c)
+                c.close()
         except OSError as e:
             if self.running:
                 logging.error(f"action: accept_connections | result: fail | error: {e}")
 
+    def drain(self):
+        """
+        Stop the server gracefully, within `drain_timeout` seconds
+
+        The server stops accepting connections and every LOAD_BATCHES
+        in progress stops at the end of its current batch, replying
+        SERVER_DRAINING once the batches it received are stored (and
+        acknowledged). Results requests still waiting for the lottery
+        get SERVER_DRAINING too. Once every upload finished, or the
+        timeout expires, the server is stopped. Without a timeout it is
+        stopped right away.
+        """
+        if self._draining.is_set():
+            return
+        self._draining.set()
+        if self._drain_timeout <= 0:
+            self.stop()
+            return
+        logging.info(f"action: drain | result: in_progress | timeout: {self._drain_timeout}")
+        self.running = False
+        self._server_socket.close()
+        self._lottery_done.set()
+        if self._wait_for_loads(self._drain_timeout):
+            logging.info("action: drain | result: success")
+        else:
+            logging.warning("action: drain | result: fail | error: timeout, closing the remaining uploads")
+        self.stop()
+
+    def _wait_for_loads(self, timeout: float) -> bool:
+        """ Wait for every LOAD_BATCHES request to finish. Returns False on timeout. """
+        deadline = time.monotonic() + timeout
+        loads = [done for loads in list(self._done_writting_data_for_agency.values()) for done in loads]
+        return all(done.wait(max(0.0, deadline - time.monotonic())) for done in loads)
+
     def stop(self):
         """
         Stop the server
@@ -114,10 +345,30 @@ class Server:
         self._server_socket.close()
         logging.info("action: server_socket_closed | result: success")
         self.__close_client_sockets()
-        self._thread_pool.stop()
+        # Wake up the requests waiting for the lottery
+        self._lottery_done.set()
+        self._thread_pool.stop(THREAD_POOL_STOP_TIMEOUT)
+        self._stop_parser_pool()
+        self._close_storage()
+        self._stop_metrics()
+
+    def _close_storage(self):
+        self._bet_writer.close()
+        if self._bet_index is not None:
+            self._bet_index.close()
+        if self._journal is not None:
+            self._journal.close()
+
+    def _stop_metrics(self):
+        if self._metrics_summary is not None:
+            self._metrics_summary.stop()
+            self._metrics_summary.log_summary()
+        if self._metrics_server is not None:
+            self._metrics_server.shutdown()
+            self._metrics_server.server_close()
 
     def __close_client_sockets(self):
-        for sock in self._current_client_sockets:
+        for sock in list(self._current_client_sockets):
             try:
                 sock.close()
             except Exception as e:
@@ -125,46 +376,240 @@ class Server:
         self._current_client_sockets.clear()
         logging.info("action: client_sockets_closed | result: success")
 
-    def _load_batches_request(self, agency: str, sock: socket):
+    def _reply_busy(self, sock: socket):
+        """ Let a connection shed by the thread pool know the server is busy """
+        logging.warning("action: accept_connections | result: fail | error: server busy")
+        try:
+            sock.sendall(ProtocolMessage.encode_string(MSG_SERVER_BUSY))
+        except OSError:
+            pass
+
+    def _load_batches_request(self, agency: str, options: list[str], sock: socket):
         """
         Handle LOAD_BATCHES request from client
         
         Function that handles the LOAD_BATCHES request from a client.
-        It will keep receiving batches of bets until an END message is
-        received. If any error occurs during the process, it will log
-        the error and return.
+        If the client offered options, it replies with the ones the
+        server accepts. Then it will keep receiving batches of bets
+        until an END message is received. If any error occurs during
+        the process, it will log the error and return.
+
+        In ACK mode every batch is acknowledged once stored (see
+        AckSender), and the request does not finish until all of them
+        were acknowledged.
+
+        With parser processes this thread only reads frames, and the
+        batches are stored in arrival order as they are parsed. Batches
+        still being parsed when the request fails are discarded.
+
+        While the server is draining, the request stops reading batches
+        after the current one and replies SERVER_DRAINING once every
+        batch received was stored.
         """
+        if self._draining.is_set():
+            if options:
+                sock.sendall(ProtocolMessage.encode_string(MSG_SERVER_DRAINING))
+            return
         total_bets = 0
-        if agency not in self._done_writting_data_for_agency:
-            self._done_writting_data_for_agency[agency] = [threading.Event()]
-            index = 0
-        else:
-            index = len(self._done_writting_data_for_agency[agency])
-            self._done_writting_data_for_agency[agency].append(threading.Event())
+        upload = upload_key(agency, options)
+        on_failed = functools.partial(self._fail_load, sock)
+        parsing = self._new_parsed_batches(agency, upload, on_failed)
+        done = threading.Event()
+        previous_loads = self._register_load(agency, upload, done)
+        reader = FrameReader(sock)
+        ack = OPT_ACK in options and OPT_ACK in self._load_batches_options
+        acks = AckSender(sock) if ack else None
+        drained = False
         try:
-            while True:
-                msg = ProtocolMessage.new_from_sock(sock)
-                if type(msg) is not list:
-                    if msg == MSG_END:
+            if options:
+                if ack:
+                    # The offset must include what earlier (maybe broken)
+                    # uploads of the same part are still storing
+                    for e in previous_loads:
+                        e.wait()
+                sock.sendall(self._load_batches_reply(upload, options))
+            self._bet_writer.reset(upload)
+
+            seq = 0
+            while not self._draining.is_set():
+                if ack and acks.pending:
+                    acks.flush()
+                msg_type, body = reader.read_frame()
+                if msg_type not in BATCH_PARSERS:
+                    if ProtocolMessage.decode(msg_type, body) == MSG_END:
+                        if parsing is not None:
+                            total_bets = parsing.wait()
                         return
                     else:
                         raise ValueError("Invalid message type received for bets batch")
                 
-                bets = [Bet.from_string(agency, bet_str) for bet_str in msg]
-                total_bets += len(bets)
-                
-                with self._store_bets_lock:
-                    store_bets(bets)
-                
-                logging.info(f"action: apuesta_recibida | result: success | cantidad: {len(bets)}")
+                on_committed = functools.partial(acks.send, seq) if ack else None
+                self._count_frame(body)
+                if parsing is None:
+                    total_bets += self._store_batch(agency, parse_batch(agency, msg_type, body), on_committed,
+                                                    upload, on_failed)
+                else:
+                    parsing.submit(agency, msg_type, body, on_committed)
+                seq += 1
+
+            # Draining: the batches received so far are stored before replying
+            if parsing is not None:
+                total_bets = parsing.wait()
+            drained = True
             
         except Exception as e:
+            if parsing is not None:
+                total_bets = parsing.stored_bets
             logging.error(f"action: apuesta_recibida | result: fail | cantidad: {total_bets}")
             logging.error(f"{e}")
         
         finally:
-            self._done_writting_data_for_agency[agency][index].set()
+            if parsing is not None:
+                parsing.cancel()
+            if drained:
+                # The drain waits for `done`, so it is set once the reply was sent
+                stored = threading.Event()
+                self._bet_writer.sync(stored.set)
+                stored.wait()
+                try:
+                    if ack:
+                        acks.flush()
+                    sock.sendall(self._draining_reply(agency))
+                    self._discard_until_closed(sock)
+                except OSError:
+                    pass
+                done.set()
+            else:
+                self._bet_writer.sync(done.set)
+                if ack:
+                    done.wait()
+                    try:
+                        acks.flush()
+                    except OSError as e:
+                        logging.error(f"action: enviar_ack | result: fail | agencia: {agency} | error: {e}")
+
+    def _draining_reply(self, agency: str) -> bytes:
+        """ Encoded reply to an upload interrupted by the drain, which the client can resume later """
+        logging.info(f"action: apuesta_recibida | result: in_progress | agencia: {agency} | error: server draining")
+        return ProtocolMessage.encode_string(MSG_SERVER_DRAINING)
+
+    def _discard_until_closed(self, sock: socket):
+        """
+        Read and discard the batches the client sent ahead of its ACKs
+        until it closes the connection (at most `drain_timeout` seconds),
+        since closing it with unread data would reset it before the
+        client reads the SERVER_DRAINING reply
+        """
+        sock.settimeout(self._drain_timeout)
+        while sock.recv(DISCARD_READ_SIZE):
+            pass
+
+    def _fail_load(self, sock: socket, _error: Exception):
+        """
+        End a load whose batch could not be stored: the load stops
+        reading batches and the client, without the ACK of that batch,
+        resumes from the bets actually stored
+        """
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _register_load(self, agency: str, upload: str, done) -> list:
+        """
+        Track a LOAD_BATCHES request until `done` is set: ALL_BETS_SENT
+        waits for every load of the agency. Returns the earlier loads of
+        the same upload (the agency or one of its streams).
+        """
+        previous_loads = list(self._loads_of_upload.get(upload, []))
+        self._loads_of_upload.setdefault(upload, []).append(done)
+        self._done_writting_data_for_agency.setdefault(agency, []).append(done)
+        return previous_loads
+
+    def _load_batches_reply(self, upload: str, options: list[str]) -> bytes:
+        """
+        Encoded reply to the options offered in a LOAD_BATCHES request:
+        LOAD_OK followed by the options accepted by the server. Unknown
+        options are left out, so clients can fall back to the defaults.
+        The OFFSET is the amount of bets of `upload` already stored.
+        """
+        accepted = [option for option in options
+                    if option in self._load_batches_options or option.startswith(f"{OPT_STREAM}=")]
+        if OPT_ACK in accepted:
+            with self._committed_lock:
+                accepted.append(f"{OPT_OFFSET}={self._committed_bets.get(upload, 0)}")
+        return ProtocolMessage.encode_string(','.join([MSG_LOAD_OK] + accepted))
+
+    def _count_frame(self, body):
+        metrics.FRAMES_RECEIVED.inc()
+        metrics.BYTES_RECEIVED.inc(HEADER_SIZE + len(body))
+
+    def _store_batch(self, agency: str, parsed: tuple[BetBatch, float], on_committed=None, upload=None,
+                     on_failed=None) -> int:
+        """
+        Validate a batch parsed from a message of an agency (with the
+        seconds spent parsing it), index its winners and hand it to the
+        bets writer to be persisted. Returns the amount of bets in the
+        batch.
+
+        `on_committed` is called from the writer once the batch is stored,
+        and its bets are counted in the progress of `upload` (by default,
+        the agency). If the writer drops the batch, its bets are removed
+        from the indexes and `on_failed(error)` is called instead.
+
+        With the bets index, bets already stored are dropped instead of
+        persisted again. They still count in the progress of `upload`,
+        since that is where the client resumes from.
+        """
+        upload = upload or agency
+        batch, parse_seconds = parsed
+        received = len(batch)
+        metrics.PARSE_SECONDS.observe(parse_seconds)
+        metrics.BETS_PARSED.inc(received, agency=agency)
+        if batch.agencies.count(int(agency)) != received:
+            raise ValueError("Batch contains bets from another agency")
+        if self._bet_index is not None:
+            batch = self._drop_duplicates(agency, batch)
+
+        winners = self._index_winners(batch)
+        committed = functools.partial(self._batch_committed, agency, upload, received, len(batch), on_committed)
+        failed = functools.partial(self._batch_failed, agency, batch, winners, on_failed)
+        self._bet_writer.write(batch, committed, (upload, agency, received, winners), failed, upload)
+
+        if self._batch_log_sample and next(self._batches_received) % self._batch_log_sample == 0:
+            logging.info(f"action: apuesta_recibida | result: success | cantidad: {received}")
+        return received
+
+    def _drop_duplicates(self, agency: str, batch: BetBatch) -> BetBatch:
+        """ The batch without the bets the bets index already holds """
+        unique = self._bet_index.add_batch(batch)
+        if len(unique) < len(batch):
+            metrics.BETS_DUPLICATED.inc(len(batch) - len(unique), agency=agency)
+            logging.debug(f"action: apuesta_duplicada | result: success | agencia: {agency} | "
+                            f"cantidad: {len(batch) - len(unique)}")
+        return unique
             
+    def _batch_committed(self, agency: str, upload: str, amount: int, stored: int, on_committed):
+        metrics.BETS_STORED.inc(stored, agency=agency)
+        with self._committed_lock:
+            self._committed_bets[upload] = self._committed_bets.get(upload, 0) + amount
+        if on_committed is not None:
+            on_committed()
+
+    def _batch_failed(self, agency: str, batch: BetBatch, winners: list[str], on_failed, error: Exception):
+        logging.error(f"action: apuesta_almacenada | result: fail | agencia: {agency} | cantidad: {len(batch)} | "
+                      f"error: {error}")
+        if winners:
+            with self._winners_lock:
+                documents = self._winners_by_agency.get(int(agency), [])
+                for document in winners:
+                    documents.remove(document)
+                self._results_frames = None
+        if self._bet_index is not None:
+            self._bet_index.discard_batch(batch)
+        if on_failed is not None:
+            on_failed(error)
+
     def _agency_done_submitting(self, agency: str):
         """
         Handle ALL_BETS_SENT from client
@@ -177,54 +622,218 @@ class Server:
         if self._lottery_completed:
             return
         
-        agency_num = int(agency)
-        if agency_num < 1 or agency_num > self._total_agencies:
+        if not self._is_valid_agency(agency):
             logging.error(f"action: agency_done_submitting | result: fail | agencia: {agency}")
             return
         
-        for e in self._done_writting_data_for_agency[agency]:
+        for e in self._done_writting_data_for_agency.get(agency, []):
             e.wait()
-            
-        with self._agency_done_submitting_lock:
-            self._agencies_done_submitting.add(agency_num)
+
+        self._mark_agency_done(agency)
+
+    def _is_valid_agency(self, agency: str) -> bool:
+        return 1 <= int(agency) <= self._total_agencies
+
+    def _mark_agency_done(self, agency: str):
+        """
+        Register that an agency has finished submitting bets and all
+        of them have been stored. If it was the last one, the lottery
+        is marked as completed.
+        """
+        if self._journal is not None:
+            self._journal.agency_done(agency)
         logging.info(f"action: agency_done_submitting | result: success | agencia: {agency}")
+        if self._bet_index is not None:
+            logging.info(f"action: apuestas_duplicadas | result: success | agencia: {agency} | "
+                         f"cantidad: {self._bet_index.duplicates.get(int(agency), 0)}")
+        self._restore_agency_done(agency)
 
-        if len(self._agencies_done_submitting) == self._total_agencies:
+    def _restore_agency_done(self, agency: str):
+        """ Register an agency done submitting bets, running the lottery if it was the last one """
+        if self._register_agency_done(int(agency)):
             self._lottery_completed = True
             logging.info("action: sorteo | result: success")
+            self._on_lottery_completed()
+
+    def _register_agency_done(self, agency_num: int) -> bool:
+        """
+        Returns True only for the agency that completes the set of
+        agencies done submitting bets, so the lottery is run once
+        """
+        with self._agency_done_submitting_lock:
+            if agency_num in self._agencies_done_submitting:
+                return False
+            self._agencies_done_submitting.add(agency_num)
+            return len(self._agencies_done_submitting) == self._total_agencies
 
-    def _send_results_to(self, agency: str, sock: socket):
+    def _on_lottery_completed(self):
+        """ Encode the results and wake up the requests waiting for them """
+        self._encode_results()
+        self._lottery_done.set()
+
+    def _send_results_to(self, agency: str, options: list[str], sock: socket):
         """
         Handle RESULTS_REQUEST from client
         
         Function that handles the RESULTS_REQUEST from a client.
-        It will wait until the lottery has been completed, and then
-        send the result to the client. 
+        If the lottery has not been completed, it replies
+        LOTERY_IN_PROGRESS so the client asks again later. With the
+        WAIT option the reply is held until the lottery is completed
+        or the results wait timeout expires.
         
         The result is a StringList message with the DNI of the
         winning bets from that company.
         If there are no winning bets, an empty list is sent.
         """
-        agency_num = int(agency)
-        if agency_num < 1 or agency_num > self._total_agencies:
+        if not self._is_valid_agency(agency):
             logging.error(f"action: enviar_resultados | result: fail | agencia: {agency}")
             return
         
         try:
-            if not self._lottery_completed:
-                ProtocolMessage.send_string_to_sock(
-                    sock,
-                    MSG_LOTERY_IN_PROGRESS
-                    )
-                return
-
-            winning_bets = []
-            for bet in load_bets():
-                if bet.agency == agency_num and has_won(bet):
-                    winning_bets.append(bet.document)
-
-            ProtocolMessage.send_string_list_to_sock(sock, winning_bets)
-            logging.info(f"action: enviar_resultados | result: success | agencia: {agency}")
+            if OPT_WAIT in options and not self._lottery_completed:
+                self._lottery_done.wait(self._results_wait_timeout)
+            sock.sendall(self._results_message_for(agency))
+            if self._lottery_completed:
+                logging.info(f"action: enviar_resultados | result: success | agencia: {agency}")
             
         except Exception as e:
-            logging.error(f"action: enviar_resultados | result: fail | agencia: {agency} | error: {e}")
\ No newline at end of file
+            logging.error(f"action: enviar_resultados | result: fail | agencia: {agency} | error: {e}")
+
+    def _results_message_for(self, agency: str) -> bytes:
+        """
+        Encoded reply to a RESULTS_REQUEST: LOTERY_IN_PROGRESS while
+        the lottery is not completed (SERVER_DRAINING if the server is
+        draining), the list of winning documents of the agency afterwards.
+        """
+        if not self._lottery_completed:
+            if self._draining.is_set():
+                return ProtocolMessage.encode_string(MSG_SERVER_DRAINING)
+            return ProtocolMessage.encode_string(MSG_LOTERY_IN_PROGRESS)
+
+        frames = self._results_frames
+        if frames is None:
+            frames = self._encode_results()
+        return frames[int(agency)]
+
+    def _encode_results(self) -> dict:
+        """
+        Encode the results of every agency once, when the lottery is
+        completed, so each RESULTS_REQUEST is served with the same
+        immutable frame instead of encoding its list again. The frames
+        are encoded again only if the winners change afterwards.
+        """
+        with self._winners_lock:
+            if self._results_frames is None:
+                self._results_frames = {
+                    agency: ProtocolMessage.encode_string_list(self._winners_by_agency.get(agency, []))
+                    for agency in range(1, self._total_agencies + 1)
+                }
+            return self._results_frames
+
+    def _index_winners(self, batch: BetBatch) -> list[str]:
+        """
+        Add the winning bets of a freshly stored batch to the
+        per-agency winners index, so results can be served from
+        memory without reading the storage file again. Returns the
+        documents of the winning bets.
+        """
+        mask = self._lottery_rule.mask(batch.numbers)
+        if 1 not in mask:
+            return []
+        documents = []
+        with self._winners_lock:
+            for i, won in enumerate(mask):
+                if won:
+                    documents.append(batch.document(i))
+                    self._winners_by_agency.setdefault(batch.agencies[i], []).append(documents[-1])
+            self._results_frames = None
+        return documents
+
+    def _recover(self):
+        """
+        Restore the state of a previous run of the server
+
+        With a journal, the bets committed and the winners of every
+        agency and the agencies done submitting are restored from it,
+        and whatever the storage file holds past the last checkpoint
+        (never acknowledged) is truncated, so resumed uploads do not
+        duplicate it. Without one, the winners index is rebuilt from
+        the storage file. A journal whose storage file was removed is
+        discarded, so removing the bets starts from scratch, and its
+        winners are rebuilt from the storage file if they were found
+        with another lottery rule.
+        """
+        journal = self._journal
+        if journal is not None and journal.storage_size is not None and not os.path.exists(self._storage_filepath):
+            logging.warning("action: recover_storage | result: fail | error: storage file not found, journal discarded")
+            journal.discard()
+        if journal is None or journal.storage_size is None:
+            self._rebuild_winners_index()
+        else:
+            size = os.path.getsize(self._storage_filepath)
+            if size > journal.storage_size:
+                logging.warning(f"action: recover_storage | result: in_progress | "
+                                f"truncated_bytes: {size - journal.storage_size}")
+                os.truncate(self._storage_filepath, journal.storage_size)
+            elif size < journal.storage_size:
+                logging.error(f"action: recover_storage | result: fail | "
+                              f"missing_bytes: {journal.storage_size - size}")
+            self._committed_bets = dict(journal.committed_bets)
+            if (journal.rule or str(DEFAULT_RULE)) == str(self._lottery_rule):
+                self._winners_by_agency = {agency: list(documents) for agency, documents in journal.winners.items()}
+            else:
+                logging.warning(f"action: recover_storage | result: in_progress | "
+                                f"lottery_rule: {self._lottery_rule} | previous_rule: {journal.rule}")
+                self._rebuild_winners_index()
+                journal.winners = {agency: list(documents) for agency, documents in self._winners_by_agency.items()}
+
+        if journal is not None:
+            for agency in sorted(journal.agencies_done):
+                self._restore_agency_done(str(agency))
+
+    def _load_bet_index(self) -> BetIndex:
+        """
+        Index of the bets already in the storage file (e.g. after a
+        restart), to drop duplicates of them. A binary bets log is
+        indexed batch by batch straight from its memory map. The keys
+        file of the index is written again from scratch.
+        """
+        index = BetIndex(bet_index_filepath(self._storage_filepath))
+        if not os.path.exists(self._storage_filepath):
+            return index
+        if is_bet_log(self._storage_filepath):
+            with BetLog(self._storage_filepath) as log:
+                for batch in log.batches():
+                    index.add_batch(batch)
+        else:
+            batch = BetBatch()
+            for bet in load_bets(self._storage_filepath):
+                batch.append(bet.agency, bet.first_name, bet.last_name, bet.document, bet.birthdate, bet.number)
+            index.add_batch(batch)
+        index.duplicates.clear()
+        logging.info(f"action: load_bet_index | result: success | apuestas: {len(index)}")
+        return index
+
+    def _rebuild_winners_index(self):
+        """
+        Rebuild the winners index from the storage file
+
+        Only needed when the server starts with bets already stored
+        (e.g. after a restart), since the in-memory index is lost, or
+        with another lottery rule than the journal's: no tally of the
+        numbers of every stored bet is kept to find the winners of a
+        new rule. A binary bets log is scanned through a memory map,
+        decoding only the documents of the winners.
+        """
+        if not os.path.exists(self._storage_filepath):
+            return
+        if is_bet_log(self._storage_filepath):
+            with BetLog(self._storage_filepath) as log:
+                self._winners_by_agency = log.winners(self._lottery_rule)
+            logging.info("action: rebuild_winners_index | result: success")
+            return
+        self._winners_by_agency = {}
+        for bet in load_bets(self._storage_filepath):
+            if self._lottery_rule.has_won(bet.number):
+                self._winners_by_agency.setdefault(bet.agency, []).append(bet.document)
+        logging.info("action: rebuild_winners_index | result: success")
@@ -0,0 +1,256 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+from multiprocessing import reduction
+
+from .communication import HEADER_SIZE, MAX_FRAME_SIZE, MSG_TIMEOUT, TYPE_STRING
+from .thread_pool import ThreadPool
+from .utils import STORAGE_FILEPATH
+
+""" Seconds a shard waits for a connection before checking if it was stopped. """
+HANDOVER_POLL_INTERVAL = 0.5
+""" Seconds between peeks at a first request that arrived only in part. """
+PEEK_RETRY_INTERVAL = 0.005
+
+
+def shard_storage_filepath(shard: int, filepath: str = STORAGE_FILEPATH) -> str:
+    """ Bets file of a shard, e.g. ./bets-0.csv """
+    root, ext = os.path.splitext(filepath)
+    return f"{root}-{shard}{ext}"
+
+
+def peek_exactly(sock: socket.socket, size: int, deadline: float) -> bytes:
+    """
+    Read `size` bytes of a socket without consuming them, waiting for
+    them until `deadline` (a time.monotonic() value). With a timeout the
+    socket is non-blocking, so MSG_WAITALL may return only what arrived
+    so far: the peek is repeated until the rest does. Raises
+    socket.timeout past the deadline and ConnectionError if the
+    connection is closed before anything arrives.
+    """
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout("Timed out waiting for the first request")
+        sock.settimeout(remaining)
+        data = sock.recv(size, socket.MSG_PEEK | socket.MSG_WAITALL)
+        if len(data) >= size:
+            return data
+        if not data:
+            raise ConnectionError("Connection closed before the first request")
+        # The socket stays readable with the part that arrived
+        time.sleep(PEEK_RETRY_INTERVAL)
+
+
+class ShardCoordinator:
+    """
+    State shared by every shard of a ShardedServer: which agencies are
+    done submitting bets and whether the lottery has been completed.
+    """
+
+    def __init__(self, ctx, total_agencies):
+        self._lock = ctx.Lock()
+        self._agencies_done = ctx.Array('b', total_agencies + 1, lock=False)
+        self._total_done = ctx.Value('i', 0, lock=False)
+        self._total_agencies = total_agencies
+        self.lottery_done = ctx.Event()
+
+    def agency_done(self, agency_num: int) -> bool:
+        """
+        Register that an agency is done submitting bets. Returns True
+        only for the call that completes the lottery, so the draw is
+        run once across all the shards.
+        """
+        with self._lock:
+            if self._agencies_done[agency_num]:
+                return False
+            self._agencies_done[agency_num] = 1
+            self._total_done.value += 1
+            if self._total_done.value < self._total_agencies:
+                return False
+        self.lottery_done.set()
+        return True
+
+
+class _HandedOverConnections:
+    """
+    Stand-in for the listening socket of a shard: accept() returns the
+    connections that the acceptor process hands over through a pipe.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._closed = False
+        self.on_acceptor_gone = None
+
+    def accept(self):
+        while not self._closed:
+            if not self._conn.poll(HANDOVER_POLL_INTERVAL):
+                continue
+            try:
+                sock = socket.socket(fileno=reduction.recv_handle(self._conn))
+            except EOFError:
+                self._closed = True
+                if self.on_acceptor_gone is not None:
+                    self.on_acceptor_gone()
+                break
+            try:
+                return sock, sock.getpeername()
+            except OSError:
+                sock.close()
+        self._conn.close()
+        raise OSError("server socket closed")
+
+    def close(self):
+        self._closed = True
+
+
+class _Shard:
+    """
+    Mixin for a Server (or AsyncServer) running as a shard of a
+    ShardedServer: connections come from the acceptor process, and
+    the completion of the lottery is tracked by the coordinator.
+    """
+
+    def __init__(self, listener, coordinator, *args, **kwargs):
+        self._listener = listener
+        self._coordinator = coordinator
+        super().__init__(*args, **kwargs)
+        listener.on_acceptor_gone = self.stop
+        threading.Thread(target=self.__wait_for_lottery, daemon=True).start()
+
+    def _create_server_socket(self, port, listen_backlog):
+        return self._listener
+
+    def _register_agency_done(self, agency_num: int) -> bool:
+        return self._coordinator.agency_done(agency_num)
+
+    def __wait_for_lottery(self):
+        """ Learn about a lottery completed by another shard """
+        self._coordinator.lottery_done.wait()
+        if not self._lottery_completed:
+            self._lottery_completed = True
+            self._on_lottery_completed()
+
+
+class ShardedServer:
+    """
+    Runs the server as N shard processes, so bets are parsed and
+    stored on several cores instead of a single GIL-bound process.
+
+    This process only accepts connections. It peeks the first request
+    of each one to learn the agency and hands the connection over to
+    the shard that owns it, (agency - 1) % N, which serves every
+    request of that connection. Each shard stores its bets in its own
+    file and keeps the winners of its agencies, while the coordinator
+    tracks the agencies done submitting across shards.
+    """
+
+    def __init__(self, server_class, shards, port, listen_backlog, total_agencies, **server_kwargs):
+        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server_socket.bind(('', port))
+        self._server_socket.listen(listen_backlog)
+        self.running = False
+
+        # Shards are forked before any thread is started
+        ctx = multiprocessing.get_context("fork")
+        self._coordinator = ShardCoordinator(ctx, total_agencies)
+        self._shards = []
+        for shard in range(shards):
+            acceptor_conn, shard_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=self.__run_shard,
+                args=(shard, shard_conn, server_class, port, listen_backlog, total_agencies, server_kwargs),
+                name=f"shard-{shard}",
+            )
+            self._shards.append((process, acceptor_conn, threading.Lock()))
+            process.start()
+            shard_conn.close()
+
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: self.stop())
+        self._thread_pool = ThreadPool(num_workers=total_agencies)
+
+    def __run_shard(self, shard, conn, server_class, port, listen_backlog, total_agencies, server_kwargs):
+        self._server_socket.close()
+        for _process, acceptor_conn, _lock in self._shards:
+            acceptor_conn.close()
+
+        if server_kwargs.get("metrics_port"):
+            # Every shard serves its own metrics, in consecutive ports
+            server_kwargs = dict(server_kwargs, metrics_port=server_kwargs["metrics_port"] + shard)
+        server_kwargs = dict(server_kwargs, storage_filepath=shard_storage_filepath(
+            shard, server_kwargs.get("storage_filepath", STORAGE_FILEPATH)))
+        shard_class = type(f"{server_class.__name__}Shard", (_Shard, server_class), {})
+        server = shard_class(_HandedOverConnections(conn), self._coordinator,
+                             port, listen_backlog, total_agencies, **server_kwargs)
+        logging.info(f"action: start_shard | result: success | shard: {shard} | pid: {os.getpid()}")
+        server.run()
+
+    def run(self):
+        """
+        Acceptor loop
+
+        Accepts connections and hands them to the routing workers
+        until the server is stopped
+        """
+        self.running = True
+        while self.running:
+            try:
+                c, addr = self._server_socket.accept()
+                logging.info(f'action: accept_connections | result: success | ip: {addr[0]}')
+                self._thread_pool.submit(self.__route_connection, c)
+            except OSError as e:
+                if self.running:
+                    logging.error(f"action: accept_connections | result: fail | error: {e}")
+
+    def __route_connection(self, sock: socket.socket):
+        """ Hand a connection over to the shard of its agency """
+        try:
+            request = self.__peek_first_request(sock)
+            agency = int(request.split(',')[1])
+            process, conn, lock = self._shards[(agency - 1) % len(self._shards)]
+            with lock:
+                reduction.send_handle(conn, sock.fileno(), process.pid)
+        except Exception as e:
+            if self.running:
+                logging.error(f"action: route_connection | result: fail | error: {e}")
+        finally:
+            sock.close()
+
+    def __peek_first_request(self, sock: socket.socket) -> str:
+        """
+        Read the first request of a connection without consuming it,
+        so the shard receives the connection as the client opened it
+        """
+        deadline = time.monotonic() + MSG_TIMEOUT
+        header = peek_exactly(sock, HEADER_SIZE, deadline)
+        if header[0:1] != TYPE_STRING:
+            raise ValueError("Invalid message type received for request")
+        length = struct.unpack('>I', header[1:])[0]
+        if length > MAX_FRAME_SIZE:
+            raise ValueError("Invalid data: request exceeds the maximum frame size")
+        request = peek_exactly(sock, HEADER_SIZE + length, deadline)[HEADER_SIZE:].decode('utf-8')
+        sock.settimeout(None)
+        return request
+
+    def stop(self):
+        """
+        Stop the server
+
+        Closes the server socket and stops every shard
+        """
+        self.running = False
+        self._server_socket.close()
+        logging.info("action: server_socket_closed | result: success")
+        for process, _conn, _lock in self._shards:
+            process.terminate()
+        for process, conn, _lock in self._shards:
+            process.join()
+            conn.close()
+        self._thread_pool.stop()
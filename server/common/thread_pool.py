@@ -1,37 +1,189 @@
+import collections
+import logging
 import threading
-import queue
+import time
+
+from .metrics import REGISTRY
+
+""" Backpressure policies, applied when the queue of a bounded pool is full. """
+POLICY_BLOCK = "block"    # submit waits until there is room
+POLICY_REJECT = "reject"  # submit returns False
+POLICY_SHED = "shed"      # submit calls on_rejected (e.g. to reply busy) and returns False
+POLICIES = (POLICY_BLOCK, POLICY_REJECT, POLICY_SHED)
+
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("thread_pool_queue_wait_seconds", "Time tasks wait for a worker")
+RUN_SECONDS = REGISTRY.histogram("thread_pool_run_seconds", "Time workers spend running a task")
+REJECTED = REGISTRY.counter("thread_pool_rejected_total", "Tasks rejected because the queue was full")
+
 
 class ThreadPool:
-    def __init__(self, num_workers, max_queue=0):
+    """
+    Pool of worker threads running submitted tasks in order
+
+    The pool starts with `num_workers` workers and grows up to
+    `max_workers` while tasks wait more than `grow_wait` seconds for a
+    worker. Workers above `num_workers` exit after `idle_timeout`
+    seconds without tasks.
+
+    With `max_queue` > 0 at most that many tasks wait in the queue, and
+    `policy` decides what happens with the ones submitted meanwhile.
+    """
+
+    def __init__(self, num_workers, max_queue=0, max_workers=0, policy=POLICY_BLOCK,
+                 on_rejected=None, grow_wait=0.005, idle_timeout=5.0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown thread pool policy: {policy}")
         self.num_workers = num_workers
-        self.task_queue = queue.Queue(maxsize=max_queue)
-        self.workers = []
-        self._init_workers()
+        self.max_workers = max(max_workers, num_workers)
+        self.max_queue = max_queue
+        self.policy = policy
+        self._on_rejected = on_rejected
+        self._grow_wait = grow_wait
+        self._idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._tasks = collections.deque()
+        self._workers = set()
+        self._idle_workers = 0
+        self._grow_timer = None
+        self._stopping = False
+        self._stats = collections.Counter()
+        with self._lock:
+            for _ in range(num_workers):
+                self._start_worker()
+
+    def _start_worker(self):
+        worker = threading.Thread(target=self._worker_loop, daemon=True)
+        self._workers.add(worker)
+        worker.start()
+
+    def submit(self, func, *args, bypass_limit=False) -> bool:
+        """
+        Queue `func(*args)` to be run by a worker. Returns False if the
+        task was not queued, because the queue was full (with the reject
+        and shed policies) or the pool is stopping.
 
-    def _init_workers(self):
-        for _ in range(self.num_workers):
-            worker = threading.Thread(target=self._worker_loop)
-            worker.start()
-            self.workers.append(worker)
+        `bypass_limit` queues the task even if the queue is full. It is
+        meant for tasks submitted by other tasks, which could otherwise
+        block every worker waiting for room in the queue.
+        """
+        with self._lock:
+            if self.max_queue > 0 and not bypass_limit and self.policy == POLICY_BLOCK:
+                while len(self._tasks) >= self.max_queue and not self._stopping:
+                    self._not_full.wait()
+            if self._stopping:
+                return False
+            if self.max_queue <= 0 or bypass_limit or len(self._tasks) < self.max_queue:
+                self._tasks.append((func, args, time.perf_counter()))
+                self._stats["submitted"] += 1
+                self._grow_if_waiting()
+                self._not_empty.notify()
+                return True
+            self._stats["rejected"] += 1
+            REJECTED.inc()
+
+        if self.policy == POLICY_SHED and self._on_rejected is not None:
+            try:
+                self._on_rejected(*args)
+            except Exception as e:
+                logging.error(f"action: shed_task | result: fail | error: {e}")
+        return False
+
+    def _grow_if_waiting(self):
+        """
+        Start a worker if the oldest task waited too long for one. If it
+        did not wait long enough yet, check again once it has, since no
+        task may be submitted or taken meanwhile (e.g. while every worker
+        is busy). Called with the lock held.
+        """
+        if len(self._workers) >= self.max_workers or not self._tasks or self._stopping:
+            return
+        if self._idle_workers > 0 and len(self._tasks) <= self._idle_workers:
+            return
+        waited = time.perf_counter() - self._tasks[0][2]
+        if waited >= self._grow_wait:
+            self._start_worker()
+        elif self._grow_timer is None:
+            self._grow_timer = threading.Timer(self._grow_wait - waited, self._grow_timer_expired)
+            self._grow_timer.daemon = True
+            self._grow_timer.start()
+
+    def _grow_timer_expired(self):
+        with self._lock:
+            self._grow_timer = None
+            self._grow_if_waiting()
 
     def _worker_loop(self):
+        worker = threading.current_thread()
         while True:
-            func, args = self.task_queue.get()
+            with self._lock:
+                self._idle_workers += 1
+                while not self._tasks and not self._stopping:
+                    timed_out = not self._not_empty.wait(self._idle_timeout)
+                    if timed_out and not self._tasks and len(self._workers) > self.num_workers:
+                        break
+                self._idle_workers -= 1
+                if not self._tasks:
+                    self._workers.discard(worker)
+                    return
+                func, args, enqueued = self._tasks.popleft()
+                self._not_full.notify()
+                waited = time.perf_counter() - enqueued
+                self._grow_if_waiting()
+
+            QUEUE_WAIT_SECONDS.observe(waited)
+            started = time.perf_counter()
             try:
-                if func is None:
-                    break
                 func(*args)
             except Exception as e:
-                print(f"Error processing task: {e}")
-            finally:
-                self.task_queue.task_done()
-
-    def submit(self, func, *args):
-        self.task_queue.put((func, args))
-        
-    def stop(self):
-        for _ in range(self.num_workers):
-            self.task_queue.put((None, None))
-        self.task_queue.join()
-        for worker in self.workers:
-            worker.join()
\ No newline at end of file
+                logging.error(f"action: run_task | result: fail | error: {e}")
+            elapsed = time.perf_counter() - started
+            RUN_SECONDS.observe(elapsed)
+            with self._lock:
+                self._stats["completed"] += 1
+                self._stats["wait_us"] += int(waited * 1e6)
+                self._stats["run_us"] += int(elapsed * 1e6)
+                self._stats["max_wait_us"] = max(self._stats["max_wait_us"], int(waited * 1e6))
+
+    def queue_depth(self) -> int:
+        return len(self._tasks)
+
+    def stats(self) -> dict:
+        """ Current size of the pool and totals of the tasks run so far """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(workers=len(self._workers), idle_workers=self._idle_workers, queued=len(self._tasks))
+        completed = stats.get("completed", 0)
+        stats["avg_wait_ms"] = stats.get("wait_us", 0) / completed / 1000 if completed else 0.0
+        stats["avg_run_ms"] = stats.get("run_us", 0) / completed / 1000 if completed else 0.0
+        return stats
+
+    def stop(self, timeout=None):
+        """
+        Stop the pool: tasks still queued are discarded, and the workers
+        exit once their current task finishes. Waits at most `timeout`
+        seconds (forever if None) for them.
+        """
+        with self._lock:
+            self._stopping = True
+            if self._grow_timer is not None:
+                self._grow_timer.cancel()
+                self._grow_timer = None
+            discarded = len(self._tasks)
+            self._tasks.clear()
+            workers = list(self._workers)
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        if discarded:
+            logging.debug(f"action: stop_thread_pool | result: in_progress | discarded_tasks: {discarded}")
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker in workers:
+            if worker is threading.current_thread():
+                continue
+            worker.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        busy = sum(worker.is_alive() for worker in workers if worker is not threading.current_thread())
+        if busy:
+            logging.warning(f"action: stop_thread_pool | result: fail | busy_workers: {busy}")
@@ -1,6 +1,12 @@
 import csv
 import datetime
+import io
+import re
 import time
+from array import array
+from operator import itemgetter
+
+from .communication import BET_BATCH_HEADER, BET_RECORD, iter_string_list
 
 
 """ Bets storage location. """
@@ -35,27 +41,324 @@ class Bet:
         parts = [part.strip() for part in parts]
         return Bet(agency, parts[0], parts[1], parts[2], parts[3], parts[4])
 
-""" Checks whether a bet won the prize or not. """
+""" Ordinal of 1970-01-01, the epoch of birthdates in BET_BATCH messages. """
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_MAX_ORDINAL = datetime.date.max.toordinal()
+""" Date ordinals by their utf-8 'YYYY-MM-DD' form, shared by all batches. """
+_BIRTHDATE_ORDINALS = {}
+""" Inverse of _BIRTHDATE_ORDINALS, filled as CSV rows are formatted. """
+_BIRTHDATE_TEXTS = {}
+""" Characters that make csv.writer quote a field (with the default dialect). """
+_CSV_SPECIAL_CHARACTERS = re.compile(rb'[",\r\n]')
+""" Bytes that continue a utf-8 character, so no text field can start with them. """
+_UTF8_CONTINUATION = re.compile(rb'[\x80-\xbf]')
+
+def _check_text(text: bytearray, offsets: array):
+    """
+    Raise ValueError unless every text field packed in `text` is valid
+    utf-8, so bets that could not be read back are never stored. The
+    buffer is decoded once: a field cut in the middle of a character
+    is caught by the next field starting with a continuation byte.
+    """
+    if text.isascii():
+        return
+    try:
+        str(text, 'utf-8')
+    except UnicodeDecodeError:
+        raise ValueError("Invalid data: text fields are not valid utf-8") from None
+    # First byte of every field (gathered in C), plus a padding byte for an empty last one
+    first_bytes = bytes(itemgetter(*offsets)(text + b'\0'))
+    if _UTF8_CONTINUATION.search(first_bytes):
+        raise ValueError("Invalid data: text fields are not valid utf-8")
+
+""" A batch of bets stored as parallel compact columns. """
+class BetBatch:
+    def __init__(self):
+        """
+        Numeric fields are kept in typed arrays (birthdates as date
+        ordinals) and the text fields of every bet are packed, in
+        order, into a single utf-8 buffer delimited by `_offsets`.
+        """
+        self.agencies = array('i')
+        self.numbers = array('i')
+        self.birthdates = array('i')
+        self._text = bytearray()
+        self._offsets = array('I', [0])
+
+    @staticmethod
+    def from_strings(agency: str, strings: list[str]) -> 'BetBatch':
+        """
+        Create a BetBatch from strings with the same format
+        expected by Bet.from_string.
+        """
+        batch = BetBatch()
+        agency_num = int(agency)
+        for string in strings:
+            parts = string.split(',')
+            if len(parts) != 5:
+                raise ValueError("Incorrect string format.")
+            batch.append(agency_num, parts[0].strip(), parts[1].strip(), parts[2].strip(),
+                         datetime.date.fromisoformat(parts[3].strip()), int(parts[4]))
+        return batch
+
+    @staticmethod
+    def from_string_list(agency: str, data: bytes) -> 'BetBatch':
+        """
+        Create a BetBatch straight from the body of a STRING_LIST
+        message with one bet line per string. Lines are parsed as
+        utf-8 bytes, so text fields are packed without ever being
+        decoded into Python strings.
+
+        Same as calling append_line for every line, with its body
+        inlined: this loop runs once per received bet. Text fields are
+        checked to be valid utf-8 once, for the whole batch.
+        """
+        batch = BetBatch()
+        agency_num = int(agency)
+        append_agency, append_number = batch.agencies.append, batch.numbers.append
+        append_birthdate, append_offset = batch.birthdates.append, batch._offsets.append
+        text, ordinals = batch._text, _BIRTHDATE_ORDINALS
+        # A single copy of the whole frame, instead of one per line
+        data = bytes(data)
+        for start, end in iter_string_list(data):
+            try:
+                first_name, last_name, document, birthdate, number = data[start:end].split(b',')
+            except ValueError:
+                raise ValueError("Incorrect string format.") from None
+            birthdate = birthdate.strip()
+            ordinal = ordinals.get(birthdate)
+            if ordinal is None:
+                ordinal = datetime.date.fromisoformat(birthdate.decode('utf-8')).toordinal()
+                ordinals[birthdate] = ordinal
+            append_number(int(number))
+            append_agency(agency_num)
+            append_birthdate(ordinal)
+            text += first_name.strip()
+            append_offset(len(text))
+            text += last_name.strip()
+            append_offset(len(text))
+            text += document.strip()
+            append_offset(len(text))
+        _check_text(text, batch._offsets)
+        return batch
+
+    @staticmethod
+    def from_bet_batch(data: bytes) -> 'BetBatch':
+        """
+        Create a BetBatch from the body of a BET_BATCH message. Each
+        record is unpacked in a single call and its text fields are
+        copied into the batch buffer as they are, then checked to be
+        valid utf-8 once, for the whole batch.
+        """
+        batch = BetBatch()
+        data = memoryview(data)
+        count, = BET_BATCH_HEADER.unpack_from(data, 0)
+        offset = BET_BATCH_HEADER.size
+        for _ in range(count):
+            if offset + BET_RECORD.size > len(data):
+                raise ValueError("Invalid data: incomplete bet record")
+            agency, number, days, first_len, last_len, doc_len = BET_RECORD.unpack_from(data, offset)
+            offset += BET_RECORD.size
+            end = offset + first_len + last_len + doc_len
+            if end > len(data):
+                raise ValueError("Invalid data: incomplete bet record")
+            ordinal = EPOCH_ORDINAL + days
+            if not 1 <= ordinal <= _MAX_ORDINAL:
+                raise ValueError("Invalid data: birthdate out of range")
+            batch.agencies.append(agency)
+            batch.numbers.append(number)
+            batch.birthdates.append(ordinal)
+            batch._text += data[offset:end]
+            text_len = len(batch._text)
+            batch._offsets.append(text_len - last_len - doc_len)
+            batch._offsets.append(text_len - doc_len)
+            batch._offsets.append(text_len)
+            offset = end
+        if offset != len(data):
+            raise ValueError("Invalid data: trailing bytes after bet records")
+        _check_text(batch._text, batch._offsets)
+        return batch
+
+    def append_line(self, agency: int, data: bytes, start: int, end: int):
+        """
+        Append the bet in the utf-8 line data[start:end], with the
+        same format expected by Bet.from_string.
+        """
+        parts = data[start:end].split(b',')
+        if len(parts) != 5:
+            raise ValueError("Incorrect string format.")
+        birthdate = parts[3].strip()
+        ordinal = _BIRTHDATE_ORDINALS.get(birthdate)
+        if ordinal is None:
+            ordinal = datetime.date.fromisoformat(birthdate.decode('utf-8')).toordinal()
+            _BIRTHDATE_ORDINALS[birthdate] = ordinal
+        self.agencies.append(agency)
+        self.numbers.append(int(parts[4]))
+        self.birthdates.append(ordinal)
+        for field in parts[0:3]:
+            self._text += field.strip()
+            self._offsets.append(len(self._text))
+
+    def append(self, agency: int, first_name: str, last_name: str, document: str,
+               birthdate: datetime.date, number: int):
+        self.agencies.append(agency)
+        self.numbers.append(number)
+        self.birthdates.append(birthdate.toordinal())
+        for field in (first_name, last_name, document):
+            self._text += field.encode('utf-8')
+            self._offsets.append(len(self._text))
+
+    def select(self, indexes) -> 'BetBatch':
+        """ New batch with only the bets at the given indexes, in that order. """
+        batch = BetBatch()
+        text, offsets = self._text, self._offsets
+        for i in indexes:
+            batch.agencies.append(self.agencies[i])
+            batch.numbers.append(self.numbers[i])
+            batch.birthdates.append(self.birthdates[i])
+            start = len(batch._text) - offsets[3 * i]
+            batch._text += text[offsets[3 * i]:offsets[3 * i + 3]]
+            batch._offsets.extend(start + offset for offset in offsets[3 * i + 1:3 * i + 4])
+        return batch
+
+    def _field(self, index: int, field: int) -> str:
+        start = self._offsets[3 * index + field]
+        end = self._offsets[3 * index + field + 1]
+        return self._text[start:end].decode('utf-8')
+
+    def document(self, index: int) -> str:
+        return self._field(index, 2)
+
+    def rows(self):
+        """
+        Yields every bet as a storage row, without building Bet objects.
+        """
+        for i in range(len(self)):
+            yield [self.agencies[i], self._field(i, 0), self._field(i, 1), self._field(i, 2),
+                   datetime.date.fromordinal(self.birthdates[i]), self.numbers[i]]
+
+    def csv_text(self) -> str:
+        """
+        The bets as the CSV rows csv.writer would write for rows(), but
+        formatted straight from the columns: birthdates are looked up
+        by ordinal and text fields are not decoded one by one. Batches
+        with a field that must be quoted go through csv.writer.
+        """
+        text, offsets = bytes(self._text), self._offsets
+        if _CSV_SPECIAL_CHARACTERS.search(text):
+            buffer = io.StringIO()
+            csv.writer(buffer, quoting=csv.QUOTE_MINIMAL).writerows(self.rows())
+            return buffer.getvalue()
+        birthdates = []
+        for ordinal in self.birthdates:
+            birthdate = _BIRTHDATE_TEXTS.get(ordinal)
+            if birthdate is None:
+                birthdate = _BIRTHDATE_TEXTS[ordinal] = datetime.date.fromordinal(ordinal).isoformat().encode('utf-8')
+            birthdates.append(birthdate)
+        return b"".join([
+            b"%d,%s,%s,%s,%s,%d\r\n" % (agency, text[offsets[3 * i]:offsets[3 * i + 1]],
+                                        text[offsets[3 * i + 1]:offsets[3 * i + 2]],
+                                        text[offsets[3 * i + 2]:offsets[3 * i + 3]], birthdates[i], number)
+            for i, (agency, number) in enumerate(zip(self.agencies, self.numbers))
+        ]).decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __getitem__(self, index: int) -> Bet:
+        """ Materializes the bet at `index` as a Bet. """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("bet index out of range")
+        bet = Bet.__new__(Bet)
+        bet.agency = self.agencies[index]
+        bet.first_name = self._field(index, 0)
+        bet.last_name = self._field(index, 1)
+        bet.document = self._field(index, 2)
+        bet.birthdate = datetime.date.fromordinal(self.birthdates[index])
+        bet.number = self.numbers[index]
+        return bet
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+"""
+Checks whether a bet won the prize or not, with the legacy fixed rule
+(LOTTERY_WINNER_NUMBER). The server uses the configured LOTTERY_RULE
+instead (see lottery.py), so this one ignores it.
+"""
 def has_won(bet: Bet) -> bool:
     return bet.number == LOTTERY_WINNER_NUMBER
 
 """
-Persist the information of each bet in the STORAGE_FILEPATH file.
+Checks which bets of a batch won the prize, all at once, with the
+legacy fixed rule as has_won does.
+Returns a mask with a truthy value for each winning bet.
+"""
+def has_won_batch(batch: BetBatch) -> bytearray:
+    return number_mask(batch.numbers, LOTTERY_WINNER_NUMBER)
+
+"""
+Mask with a truthy value for each number of the column equal to
+`number`. The number is searched over the raw bytes of the column,
+so the scan runs in C instead of once per bet.
+"""
+def number_mask(numbers: array, number: int) -> bytearray:
+    mask = bytearray(len(numbers))
+    itemsize = numbers.itemsize
+    raw = numbers.tobytes()
+    needle = array(numbers.typecode, [number]).tobytes()
+    pos = raw.find(needle)
+    while pos != -1:
+        if pos % itemsize == 0:
+            mask[pos // itemsize] = 1
+        pos = raw.find(needle, pos + 1)
+    return mask
+
+"""
+File the server stores the bets in: the binary bets log if there is one
+(STORAGE_FORMAT = binary, as in config.ini), STORAGE_FILEPATH otherwise.
+"""
+def storage_filepath() -> str:
+    from .bet_log import BET_LOG_FILEPATH, is_bet_log
+    return BET_LOG_FILEPATH if is_bet_log(BET_LOG_FILEPATH) else STORAGE_FILEPATH
+
+"""
+Persist the information of each bet in the storage file (see
+storage_filepath), or in the given one, in its format.
 Not thread-safe/process-safe.
 """
-def store_bets(bets: list[Bet]) -> None:
-    with open(STORAGE_FILEPATH, 'a+') as file:
+def store_bets(bets: list[Bet], filepath: str = None) -> None:
+    from .bet_log import encode_block, is_bet_log, open_for_append
+    filepath = filepath or storage_filepath()
+    if is_bet_log(filepath):
+        batch = BetBatch()
+        for bet in bets:
+            batch.append(bet.agency, bet.first_name, bet.last_name, bet.document, bet.birthdate, bet.number)
+        with open_for_append(filepath) as file:
+            file.write(encode_block(batch))
+        return
+    with open(filepath, 'a+') as file:
         writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
         for bet in bets:
             writer.writerow([bet.agency, bet.first_name, bet.last_name,
                              bet.document, bet.birthdate, bet.number])
 
 """
-Loads the information all the bets in the STORAGE_FILEPATH file.
+Loads the information all the bets in the storage file (see
+storage_filepath), or in the given one, CSV or binary bets log.
 Not thread-safe/process-safe.
 """
-def load_bets() -> list[Bet]:
-    with open(STORAGE_FILEPATH, 'r') as file:
+def load_bets(filepath: str = None) -> list[Bet]:
+    from .bet_log import BetLog, is_bet_log
+    filepath = filepath or storage_filepath()
+    if is_bet_log(filepath):
+        with BetLog(filepath) as log:
+            yield from log.bets()
+        return
+    with open(filepath, 'r') as file:
         reader = csv.reader(file, quoting=csv.QUOTE_MINIMAL)
         for row in reader:
             yield Bet(row[0], row[1], row[2], row[3], row[4], row[5])
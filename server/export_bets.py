@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Export a binary bets log to CSV, with the same rows as bets.csv
+
+Usage: python export_bets.py bets.bin --output bets.csv [--agency 1]
+"""
+
+import argparse
+import csv
+import sys
+
+from common.bet_log import BET_LOG_FILEPATH, BetLog
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Export a binary bets log to CSV")
+    parser.add_argument("log", nargs="?", default=BET_LOG_FILEPATH, help="bets log to export")
+    parser.add_argument("--output", help="CSV file to write (default: stdout)")
+    parser.add_argument("--agency", type=int, help="export only the bets of this agency")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    output = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        writer = csv.writer(output, quoting=csv.QUOTE_MINIMAL)
+        with BetLog(args.log) as log:
+            for batch in log.batches(args.agency):
+                writer.writerows(row for row in batch.rows() if args.agency is None or row[0] == args.agency)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,21 @@
 
 from configparser import ConfigParser
 from common.server import Server
+from common.async_server import AsyncServer
+from common.bet_log import BET_LOG_FILEPATH
+from common.bet_writer import FORMAT_BINARY, STORAGE_FORMATS
+from common.lottery import parse_rule
+from common.sharded_server import ShardedServer
+from common.thread_pool import POLICIES
+from common.utils import STORAGE_FILEPATH
 import logging
 import os
 
+SERVER_MODES = {
+    "threads": Server,
+    "async": AsyncServer,
+}
+
 
 def initialize_config():
     """ Parse env variables or config file to find program config params
@@ -27,6 +39,34 @@ def initialize_config():
         config_params["listen_backlog"] = int(os.getenv('SERVER_LISTEN_BACKLOG', config["DEFAULT"]["SERVER_LISTEN_BACKLOG"]))
         config_params["logging_level"] = os.getenv('LOGGING_LEVEL', config["DEFAULT"]["LOGGING_LEVEL"])
         config_params["total_agencies"] = int(os.getenv('TOTAL_AGENCIES', config["DEFAULT"]["TOTAL_AGENCIES"]))
+        config_params["server_mode"] = os.getenv('SERVER_MODE', config["DEFAULT"]["SERVER_MODE"])
+        if config_params["server_mode"] not in SERVER_MODES:
+            raise ValueError(f"invalid SERVER_MODE '{config_params['server_mode']}'")
+        config_params["flush_bytes"] = int(os.getenv('STORAGE_FLUSH_BYTES', config["DEFAULT"]["STORAGE_FLUSH_BYTES"]))
+        config_params["flush_interval"] = float(os.getenv('STORAGE_FLUSH_INTERVAL', config["DEFAULT"]["STORAGE_FLUSH_INTERVAL"]))
+        config_params["fsync"] = parse_bool(os.getenv('STORAGE_FSYNC', config["DEFAULT"]["STORAGE_FSYNC"]))
+        config_params["storage_format"] = os.getenv('STORAGE_FORMAT', config["DEFAULT"]["STORAGE_FORMAT"])
+        if config_params["storage_format"] not in STORAGE_FORMATS:
+            raise ValueError(f"invalid STORAGE_FORMAT '{config_params['storage_format']}'")
+        config_params["journal"] = parse_bool(os.getenv('STORAGE_JOURNAL', config["DEFAULT"]["STORAGE_JOURNAL"]))
+        config_params["dedup"] = parse_bool(os.getenv('STORAGE_DEDUP', config["DEFAULT"]["STORAGE_DEDUP"]))
+        config_params["lottery_rule"] = parse_rule(os.getenv('LOTTERY_RULE', config["DEFAULT"]["LOTTERY_RULE"]))
+        config_params["results_wait_timeout"] = float(os.getenv('RESULTS_WAIT_TIMEOUT', config["DEFAULT"]["RESULTS_WAIT_TIMEOUT"]))
+        config_params["drain_timeout"] = float(os.getenv('SERVER_DRAIN_TIMEOUT', config["DEFAULT"]["SERVER_DRAIN_TIMEOUT"]))
+        config_params["metrics_port"] = int(os.getenv('METRICS_PORT', config["DEFAULT"]["METRICS_PORT"]))
+        config_params["metrics_log_interval"] = float(os.getenv('METRICS_LOG_INTERVAL', config["DEFAULT"]["METRICS_LOG_INTERVAL"]))
+        config_params["batch_log_sample"] = int(os.getenv('BATCH_LOG_SAMPLE', config["DEFAULT"]["BATCH_LOG_SAMPLE"]))
+        config_params["pool_max_workers"] = int(os.getenv('THREAD_POOL_MAX_WORKERS', config["DEFAULT"]["THREAD_POOL_MAX_WORKERS"]))
+        config_params["pool_max_queue"] = int(os.getenv('THREAD_POOL_MAX_QUEUE', config["DEFAULT"]["THREAD_POOL_MAX_QUEUE"]))
+        config_params["pool_policy"] = os.getenv('THREAD_POOL_POLICY', config["DEFAULT"]["THREAD_POOL_POLICY"])
+        if config_params["pool_policy"] not in POLICIES:
+            raise ValueError(f"invalid THREAD_POOL_POLICY '{config_params['pool_policy']}'")
+        config_params["parser_processes"] = int(os.getenv('PARSER_PROCESSES', config["DEFAULT"]["PARSER_PROCESSES"]))
+        if config_params["parser_processes"] < 0:
+            raise ValueError(f"invalid PARSER_PROCESSES '{config_params['parser_processes']}'")
+        config_params["shards"] = int(os.getenv('SERVER_SHARDS', config["DEFAULT"]["SERVER_SHARDS"]))
+        if config_params["shards"] < 1:
+            raise ValueError(f"invalid SERVER_SHARDS '{config_params['shards']}'")
     except KeyError as e:
         raise KeyError("Key was not found. Error: {} .Aborting server".format(e))
     except ValueError as e:
@@ -35,22 +75,80 @@ def initialize_config():
     return config_params
 
 
+def parse_bool(value):
+    """ Parse a boolean config param, raising ValueError if it is not one """
+    if value.lower() in ("true", "yes", "1"):
+        return True
+    if value.lower() in ("false", "no", "0"):
+        return False
+    raise ValueError(f"invalid boolean '{value}'")
+
+
 def main():
     config_params = initialize_config()
     logging_level = config_params["logging_level"]
     port = config_params["port"]
     listen_backlog = config_params["listen_backlog"]
     total_agencies = config_params["total_agencies"]
+    server_mode = config_params["server_mode"]
+    flush_bytes = config_params["flush_bytes"]
+    flush_interval = config_params["flush_interval"]
+    fsync = config_params["fsync"]
+    results_wait_timeout = config_params["results_wait_timeout"]
+    drain_timeout = config_params["drain_timeout"]
+    shards = config_params["shards"]
+    metrics_port = config_params["metrics_port"]
+    metrics_log_interval = config_params["metrics_log_interval"]
+    batch_log_sample = config_params["batch_log_sample"]
+    pool_max_workers = config_params["pool_max_workers"]
+    pool_max_queue = config_params["pool_max_queue"]
+    pool_policy = config_params["pool_policy"]
+    parser_processes = config_params["parser_processes"]
+    storage_format = config_params["storage_format"]
+    journal = config_params["journal"]
+    lottery_rule = config_params["lottery_rule"]
+    dedup = config_params["dedup"]
 
     initialize_log(logging_level)
 
     # Log config parameters at the beginning of the program to verify the configuration
     # of the component
     logging.debug(f"action: config | result: success | port: {port} | "
-                  f"listen_backlog: {listen_backlog} | logging_level: {logging_level}")
+                  f"listen_backlog: {listen_backlog} | logging_level: {logging_level} | "
+                  f"server_mode: {server_mode} | flush_bytes: {flush_bytes} | "
+                  f"flush_interval: {flush_interval} | fsync: {fsync} | "
+                  f"results_wait_timeout: {results_wait_timeout} | drain_timeout: {drain_timeout} | shards: {shards} | "
+                  f"metrics_port: {metrics_port} | metrics_log_interval: {metrics_log_interval} | "
+                  f"batch_log_sample: {batch_log_sample} | pool_max_workers: {pool_max_workers} | "
+                  f"pool_max_queue: {pool_max_queue} | pool_policy: {pool_policy} | "
+                  f"parser_processes: {parser_processes} | storage_format: {storage_format} | "
+                  f"journal: {journal} | lottery_rule: {lottery_rule} | dedup: {dedup}")
 
     # Initialize server and start server loop
-    server = Server(port, listen_backlog, total_agencies)
+    server_options = {
+        "flush_bytes": flush_bytes,
+        "flush_interval": flush_interval,
+        "fsync": fsync,
+        "storage_format": storage_format,
+        "storage_filepath": BET_LOG_FILEPATH if storage_format == FORMAT_BINARY else STORAGE_FILEPATH,
+        "journal": journal,
+        "lottery_rule": lottery_rule,
+        "dedup": dedup,
+        "results_wait_timeout": results_wait_timeout,
+        "drain_timeout": drain_timeout,
+        "metrics_port": metrics_port,
+        "metrics_log_interval": metrics_log_interval,
+        "batch_log_sample": batch_log_sample,
+        "pool_max_workers": pool_max_workers,
+        "pool_max_queue": pool_max_queue,
+        "pool_policy": pool_policy,
+        "parser_processes": parser_processes,
+    }
+    if shards > 1:
+        server = ShardedServer(SERVER_MODES[server_mode], shards, port, listen_backlog,
+                               total_agencies, **server_options)
+    else:
+        server = SERVER_MODES[server_mode](port, listen_backlog, total_agencies, **server_options)
     server.run()
 
 def initialize_log(logging_level):
@@ -1,6 +1,40 @@
 from common.utils import *
+from common.bet_writer import FORMAT_BINARY, BetWriter
+from common import bet_index
+from common.bet_index import BetIndex
+from common.bet_log import BET_LOG_FILEPATH, BetLog, open_for_append
+from common.journal import Journal, journal_filepath
+from common.communication import (ProtocolMessage, FrameReader, HEADER_SIZE, MAX_DECOMPRESSED_SIZE, MAX_FRAME_SIZE,
+                                  TYPE_COMPRESSED, TYPE_STRING_LIST)
+from common.sharded_server import ShardCoordinator, peek_exactly
+from common.server import AckSender, Server, upload_key
+from common.async_server import AsyncServer
+from common.lottery import parse_rule
+from common.batch_parser import ParsedBatches, parse_batch
+from common.metrics import Registry
+from common.thread_pool import POLICY_SHED, ThreadPool
+import benchmark
+import concurrent.futures
+import importlib.util
+import io
+import multiprocessing
+import threading
 import os
+import select
+import socket
+import tempfile
+import time
 import unittest
+import unittest.mock
+import zlib
+
+def assert_equal_bets(test, b1, b2):
+    test.assertEqual(b1.agency, b2.agency)
+    test.assertEqual(b1.first_name, b2.first_name)
+    test.assertEqual(b1.last_name, b2.last_name)
+    test.assertEqual(b1.document, b2.document)
+    test.assertEqual(b1.birthdate, b2.birthdate)
+    test.assertEqual(b1.number, b2.number)
 
 class TestUtils(unittest.TestCase):
 
@@ -31,7 +65,7 @@ class TestUtils(unittest.TestCase):
         from_load = list(load_bets())
 
         self.assertEqual(1, len(from_load))
-        self._assert_equal_bets(to_store[0], from_load[0])
+        assert_equal_bets(self, to_store[0], from_load[0])
 
 
     def test_store_bets_and_load_bets_keeps_registry_order(self):
@@ -43,16 +77,874 @@ class TestUtils(unittest.TestCase):
         from_load = list(load_bets())
 
         self.assertEqual(2, len(from_load))
-        self._assert_equal_bets(to_store[0], from_load[0])
-        self._assert_equal_bets(to_store[1], from_load[1])
-
-    def _assert_equal_bets(self, b1, b2):
-        self.assertEqual(b1.agency, b2.agency)
-        self.assertEqual(b1.first_name, b2.first_name)
-        self.assertEqual(b1.last_name, b2.last_name)
-        self.assertEqual(b1.document, b2.document)
-        self.assertEqual(b1.birthdate, b2.birthdate)
-        self.assertEqual(b1.number, b2.number)
+        assert_equal_bets(self, to_store[0], from_load[0])
+        assert_equal_bets(self, to_store[1], from_load[1])
+
+    def test_bet_batch_keeps_fields_data(self):
+        batch = BetBatch.from_strings('1', ['first, last, 10000000, 2000-12-20, 7500'])
+        self.assertEqual(1, len(batch))
+        assert_equal_bets(self, Bet('1', 'first', 'last', '10000000','2000-12-20', 7500), batch[0])
+
+    def test_bet_batch_from_string_list_body_keeps_fields_data(self):
+        lines = ['first, last, 10000000, 2000-12-20, 7500', 'Nicolás,Peña,10000001,1999-01-02,7574']
+        body = ProtocolMessage.encode_string_list(lines)[HEADER_SIZE:]
+        batch = BetBatch.from_string_list('1', memoryview(body))
+
+        self.assertEqual(2, len(batch))
+        expected = BetBatch.from_strings('1', lines)
+        assert_equal_bets(self, expected[0], batch[0])
+        assert_equal_bets(self, expected[1], batch[1])
+
+    def test_bet_batch_from_string_list_rejects_text_that_is_not_utf8(self):
+        for line in (b'\xff\xfe,last,10000000,2000-12-20,7500', b'first\xc3,\xb1last,10000000,2000-12-20,7500'):
+            body = len(line).to_bytes(4, byteorder='big') + line
+            with self.assertRaises(ValueError):
+                BetBatch.from_string_list('1', body)
+
+    def test_frame_larger_than_the_maximum_is_rejected_before_its_body(self):
+        server, client = socket.socketpair()
+        with server, client:
+            client.sendall(TYPE_STRING_LIST + (MAX_FRAME_SIZE + 1).to_bytes(4, byteorder='big'))
+            with self.assertRaises(ValueError):
+                FrameReader(server).read_frame()
+
+    def test_bet_batch_from_bet_batch_body_keeps_fields_data(self):
+        days = datetime.date(2000, 12, 20).toordinal() - EPOCH_ORDINAL
+        message = ProtocolMessage.encode_bet_batch([(1, 'first', 'last', '10000000', days, 7500)])
+        batch = BetBatch.from_bet_batch(message[HEADER_SIZE:])
+
+        self.assertEqual(1, len(batch))
+        assert_equal_bets(self, Bet('1', 'first', 'last', '10000000','2000-12-20', 7500), batch[0])
+
+    def test_bet_batch_from_bet_batch_rejects_text_that_is_not_utf8(self):
+        first_name = b'\xff\xfe'
+        body = (BET_BATCH_HEADER.pack(1) + BET_RECORD.pack(1, 7500, 0, len(first_name), 4, 8)
+                + first_name + b'last10000000')
+        with self.assertRaises(ValueError):
+            BetBatch.from_bet_batch(body)
+
+    def test_compressed_batch_is_parsed_as_the_batch_it_carries(self):
+        days = datetime.date(2000, 12, 20).toordinal() - EPOCH_ORDINAL
+        message = ProtocolMessage.encode_bet_batch([(1, 'first', 'last', '10000000', days, 7500)] * 50)
+        compressed = ProtocolMessage.encode_compressed(message)
+        self.assertLess(len(compressed), len(message))
+        batch, _seconds = parse_batch('1', compressed[0:1], memoryview(compressed)[HEADER_SIZE:])
+
+        self.assertEqual(50, len(batch))
+        assert_equal_bets(self, Bet('1', 'first', 'last', '10000000','2000-12-20', 7500), batch[49])
+        nested = ProtocolMessage.encode_compressed(compressed)
+        with self.assertRaises(ValueError):
+            parse_batch('1', nested[0:1], nested[HEADER_SIZE:])
+
+    def test_bet_batch_csv_text_matches_csv_writer_rows(self):
+        for names in (('first', 'last'), ('Nicolás', 'Peña, "Jr"')):
+            batch = BetBatch()
+            batch.append(1, names[0], names[1], '10000000', datetime.date(2000, 12, 20), 7500)
+            batch.append(2, 'x', 'y', '10000001', datetime.date(1999, 1, 2), 7574)
+            buffer = io.StringIO()
+            csv.writer(buffer, quoting=csv.QUOTE_MINIMAL).writerows(batch.rows())
+            self.assertEqual(buffer.getvalue(), batch.csv_text())
+
+    def test_has_won_batch_marks_only_winner_numbers(self):
+        batch = BetBatch.from_strings('1', [
+            f'first_0,last_0,10000000,2000-12-20,{LOTTERY_WINNER_NUMBER}',
+            f'first_1,last_1,10000001,2000-12-21,{LOTTERY_WINNER_NUMBER + 1}',
+            f'first_2,last_2,10000002,2000-12-22,{LOTTERY_WINNER_NUMBER}',
+        ])
+        self.assertEqual([1, 0, 1], list(has_won_batch(batch)))
+
+class TestBetWriter(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(STORAGE_FILEPATH):
+            os.remove(STORAGE_FILEPATH)
+
+    def test_sync_callback_runs_after_bets_are_stored(self):
+        writer = BetWriter(STORAGE_FILEPATH, flush_interval=0.01)
+        stored = []
+        writer.write([Bet('1', 'first_0', 'last_0', '10000000','2000-12-20', 7500)])
+        writer.write([Bet('2', 'first_1', 'last_1', '10000001','2000-12-21', 7501)])
+        writer.sync(lambda: stored.extend(load_bets()))
+        writer.close()
+
+        self.assertEqual(2, len(stored))
+        self.assertEqual('10000000', stored[0].document)
+        self.assertEqual(2, stored[1].agency)
+
+    def test_batch_that_cannot_be_written_fails_and_the_next_ones_of_its_upload_too(self):
+        writer = BetWriter(STORAGE_FILEPATH)
+        results = []
+        def write(upload, document):
+            batch = BetBatch.from_strings(upload, [f'first,last,{document},2000-12-20,7500'])
+            if document == 'bad':
+                batch._text[0:1] = b'\xff'
+            writer.write(batch, lambda: results.append((document, 'stored')),
+                         on_failed=lambda _error: results.append((document, 'failed')), upload=upload)
+        write('1', 'bad')
+        write('1', '10000001')
+        write('2', '10000002')
+        writer.reset('1')
+        write('1', '10000003')
+        writer.sync(lambda: results.append(('sync', 'done')))
+        writer.close()
+
+        self.assertEqual([('bad', 'failed'), ('10000001', 'failed'), ('10000002', 'stored'),
+                          ('10000003', 'stored'), ('sync', 'done')], results)
+        self.assertEqual(['10000002', '10000003'], [bet.document for bet in load_bets()])
+
+    def test_failed_flush_runs_failure_callbacks_and_truncates_what_it_wrote(self):
+        writer = BetWriter(STORAGE_FILEPATH)
+        results = []
+        flushed = threading.Event()
+        writer.write([Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)], upload='1')
+        writer.sync(flushed.set)
+        flushed.wait()
+        writer._file = _FullDiskFile(writer._file)
+        writer.write([Bet('1', 'first', 'last', '10000001', '2000-12-20', 7500)], lambda: results.append('acked'),
+                     on_failed=results.append, upload='1')
+        writer.reset('1')
+        writer.write([Bet('1', 'first', 'last', '10000002', '2000-12-20', 7500)], lambda: results.append('acked'),
+                     upload='1')
+        writer.close()
+
+        self.assertIsInstance(results[0], OSError)
+        self.assertEqual('acked', results[1])
+        self.assertEqual(['10000000', '10000002'], [bet.document for bet in load_bets()])
+
+class _FullDiskFile:
+    """ Storage file whose next write only writes half of the data before failing """
+
+    def __init__(self, file):
+        self._file = file
+
+    def write(self, data):
+        self._file.write(data[:len(data) // 2])
+        self._file.flush()
+        raise OSError(28, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+class TestBetLog(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists(BET_LOG_FILEPATH):
+            os.remove(BET_LOG_FILEPATH)
+
+    def _write_log(self):
+        writer = BetWriter(BET_LOG_FILEPATH, storage_format=FORMAT_BINARY)
+        writer.write(BetBatch.from_strings('1', ['Nicolás,Peña,10000000,2000-12-20,7574', 'a,b,10000001,1999-01-02,1']))
+        writer.write([Bet('2', 'first', 'last', '10000002', '2001-02-03', LOTTERY_WINNER_NUMBER)])
+        writer.write(BetBatch.from_strings('1', ['c,d,10000003,1998-03-04,2']))
+        writer.close()
+
+    def test_load_bets_reads_binary_log_in_order(self):
+        self._write_log()
+        bets = list(load_bets(BET_LOG_FILEPATH))
+
+        self.assertEqual(['10000000', '10000001', '10000002', '10000003'], [bet.document for bet in bets])
+        assert_equal_bets(self, Bet('1', 'Nicolás', 'Peña', '10000000', '2000-12-20', 7574), bets[0])
+        self.assertEqual(2, bets[2].agency)
+
+    def test_winners_and_bets_by_agency(self):
+        self._write_log()
+        with BetLog(BET_LOG_FILEPATH) as log:
+            self.assertEqual({1: ['10000000'], 2: ['10000002']}, log.winners())
+            self.assertEqual(['10000000', '10000001', '10000003'], [bet.document for bet in log.bets(1)])
+
+    def test_store_bets_and_load_bets_use_the_binary_log_when_the_server_stores_bets_there(self):
+        self._write_log()
+        store_bets([Bet('3', 'e', 'f', '10000004', '1997-04-05', 3)])
+
+        self.assertEqual(BET_LOG_FILEPATH, storage_filepath())
+        self.assertFalse(os.path.exists(STORAGE_FILEPATH))
+        bets = list(load_bets())
+        self.assertEqual(['10000000', '10000001', '10000002', '10000003', '10000004'], [bet.document for bet in bets])
+        assert_equal_bets(self, Bet('3', 'e', 'f', '10000004', '1997-04-05', 3), bets[4])
+
+    def test_incomplete_last_block_is_truncated_before_appending(self):
+        self._write_log()
+        size = os.path.getsize(BET_LOG_FILEPATH)
+        with open(BET_LOG_FILEPATH, 'r+b') as file:
+            file.truncate(size - 3)
+        open_for_append(BET_LOG_FILEPATH).close()
+
+        with BetLog(BET_LOG_FILEPATH) as log:
+            self.assertEqual(3, len(log))
+            self.assertEqual(log.size, log.valid_size)
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.filepath = journal_filepath(STORAGE_FILEPATH)
+
+    def tearDown(self):
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def test_replay_restores_committed_groups_only(self):
+        journal = Journal(self.filepath)
+        journal.compact(0)
+        journal.commit([('1', '1', 100, []), ('2/0/2', '2', 50, ['10000000'])], 1000)
+        journal.agency_done('1')
+        journal.commit([('1', '1', 20, ['10000001'])], 1200)
+        journal.close()
+        with open(self.filepath, 'a') as file:
+            file.write("BETS,2/1/2,70\nWINNER,2,10000002\nSIZE,14")
+
+        journal = Journal(self.filepath)
+        self.assertEqual({'1': 120, '2/0/2': 50}, journal.committed_bets)
+        self.assertEqual({1: ['10000001'], 2: ['10000000']}, journal.winners)
+        self.assertEqual({1}, journal.agencies_done)
+        self.assertEqual(1200, journal.storage_size)
+
+    def test_compact_keeps_the_replayed_state(self):
+        journal = Journal(self.filepath)
+        journal.compact(0)
+        for _ in range(10):
+            journal.commit([('3', '3', 10, ['10000003'])], 500)
+        journal.agency_done('3')
+        journal.close()
+
+        journal = Journal(self.filepath)
+        journal.compact(journal.storage_size)
+        journal.close()
+        with open(self.filepath) as file:
+            self.assertEqual(13, len(file.readlines()))
+        journal = Journal(self.filepath)
+        self.assertEqual({'3': 100}, journal.committed_bets)
+        self.assertEqual(10, len(journal.winners[3]))
+        self.assertEqual({3}, journal.agencies_done)
+        self.assertEqual(500, journal.storage_size)
+
+    def test_documents_that_would_split_a_record_are_replayed_as_written(self):
+        documents = ['1,2', '3\n4', '5\r6', '7%2C8']
+        journal = Journal(self.filepath)
+        journal.compact(0)
+        journal.commit([('1', '1', 4, documents)], 100)
+        journal.close()
+
+        journal = Journal(self.filepath)
+        self.assertEqual({1: documents}, journal.winners)
+        self.assertEqual(100, journal.storage_size)
+        journal.compact(journal.storage_size)
+        journal.close()
+        self.assertEqual({1: documents}, Journal(self.filepath).winners)
+
+class TestBetIndex(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+
+    def _index(self, capacity):
+        index = BetIndex(os.path.join(self._dir.name, 'bets.csv.keys'), capacity=capacity)
+        self.addCleanup(index.close)
+        return index
+
+    def test_duplicated_bets_are_dropped_and_counted_by_agency(self):
+        index = self._index(4)
+        first = BetBatch.from_strings('1', [f'A,B,{doc},2000-01-01,{doc % 3}' for doc in range(10)])
+        self.assertIs(first, index.add_batch(first))
+        again = BetBatch.from_strings('1', ['A,B,3,2000-01-01,0', 'C,D,3,2001-02-03,1', 'C,D,3,2001-02-03,1'])
+        unique = index.add_batch(again)
+        self.assertEqual([('C', 'D', '3', datetime.date(2001, 2, 3), 1)],
+                         [(b.first_name, b.last_name, b.document, b.birthdate, b.number) for b in unique])
+        self.assertEqual(11, len(index))
+        self.assertEqual({1: 2}, index.duplicates)
+
+    def test_bets_with_the_same_fingerprint_are_told_apart_by_their_key(self):
+        index = self._index(4)
+        batch = BetBatch.from_strings('1', [f'A,B,{doc},2000-01-01,7574' for doc in range(6)])
+        # Every key gets the same fingerprint
+        with unittest.mock.patch.object(bet_index, 'hash', lambda _key: 42, create=True):
+            self.assertIs(batch, index.add_batch(batch))
+            again = BetBatch.from_strings('1', ['A,B,3,2000-01-01,7574', 'A,B,6,2000-01-01,7574'])
+            self.assertEqual(['6'], [bet.document for bet in index.add_batch(again)])
+            index.discard_batch(batch.select([0, 1]))
+            self.assertEqual(5, len(index))
+            self.assertEqual(['0', '1'], [bet.document for bet in index.add_batch(batch)])
+        self.assertEqual({1: 5}, index.duplicates)
+
+class TestLotteryRules(unittest.TestCase):
+
+    def test_rules_mark_the_winning_numbers_of_a_column(self):
+        numbers = array('i', [7574, 174, 7575, 74, 7574])
+        self.assertEqual([1, 0, 0, 0, 1], list(parse_rule('number:7574').mask(numbers)))
+        self.assertEqual([1, 1, 0, 1, 1], list(parse_rule('ending:74').mask(numbers)))
+        self.assertEqual('ending:74', str(parse_rule('ending:74')))
+        with self.assertRaises(ValueError):
+            parse_rule('random:3')
+
+class TestUploadKey(unittest.TestCase):
+
+    def test_streams_of_an_agency_are_tracked_apart(self):
+        self.assertEqual('3', upload_key('3', ['BET_BATCH', 'ACK']))
+        self.assertEqual('3/1/4', upload_key('3', ['ACK', 'STREAM=1/4']))
+        with self.assertRaises(ValueError):
+            upload_key('3', ['STREAM=4/4'])
+
+class TestAckSender(unittest.TestCase):
+
+    def test_acks_that_do_not_fit_in_the_send_buffer_are_left_for_flush(self):
+        server_sock, client_sock = socket.socketpair()
+        self.addCleanup(server_sock.close)
+        self.addCleanup(client_sock.close)
+        server_sock.settimeout(5)
+        # The client does not read until the send buffer is full
+        filler = ProtocolMessage.encode_string('x' * 1000)
+        frames = 0
+        while select.select([], [server_sock], [], 0)[1]:
+            server_sock.sendall(filler)
+            frames += 1
+
+        acks = AckSender(server_sock)
+        start = time.monotonic()
+        acks.send(0)
+        acks.send(1)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertTrue(acks.pending)
+
+        reading = threading.Thread(target=lambda: [ProtocolMessage.new_from_sock(client_sock) for _ in range(frames)])
+        reading.start()
+        acks.flush()
+        reading.join()
+        self.assertFalse(acks.pending)
+        self.assertEqual(['ACK,0', 'ACK,1'], [ProtocolMessage.new_from_sock(client_sock) for _ in range(2)])
+
+class TestShardCoordinator(unittest.TestCase):
+
+    def test_lottery_completes_once_when_every_agency_is_done(self):
+        coordinator = ShardCoordinator(multiprocessing.get_context("fork"), 3)
+        self.assertFalse(coordinator.agency_done(1))
+        self.assertFalse(coordinator.agency_done(3))
+        self.assertFalse(coordinator.agency_done(1))
+        self.assertFalse(coordinator.lottery_done.is_set())
+        self.assertTrue(coordinator.agency_done(2))
+        self.assertTrue(coordinator.lottery_done.is_set())
+        self.assertFalse(coordinator.agency_done(2))
+
+class TestPeekExactly(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.client_sock = socket.socketpair()
+        self.addCleanup(self.sock.close)
+        self.addCleanup(self.client_sock.close)
+
+    def test_waits_for_the_rest_of_a_request_that_arrived_in_part(self):
+        request = ProtocolMessage.encode_string('LOAD_BATCHES,1,ACK')
+        self.client_sock.sendall(request[:3])
+        sending = threading.Timer(0.05, self.client_sock.sendall, [request[3:]])
+        sending.start()
+        self.assertEqual(request, peek_exactly(self.sock, len(request), time.monotonic() + 5))
+        sending.join()
+        # Nothing was consumed
+        self.assertEqual('LOAD_BATCHES,1,ACK', ProtocolMessage.new_from_sock(self.sock))
+
+    def test_fails_past_the_deadline_or_when_the_connection_is_closed(self):
+        self.client_sock.sendall(b'\x01')
+        with self.assertRaises(socket.timeout):
+            peek_exactly(self.sock, HEADER_SIZE, time.monotonic() + 0.1)
+        self.sock.recv(1)
+        self.client_sock.close()
+        with self.assertRaises(ConnectionError):
+            peek_exactly(self.sock, HEADER_SIZE, time.monotonic() + 5)
+
+class TestParsedBatches(unittest.TestCase):
+
+    def test_batches_are_stored_in_arrival_order(self):
+        stored = []
+        bodies = [ProtocolMessage.encode_string_list([f"first,last,{i},2000-12-20,{i}"])[HEADER_SIZE:] for i in range(20)]
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            parsing = ParsedBatches(executor, 4, lambda parsed, seq: stored.append((seq, parsed[0].numbers[0])) or 1)
+            for i, body in enumerate(bodies):
+                parsing.submit('1', TYPE_STRING_LIST, body, i)
+            self.assertEqual(20, parsing.wait())
+        self.assertEqual([(i, i) for i in range(20)], stored)
+
+    def test_batches_after_a_parse_error_are_discarded(self):
+        stored = []
+        bodies = [ProtocolMessage.encode_string_list([line])[HEADER_SIZE:] for line in
+                  ["first,last,1,2000-12-20,1", "not a bet", "first,last,3,2000-12-20,3"]]
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            parsing = ParsedBatches(executor, 4, lambda parsed, on_committed: stored.append(parsed[0]) or 1)
+            for body in bodies:
+                parsing.submit('1', TYPE_STRING_LIST, body)
+            self.assertRaises(ValueError, parsing.wait)
+        self.assertEqual(1, len(stored))
+
+class TestMetrics(unittest.TestCase):
+
+    def test_registry_renders_counters_histograms_and_gauges(self):
+        registry = Registry()
+        registry.counter("bets_total", "Bets").inc(3, agency="1")
+        registry.counter("bets_total", "Bets").inc(2, agency="1")
+        histogram = registry.histogram("parse_seconds", "Parse time", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        registry.gauge("queue_depth", "Queue depth", lambda: 7)
+
+        lines = registry.render().splitlines()
+        self.assertIn('bets_total{agency="1"} 5', lines)
+        self.assertIn('parse_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('parse_seconds_bucket{le="+Inf"} 2', lines)
+        self.assertIn('parse_seconds_count 2', lines)
+        self.assertIn('queue_depth 7', lines)
+
+class TestThreadPool(unittest.TestCase):
+
+    def test_shed_policy_rejects_tasks_when_queue_is_full(self):
+        shed = []
+        pool = ThreadPool(1, max_queue=1, policy=POLICY_SHED, on_rejected=shed.append)
+        started, release = threading.Event(), threading.Event()
+        pool.submit(lambda: (started.set(), release.wait()))
+        started.wait(1)
+
+        self.assertTrue(pool.submit(lambda x: None, 1))
+        self.assertFalse(pool.submit(lambda x: None, 2))
+        self.assertTrue(pool.submit(lambda x: None, 3, bypass_limit=True))
+        self.assertEqual([2], shed)
+        self.assertEqual(1, pool.stats()["rejected"])
+        release.set()
+        pool.stop(1)
+
+    def test_grows_up_to_max_workers_while_tasks_wait(self):
+        pool = ThreadPool(1, max_workers=3)
+        barrier = threading.Barrier(3, timeout=2)
+        done = threading.Semaphore(0)
+        for _ in range(3):
+            pool.submit(lambda: (barrier.wait(), done.release()))
+        for _ in range(3):
+            self.assertTrue(done.acquire(timeout=3))
+        pool.stop(1)
+
+        self.assertFalse(barrier.broken)
+        self.assertEqual(3, pool.stats()["submitted"])
+
+    def test_grows_while_every_worker_is_busy_and_nothing_is_submitted(self):
+        pool = ThreadPool(1, max_workers=4)
+        release = threading.Event()
+        ran = threading.Event()
+        pool.submit(release.wait)
+        pool.submit(ran.set)
+
+        self.assertTrue(ran.wait(1))
+        self.assertEqual(2, pool.stats()["workers"])
+        release.set()
+        pool.stop(1)
+
+class _ServerTestCase(unittest.TestCase):
+    """ Runs servers of both modes over a temporary storage file and talks to them through sockets """
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.storage_filepath = os.path.join(self._dir.name, 'bets.csv')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _start(self, server_class, total_agencies=1, **kwargs):
+        server = server_class(0, 5, total_agencies, storage_filepath=self.storage_filepath, **kwargs)
+        runner = threading.Thread(target=server.run, daemon=True)
+        runner.start()
+        return server, runner
+
+    def _stop(self, server, runner):
+        server.stop()
+        # A blocking accept is not woken up by closing its socket from another thread (the
+        # server handles SIGTERM in the main thread), so only the event loop is waited for
+        if isinstance(server, AsyncServer):
+            runner.join(5)
+            self.assertFalse(runner.is_alive())
+
+    def _connect(self, server):
+        sock = socket.create_connection(('127.0.0.1', server._server_socket.getsockname()[1]), timeout=5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def _send_batch(self, sock, first_document, amount, number=7500):
+        sock.sendall(ProtocolMessage.encode_string_list(
+            [f'first,last,{first_document + i},2000-12-20,{number}' for i in range(amount)]))
+
+    def _upload(self, server, agency, winners, losers):
+        """
+        Upload a batch of winning bets and one of losing bets of an
+        agency, numbered from the given documents, through a new
+        connection that is left open for its next requests
+        """
+        sock = self._connect(server)
+        ProtocolMessage.send_string_to_sock(sock, f'LOAD_BATCHES,{agency},ACK')
+        self.assertTrue(ProtocolMessage.new_from_sock(sock).startswith('LOAD_OK'))
+        self._send_batch(sock, *winners, number=LOTTERY_WINNER_NUMBER)
+        self._send_batch(sock, *losers)
+        self.assertEqual(['ACK,0', 'ACK,1'], [ProtocolMessage.new_from_sock(sock) for _ in range(2)])
+        ProtocolMessage.send_string_to_sock(sock, 'END')
+        return sock
+
+    def _results(self, sock, agency, *options):
+        ProtocolMessage.send_string_to_sock(sock, ','.join(['RESULTS_REQUEST', str(agency), *options]))
+        return ProtocolMessage.new_from_sock(sock)
+
+    def _stored_documents(self):
+        return sorted(int(bet.document) for bet in load_bets(self.storage_filepath))
+
+class TestLoadBatchesAcks(_ServerTestCase):
+
+    def test_batches_are_acked_in_order_and_a_resumed_upload_gets_its_offset(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class=server_class.__name__):
+                server, runner = self._start(server_class)
+                sock = self._connect(server)
+                ProtocolMessage.send_string_to_sock(sock, 'LOAD_BATCHES,1,ACK')
+                self.assertEqual('LOAD_OK,ACK,OFFSET=0', ProtocolMessage.new_from_sock(sock))
+                for i in range(3):
+                    self._send_batch(sock, 2 * i, 2)
+                self.assertEqual(['ACK,0', 'ACK,1', 'ACK,2'], [ProtocolMessage.new_from_sock(sock) for _ in range(3)])
+                # The upload breaks without END, and is resumed from what was stored
+                sock.close()
+
+                sock = self._connect(server)
+                ProtocolMessage.send_string_to_sock(sock, 'LOAD_BATCHES,1,ACK')
+                self.assertEqual('LOAD_OK,ACK,OFFSET=6', ProtocolMessage.new_from_sock(sock))
+                self._send_batch(sock, 6, 2)
+                self.assertEqual('ACK,0', ProtocolMessage.new_from_sock(sock))
+                ProtocolMessage.send_string_to_sock(sock, 'END')
+                # An idle connection would keep a worker blocked on it until MSG_TIMEOUT
+                sock.close()
+                self._stop(server, runner)
+
+                self.assertEqual(list(range(8)), self._stored_documents())
+                os.remove(self.storage_filepath)
+
+class TestDrain(_ServerTestCase):
+    DRAIN_TIMEOUT = 2
+
+    def _drain(self, server, runner):
+        """ Drain the server from another thread, returning the seconds it took to stop """
+        elapsed = []
+        def drain():
+            start = time.monotonic()
+            server.drain()
+            # AsyncServer.drain only schedules the drain in the event loop
+            if isinstance(server, AsyncServer):
+                runner.join()
+            elapsed.append(time.monotonic() - start)
+        draining = threading.Thread(target=drain, daemon=True)
+        draining.start()
+        self.assertTrue(server._draining.wait(5))
+        return draining, elapsed
+
+    def test_drain_interrupts_an_upload_after_storing_what_it_received(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class=server_class.__name__):
+                server, runner = self._start(server_class, journal=True, drain_timeout=self.DRAIN_TIMEOUT)
+                sock = self._connect(server)
+                ProtocolMessage.send_string_to_sock(sock, 'LOAD_BATCHES,1,ACK')
+                self.assertEqual('LOAD_OK,ACK,OFFSET=0', ProtocolMessage.new_from_sock(sock))
+                for i in range(2):
+                    self._send_batch(sock, 2 * i, 2)
+                self.assertEqual(['ACK,0', 'ACK,1'], [ProtocolMessage.new_from_sock(sock) for _ in range(2)])
+                # ACKs are sent by the bets writer, maybe before the upload gets back to reading
+                time.sleep(0.1)
+
+                draining, elapsed = self._drain(server, runner)
+                # The batch being read when the drain started is still stored and acked
+                self._send_batch(sock, 4, 2)
+                self.assertEqual('ACK,2', ProtocolMessage.new_from_sock(sock))
+                self.assertEqual('SERVER_DRAINING', ProtocolMessage.new_from_sock(sock))
+                sock.close()
+                draining.join(self.DRAIN_TIMEOUT + 5)
+                self.assertLess(elapsed[0], self.DRAIN_TIMEOUT)
+                self.assertEqual(list(range(6)), self._stored_documents())
+
+                # The upload is resumed after the restart from what was stored
+                server, runner = self._start(server_class, journal=True)
+                sock = self._connect(server)
+                ProtocolMessage.send_string_to_sock(sock, 'LOAD_BATCHES,1,ACK')
+                self.assertEqual('LOAD_OK,ACK,OFFSET=6', ProtocolMessage.new_from_sock(sock))
+                sock.close()
+                self._stop(server, runner)
+
+                os.remove(self.storage_filepath)
+                os.remove(journal_filepath(self.storage_filepath))
+
+class TestResults(_ServerTestCase):
+
+    def test_each_agency_gets_its_winners_once_every_agency_is_done(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class=server_class.__name__):
+                server, runner = self._start(server_class, total_agencies=2)
+                first = self._upload(server, 1, winners=(10, 2), losers=(12, 2))
+                ProtocolMessage.send_string_to_sock(first, 'ALL_BETS_SENT,1')
+                self.assertEqual('LOTERY_IN_PROGRESS', self._results(first, 1))
+
+                second = self._upload(server, 2, winners=(20, 1), losers=(21, 1))
+                ProtocolMessage.send_string_to_sock(second, 'ALL_BETS_SENT,2')
+                self.assertEqual(['20'], self._results(second, 2))
+                self.assertEqual(['10', '11'], self._results(first, 1))
+                first.close()
+                second.close()
+                self._stop(server, runner)
+                os.remove(self.storage_filepath)
+
+    def test_waiting_request_is_answered_when_the_lottery_completes_or_the_wait_times_out(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class=server_class.__name__):
+                server, runner = self._start(server_class, total_agencies=2, results_wait_timeout=5)
+                first = self._upload(server, 1, winners=(10, 1), losers=(11, 1))
+                ProtocolMessage.send_string_to_sock(first, 'ALL_BETS_SENT,1')
+                ProtocolMessage.send_string_to_sock(first, 'RESULTS_REQUEST,1,WAIT')
+                # Held while the other agency is not done
+                self.assertEqual([], select.select([first], [], [], 0.2)[0])
+
+                second = self._connect(server)
+                start = time.monotonic()
+                ProtocolMessage.send_string_to_sock(second, 'ALL_BETS_SENT,2')
+                self.assertEqual(['10'], ProtocolMessage.new_from_sock(first))
+                self.assertLess(time.monotonic() - start, 1)
+                first.close()
+                second.close()
+                self._stop(server, runner)
+                os.remove(self.storage_filepath)
+
+                server, runner = self._start(server_class, total_agencies=2, results_wait_timeout=0.5)
+                sock = self._connect(server)
+                start = time.monotonic()
+                self.assertEqual('LOTERY_IN_PROGRESS', self._results(sock, 1, 'WAIT'))
+                self.assertGreaterEqual(time.monotonic() - start, 0.5)
+                sock.close()
+                self._stop(server, runner)
+                os.remove(self.storage_filepath)
+
+    def test_results_are_encoded_again_when_winners_change_after_the_lottery(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class=server_class.__name__):
+                server, runner = self._start(server_class, total_agencies=2)
+                first = self._upload(server, 1, winners=(10, 1), losers=(11, 1))
+                ProtocolMessage.send_string_to_sock(first, 'ALL_BETS_SENT,1')
+                ProtocolMessage.send_string_to_sock(first, 'ALL_BETS_SENT,2')
+                self.assertEqual(['10'], self._results(first, 1))
+                self.assertIs(server._results_message_for('1'), server._results_message_for('1'))
+
+                # An upload finished after the lottery adds its winners to the results
+                late = self._upload(server, 1, winners=(12, 1), losers=(13, 1))
+                self.assertEqual(['10', '12'], self._results(late, 1))
+                self.assertEqual([], self._results(late, 2))
+                first.close()
+                late.close()
+                self._stop(server, runner)
+                os.remove(self.storage_filepath)
+
+class TestStreams(_ServerTestCase):
+
+    def _open_stream(self, server, stream, offset):
+        sock = self._connect(server)
+        ProtocolMessage.send_string_to_sock(sock, f'LOAD_BATCHES,1,ACK,STREAM={stream}/2')
+        self.assertEqual(f'LOAD_OK,ACK,STREAM={stream}/2,OFFSET={offset}', ProtocolMessage.new_from_sock(sock))
+        return sock
+
+    def test_streams_are_resumed_from_their_own_offset_and_all_bets_sent_waits_for_every_one(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class=server_class.__name__):
+                # A worker per connection of the agency
+                server, runner = self._start(server_class, pool_max_workers=3)
+                first, second = self._open_stream(server, 0, 0), self._open_stream(server, 1, 0)
+                self._send_batch(first, 0, 3)
+                self._send_batch(second, 10, 1)
+                self.assertEqual('ACK,0', ProtocolMessage.new_from_sock(first))
+                self.assertEqual('ACK,0', ProtocolMessage.new_from_sock(second))
+                # Both uploads break without END
+                first.close()
+                second.close()
+
+                first, second = self._open_stream(server, 0, 3), self._open_stream(server, 1, 1)
+                self._send_batch(first, 3, 1, number=LOTTERY_WINNER_NUMBER)
+                self.assertEqual('ACK,0', ProtocolMessage.new_from_sock(first))
+                ProtocolMessage.send_string_to_sock(first, 'END')
+                done = self._connect(server)
+                ProtocolMessage.send_string_to_sock(done, 'ALL_BETS_SENT,1')
+                ProtocolMessage.send_string_to_sock(done, 'RESULTS_REQUEST,1')
+                # Held while the second stream is still uploading
+                self.assertEqual([], select.select([done], [], [], 0.2)[0])
+
+                self._send_batch(second, 11, 1, number=LOTTERY_WINNER_NUMBER)
+                self.assertEqual('ACK,0', ProtocolMessage.new_from_sock(second))
+                ProtocolMessage.send_string_to_sock(second, 'END')
+                self.assertEqual(['3', '11'], ProtocolMessage.new_from_sock(done))
+                for sock in (first, second, done):
+                    sock.close()
+                self._stop(server, runner)
+
+                self.assertEqual([0, 1, 2, 3, 10, 11], self._stored_documents())
+                os.remove(self.storage_filepath)
+
+class TestCompression(_ServerTestCase):
+
+    @staticmethod
+    def _compressed_frame(msg_type, data):
+        body = msg_type + data
+        return TYPE_COMPRESSED + len(body).to_bytes(4, byteorder='big') + body
+
+    def test_compressed_batches_are_stored_and_invalid_ones_end_the_upload(self):
+        bad_frames = {
+            'too_large': self._compressed_frame(TYPE_STRING_LIST, zlib.compress(bytes(MAX_DECOMPRESSED_SIZE + 1), 9)),
+            'corrupt': self._compressed_frame(TYPE_STRING_LIST, b'not a zlib stream'),
+        }
+        for server_class in (Server, AsyncServer):
+            for name, bad_frame in bad_frames.items():
+                with self.subTest(server_class=server_class.__name__, frame=name):
+                    server, runner = self._start(server_class)
+                    sock = self._connect(server)
+                    ProtocolMessage.send_string_to_sock(sock, 'LOAD_BATCHES,1,ACK,ZLIB')
+                    self.assertEqual('LOAD_OK,ACK,ZLIB,OFFSET=0', ProtocolMessage.new_from_sock(sock))
+                    batch = ProtocolMessage.encode_string_list([f'first,last,{i},2000-12-20,7500' for i in range(2)])
+                    sock.sendall(ProtocolMessage.encode_compressed(batch))
+                    self.assertEqual('ACK,0', ProtocolMessage.new_from_sock(sock))
+
+                    sock.sendall(bad_frame)
+                    ProtocolMessage.send_string_to_sock(sock, 'END')
+                    # The connection is closed with no ACK for the invalid batch
+                    self.assertEqual(b'', sock.recv(1))
+                    sock.close()
+
+                    sock = self._connect(server)
+                    ProtocolMessage.send_string_to_sock(sock, 'LOAD_BATCHES,1,ACK,ZLIB')
+                    self.assertEqual('LOAD_OK,ACK,ZLIB,OFFSET=2', ProtocolMessage.new_from_sock(sock))
+                    sock.close()
+                    self._stop(server, runner)
+
+                    self.assertEqual([0, 1], self._stored_documents())
+                    os.remove(self.storage_filepath)
+
+class TestRecovery(_ServerTestCase):
+
+    def test_restart_truncates_unacknowledged_bets_and_restores_the_agencies_done_and_the_lottery(self):
+        for server_class in (Server, AsyncServer):
+            with self.subTest(server_class=server_class.__name__):
+                server, runner = self._start(server_class, total_agencies=2, journal=True)
+                first = self._upload(server, 1, winners=(10, 1), losers=(11, 1))
+                ProtocolMessage.send_string_to_sock(first, 'ALL_BETS_SENT,1')
+                self._upload(server, 2, winners=(20, 1), losers=(21, 1)).close()
+                self.assertEqual('LOTERY_IN_PROGRESS', self._results(first, 1))
+                first.close()
+                self._stop(server, runner)
+                # A batch written by a crashed server but never checkpointed in the journal
+                with open(self.storage_filepath, 'a') as file:
+                    file.write(f'2,first,last,22,2000-12-20,{LOTTERY_WINNER_NUMBER}\n')
+
+                server, runner = self._start(server_class, total_agencies=2, journal=True)
+                self.assertEqual([10, 11, 20, 21], self._stored_documents())
+                self.assertEqual({1}, server._agencies_done_submitting)
+                sock = self._connect(server)
+                ProtocolMessage.send_string_to_sock(sock, 'LOAD_BATCHES,2,ACK')
+                self.assertEqual('LOAD_OK,ACK,OFFSET=2', ProtocolMessage.new_from_sock(sock))
+                ProtocolMessage.send_string_to_sock(sock, 'END')
+                ProtocolMessage.send_string_to_sock(sock, 'ALL_BETS_SENT,2')
+                self.assertEqual(['20'], self._results(sock, 2))
+                sock.close()
+                self._stop(server, runner)
+
+                # The lottery is completed on startup, with no agency sending ALL_BETS_SENT again
+                server, runner = self._start(server_class, total_agencies=2, journal=True)
+                sock = self._connect(server)
+                self.assertEqual(['10'], self._results(sock, 1))
+                self.assertEqual(['20'], self._results(sock, 2))
+                sock.close()
+                self._stop(server, runner)
+
+                os.remove(self.storage_filepath)
+                os.remove(journal_filepath(self.storage_filepath))
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_storage_settings_default_to_the_ones_of_config_ini(self):
+        config = benchmark.server_config()
+        args = benchmark.get_args([])
+        self.assertEqual(config["STORAGE_FORMAT"], args.storage_format)
+        self.assertEqual(config.getboolean("STORAGE_JOURNAL"), args.journal)
+        self.assertEqual(config.getboolean("STORAGE_DEDUP"), args.dedup)
+
+        args = benchmark.get_args(['--no-journal', '--dedup'])
+        self.assertFalse(args.journal)
+        self.assertTrue(args.dedup)
+
+    def test_run_reports_every_bet_stored_and_every_winner(self):
+        args = benchmark.get_args(['--bets-per-agency', '300', '--window', '4'])
+        report = benchmark.run(args, 2, 50)
+
+        self.assertEqual(600, report["bets"])
+        winners = sum(int(line.rsplit(',', 1)[1]) == LOTTERY_WINNER_NUMBER
+                      for agency in (1, 2) for line in benchmark.load_agency_lines(args, agency))
+        self.assertEqual(winners, report["winners"])
+        self.assertGreater(report["bets_per_sec"], 0)
+        self.assertIsNotNone(report["batch_latency_ms"]["p99"])
+        self.assertGreater(report["peak_rss_kb"], 0)
+
+def _load_generar_compose():
+    filepath = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'generar-compose.py')
+    spec = importlib.util.spec_from_file_location('generar_compose', filepath)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class TestGenerarCompose(unittest.TestCase):
+
+    def setUp(self):
+        self.generar_compose = _load_generar_compose()
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+        self.filepath = os.path.join(self._dir.name, 'docker-compose.yaml')
+
+    def _compose(self):
+        with open(self.filepath) as file:
+            return file.read()
+
+    def test_a_service_per_agency(self):
+        self.generar_compose.generar_compose(self.filepath, 3)
+        compose = self._compose()
+
+        self.assertIn('TOTAL_AGENCIES=3', compose)
+        for agency in (1, 2, 3):
+            self.assertIn(f'  client{agency}:\n', compose)
+            self.assertIn(f'./.data/agency-{agency}.csv:/data/agency-{agency}.csv', compose)
+        self.assertNotIn('client4:', compose)
+
+    def test_fleet_groups_agencies_by_container(self):
+        self.generar_compose.generar_compose_flota(self.filepath, 10, 4, False, './datos')
+        compose = self._compose()
+
+        self.assertIn('SERVER_LISTEN_BACKLOG=10', compose)
+        self.assertIn('./datos:/data:ro', compose)
+        for container, (first, last) in enumerate([(1, 4), (5, 8), (9, 10)], start=1):
+            self.assertIn(f'  client{container}:\n', compose)
+            self.assertIn(f'$$(seq {first} {last})', compose)
+        self.assertNotIn('client4:', compose)
+        self.assertNotIn('replicas:', compose)
+
+    def test_fleet_of_replicas_takes_a_slot_each(self):
+        self.generar_compose.generar_compose_flota(self.filepath, 10, 4, True, './datos')
+        compose = self._compose()
+
+        self.assertIn('      replicas: 3\n', compose)
+        self.assertIn('client-slots:/slots', compose)
+        self.assertIn('volumes:\n  client-slots:\n', compose)
+        self.assertNotIn('client1:', compose)
+
+    def test_synthetic_agencies_follow_the_zipf_skew(self):
+        datos = os.path.join(self._dir.name, 'datos')
+        self.assertEqual([1, 2, 3], self.generar_compose.agencias_sin_datos(datos, 3))
+        self.generar_compose.generar_apuestas(datos, 3, 100, 1.0, 0)
+
+        self.assertEqual([], self.generar_compose.agencias_sin_datos(datos, 3))
+        rows = []
+        for agency in (1, 2, 3):
+            with open(os.path.join(datos, f'agency-{agency}.csv'), encoding='utf-8') as file:
+                lines = file.read().splitlines()
+            rows.append(len(lines))
+            for line in lines:
+                Bet.from_string(str(agency), line)
+        # Agency n gets a share proportional to 1/n
+        self.assertEqual([164, 82, 55], rows)
 
 if __name__ == '__main__':
     unittest.main()